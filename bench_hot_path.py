@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import json
+import math
+import os
+import platform
+import pstats
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+
+from physics import VirtualBike
+from trainer_data import derived_information, print_data, save_max, set_resistance
+from session_recorder import SessionRecorder
+from sim_devices import SimClock, SimulatedTrainer, SyntheticProfile
+
+'''
+Benchmarks for everything that runs every tick. For each input rate and session length it runs the number of ticks
+that session would have (rate * seconds) as fast as it can, and reports throughput, per call latency percentiles,
+bytes allocated per tick and bytes written per tick (to disk, or to the terminal for print_data).
+
+The nested closures in derived_information can't be called on their own, so their share of the time comes from a
+cProfile pass over the first few thousand ticks.
+
+Results can be saved as a JSON baseline, and a later run can be compared against it to catch regressions:
+    python bench_hot_path.py --quick --save-baseline bench_baselines/hot_path.json
+    python bench_hot_path.py --quick --compare bench_baselines/hot_path.json
+'''
+
+default_rates = [4, 10, 25, 100]  # Hz
+default_durations = [60, 600, 3600, 21600]  # 1 minute to 6 hours
+quick_durations = [60, 600]
+
+alloc_sample_ticks = 2000  # Ticks run under tracemalloc, it slows everything down so only a slice gets measured
+profile_ticks = 5000  # Ticks run under cProfile for the closure breakdown
+closures = ("calculate_elapsed_time", "calculate_virtual_speed", "calculate_wkg")
+
+
+# Fake trainer input, a bit of variation so nothing gets optimised down to a constant
+def make_inputs(shared_data, debug_data, tick, rate):
+    t = tick / rate
+    shared_data["power"] = 180 + 60 * math.sin(t * 0.05)
+    shared_data["cadence"] = 88 + 4 * math.sin(t * 0.3)
+    shared_data["heart_rate"] = 140 + int(10 * math.sin(t * 0.01))
+    debug_data["t_speed"] = 30 + 3 * math.sin(t * 0.05)
+
+
+def fresh_data():
+    shared_data = {"power": 0, "cadence": 0, "speed": 0, "heart_rate": None, "weight": 75, "velocity": 0}
+    debug_data = {}
+    return shared_data, debug_data
+
+
+def percentiles(samples_ns):
+    ordered = sorted(samples_ns)
+    n = len(ordered)
+
+    def pick(p):
+        return ordered[min(n - 1, int(p / 100 * n))] / 1000
+
+    return {
+        "p50_us": pick(50),
+        "p90_us": pick(90),
+        "p99_us": pick(99),
+        "p999_us": pick(99.9),
+        "max_us": ordered[-1] / 1000,
+        "mean_us": sum(ordered) / n / 1000,
+    }
+
+
+# Transient bytes allocated per call. tracemalloc's peak is reset before each call, so peak minus what's still held
+# afterwards is what the call allocated and threw away.
+def allocations_per_tick(call, ticks):
+    tracemalloc.start()
+    total_peak = 0
+    total_retained = 0
+    try:
+        for tick in range(ticks):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            call(tick)
+            after, peak = tracemalloc.get_traced_memory()
+            total_peak += peak - before
+            total_retained += after - before
+    finally:
+        tracemalloc.stop()
+    return {"alloc_bytes_per_tick": total_peak / ticks, "retained_bytes_per_tick": total_retained / ticks}
+
+
+# Counts what print_data sends to the terminal without actually printing it
+class CountingSink:
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def run_timed(call, ticks):
+    latencies = array("q", bytes(8 * ticks))
+    clock = time.perf_counter_ns
+    started = clock()
+    for tick in range(ticks):
+        t0 = clock()
+        call(tick)
+        latencies[tick] = clock() - t0
+    wall = (clock() - started) / 1e9
+    result = {"ticks": ticks, "wall_s": wall, "calls_per_s": ticks / wall if wall else 0.0}
+    result.update(percentiles(latencies))
+    return result
+
+
+# Each pass gets its own bike and starts the clock again, with the time going up by 1 / rate a tick. Ticks run much
+# faster than real time, so on the real clock the physics would hardly ever step, and the module level bike would carry
+# its state from one run into the next.
+def derived_information_call(rate):
+    shared_data, debug_data = fresh_data()
+    state = {"elapsed_start_time": None, "is_moving": False}
+    bike = VirtualBike()
+
+    def call(tick):
+        make_inputs(shared_data, debug_data, tick, rate)
+        state["elapsed_start_time"], state["is_moving"] = derived_information(
+            shared_data, debug_data, state["elapsed_start_time"], state["is_moving"], 0.0, bike=bike, now=tick / rate)
+
+    return call
+
+
+def bench_derived_information(rate, ticks):
+    call = derived_information_call(rate)
+    result = run_timed(call, ticks)
+    result.update(allocations_per_tick(derived_information_call(rate), min(ticks, alloc_sample_ticks)))
+    result["file_bytes_per_tick"] = 0
+
+    # Closure breakdown
+    call = derived_information_call(rate)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for tick in range(min(ticks, profile_ticks)):
+        call(tick)
+    profiler.disable()
+    breakdown = {}
+    for (file_name, line, name), (cc, nc, tt, ct, callers) in pstats.Stats(profiler).stats.items():
+        if name in closures:
+            breakdown[name] = {"calls": nc, "mean_cum_us": ct / nc * 1e6 if nc else 0.0}
+    result["closures"] = breakdown
+    return result
+
+
+def bench_print_data(rate, ticks):
+    shared_data, debug_data = fresh_data()
+    derived_information(shared_data, debug_data, None, False, 0.0, bike=VirtualBike(), now=0.0)
+    sink = CountingSink()
+
+    def call(tick):
+        make_inputs(shared_data, debug_data, tick, rate)
+        print_data(shared_data, debug_data, "raw_elapsed_time", debug=True)
+
+    with contextlib.redirect_stdout(sink):
+        result = run_timed(call, ticks)
+        bytes_out = sink.bytes
+        result.update(allocations_per_tick(call, min(ticks, alloc_sample_ticks)))
+    result["file_bytes_per_tick"] = bytes_out / ticks
+    return result
+
+
+def bench_save_max(rate, ticks, work_dir):
+    shared_data, debug_data = fresh_data()
+    derived_information(shared_data, debug_data, None, False, 0.0, bike=VirtualBike(), now=0.0)
+    file_name = os.path.join(work_dir, "max_values.json")
+
+    def call(tick):
+        make_inputs(shared_data, debug_data, tick, rate)
+        save_max(shared_data, debug_data, file_name)
+
+    # save_max rewrites the whole file every call, so the bytes written per call is the size of the file
+    result = run_timed(call, ticks)
+    result["file_bytes_per_tick"] = os.path.getsize(file_name)
+    result.update(allocations_per_tick(call, min(ticks, alloc_sample_ticks)))
+    return result
+
+
+# The session recorder that replaced save_max in the main loop, for comparison
+def bench_session_recorder(rate, ticks, work_dir):
+    shared_data, debug_data = fresh_data()
+    derived_information(shared_data, debug_data, None, False, 0.0, bike=VirtualBike(), now=0.0)
+
+    async def run():
+        recorder = SessionRecorder(log_dir=work_dir, summary_file=None, checkpoint_interval=None)
+
+        def call(tick):
+            make_inputs(shared_data, debug_data, tick, rate)
+            recorder.record(shared_data, debug_data)
+
+        result = run_timed(call, ticks)
+        result.update(allocations_per_tick(call, min(ticks, alloc_sample_ticks)))
+        await recorder.close()
+        result["file_bytes_per_tick"] = recorder.bytes_written / recorder.samples_recorded
+        return result
+
+    return asyncio.run(run())
+
+
+# set_resistance against the simulated trainer's FTMS stand in. The target changes every call, so every call does the
+# full request control / reset / set resistance round
+def bench_set_resistance(rate, ticks):
+    async def run():
+        trainer = SimulatedTrainer(SyntheticProfile(), SimClock(), response_delay=0)
+        ftms = trainer.create_ftms()
+        shared_data, _ = fresh_data()
+        latencies = array("q", bytes(8 * ticks))
+        clock = time.perf_counter_ns
+        current = 20
+        started = clock()
+        for tick in range(ticks):
+            desired = 20 + tick % 10
+            t0 = clock()
+            current = await set_resistance(ftms, desired, current, shared_data, retries=10)
+            latencies[tick] = clock() - t0
+            if tick % 10000 == 0:
+                ftms.commands.clear()
+        wall = (clock() - started) / 1e9
+        result = {"ticks": ticks, "wall_s": wall, "calls_per_s": ticks / wall if wall else 0.0,
+                  "file_bytes_per_tick": 0}
+        result.update(percentiles(latencies))
+        return result
+
+    return asyncio.run(run())
+
+
+def run_suite(rates, durations, functions):
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for rate in rates:
+            for duration in durations:
+                ticks = int(rate * duration)
+                key = f"{rate:g}Hz_{duration:g}s"
+                results[key] = {}
+                for name in functions:
+                    if name == "derived_information":
+                        result = bench_derived_information(rate, ticks)
+                    elif name == "print_data":
+                        result = bench_print_data(rate, ticks)
+                    elif name == "save_max":
+                        result = bench_save_max(rate, ticks, work_dir)
+                    elif name == "session_recorder":
+                        result = bench_session_recorder(rate, ticks, work_dir)
+                    else:
+                        result = bench_set_resistance(rate, ticks)
+                    results[key][name] = result
+                    print(f"{key:>14} {name:<20} {result['calls_per_s']:>12.0f}/s  p50 {result['p50_us']:8.1f}us  "
+                          f"p99 {result['p99_us']:8.1f}us  alloc {result.get('alloc_bytes_per_tick', 0):8.0f}B  "
+                          f"written {result['file_bytes_per_tick']:8.0f}B")
+    return results
+
+
+# Flags anything whose p50 or p99 got more than `threshold` slower than the baseline
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, functions in results.items():
+        for name, result in functions.items():
+            base = baseline.get("results", {}).get(key, {}).get(name)
+            if not base:
+                continue
+            for metric in ("p50_us", "p99_us"):
+                if base[metric] > 0 and result[metric] > base[metric] * (1 + threshold):
+                    regressions.append(f"{key} {name} {metric}: {base[metric]:.1f}us -> {result[metric]:.1f}us")
+    return regressions
+
+
+if __name__ == "__main__":
+    all_functions = ["derived_information", "print_data", "save_max", "session_recorder", "set_resistance"]
+    parser = argparse.ArgumentParser(description="Benchmark the per tick hot path")
+    parser.add_argument("--rates", type=float, nargs="+", default=default_rates, help="input rates in Hz")
+    parser.add_argument("--durations", type=float, nargs="+", default=None, help="session lengths in seconds")
+    parser.add_argument("--quick", action="store_true", help="only the 1 and 10 minute sessions")
+    parser.add_argument("--functions", nargs="+", default=all_functions, choices=all_functions)
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the results to a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    durations = args.durations or (quick_durations if args.quick else default_durations)
+    results = run_suite(args.rates, durations, args.functions)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or ".", exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=4)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions:")
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print("No regressions.")
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from bleak import BleakScanner
+
+'''
+Shared bluetooth scanning. Every connection used to run its own full BleakScanner.discover(), one after the other,
+and each one takes several seconds. This does one scan for everything that's wanted, and stops as soon as all of the
+wanted devices have been seen rather than waiting out the full timeout.
+
+Whatever turns up gets kept in a short lived cache, so connect_profile.py's trainer and HRM setup, and the trainer
+data connection, can reuse the last scan instead of starting another one.
+'''
+
+FTMS_SERVICE = "00001826-0000-1000-8000-00805f9b34fb"
+HEART_RATE_SERVICE = "0000180d-0000-1000-8000-00805f9b34fb"
+
+cache_ttl = 30.0  # Seconds a scan result is trusted for
+default_timeout = 10.0
+
+# address -> (BLEDevice, advertised service uuids, time seen)
+_cache = {}
+_last_full_scan = None
+
+
+def _fresh(seen):
+    return time.monotonic() - seen <= cache_ttl
+
+
+def cached_device(address):
+    if not address:
+        return None
+    entry = _cache.get(address.upper())
+    if entry and _fresh(entry[2]):
+        return entry[0]
+    return None
+
+
+def clear_cache():
+    global _last_full_scan
+    _cache.clear()
+    _last_full_scan = None
+
+
+# Scan for devices. If addresses are given, the scan stops as soon as they have all been seen, and if they're all
+# already in the cache there's no scan at all. service_uuids limits the results to devices advertising those services.
+# Returns {address: BLEDevice} for everything found.
+async def scan(addresses=None, service_uuids=None, timeout=default_timeout, use_cache=True):
+    global _last_full_scan
+    wanted = {address.upper() for address in addresses if address} if addresses else set()
+
+    if use_cache:
+        if wanted and all(cached_device(address) for address in wanted):
+            return {address: cached_device(address) for address in wanted}
+        if not wanted and _last_full_scan and _fresh(_last_full_scan) and not service_uuids:
+            return {address: entry[0] for address, entry in _cache.items() if _fresh(entry[2])}
+
+    found = {}
+    all_seen = asyncio.Event()
+
+    def detection_callback(device, advertisement_data):
+        address = device.address.upper()
+        uuids = [uuid.lower() for uuid in (advertisement_data.service_uuids or [])]
+        _cache[address] = (device, uuids, time.monotonic())
+        found[address] = device
+        if wanted and wanted.issubset(found):
+            all_seen.set()
+
+    scanner_kwargs = {"detection_callback": detection_callback}
+    if service_uuids:
+        scanner_kwargs["service_uuids"] = list(service_uuids)
+    scanner = BleakScanner(**scanner_kwargs)
+
+    await scanner.start()
+    try:
+        await asyncio.wait_for(all_seen.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass  # Not everything showed up, go with what we've got
+    finally:
+        await scanner.stop()
+
+    if not wanted and not service_uuids:
+        _last_full_scan = time.monotonic()
+    return found
+
+
+# Same as BleakScanner.discover(), a list of the devices nearby, but going through the cache
+async def discover(service_uuids=None, timeout=5.0, use_cache=True):
+    return list((await scan(service_uuids=service_uuids, timeout=timeout, use_cache=use_cache)).values())
+
+
+# Devices in the cache that advertise a service, for putting likely matches at the top of a list
+def advertises(address, service_uuid):
+    entry = _cache.get(address.upper())
+    return bool(entry) and service_uuid.lower() in entry[1]
@@ -1,8 +1,9 @@
-import os
-import json
+import argparse
 import asyncio
-from bleak import BleakScanner, BleakClient
-from pycycling.fitness_machine_service import FitnessMachineService
+from bleak import BleakClient
+import ble_scan
+from profile_store import get_store
+from ftms_capabilities import get_capabilities
 
 # THIS SCRIPT NEEDS TO BE RUN AT LEAST ONCE BEFORE RUNNING THE TRAINER DATA SCRIPT PLEASE
 
@@ -11,29 +12,15 @@ debug = 0
 
 # Initialise the User Profile json
 user_profile = "userprofile.json"
+rider = None  # Which rider profile to set up. None uses whichever one was used last
 
-# Function to load profile
+# Function to load profile. The store parses the file once and hands back the same cached profile every time
 def load_profile():
-    if os.path.exists(user_profile):
-        with open(user_profile, "r") as f:
-            try:
-                profile = json.load(f)
-                # Setting up the headings if they do not exist
-                if "user_data" not in profile:
-                    profile["user_data"] = {}
-                if "device" not in profile:
-                    profile["device"] = {}
-                return profile
-            except json.JSONDecodeError:
-                return {"user_data": {}, "device": {}}
-                # Return empty. This happens if the file is there but does not contain anything
-    else:
-        return {"user_data": {}, "device": {}}
-
-# Function to save user profile
+    return get_store(user_profile).get(rider)
+
+# Function to save user profile. The store batches the saves up and writes the file once things go quiet
 def save_profile(profile):
-    with open(user_profile, "w") as f:
-        json.dump(profile, f, indent=4, sort_keys=True)
+    get_store(user_profile).save(profile, rider)
 
 
 
@@ -106,12 +93,10 @@ def weight_init(profile):
 # work with power alone, and ignore other metrics.
 async def check_ftms_power_support(client):
     try:
-        ftms = FitnessMachineService(client)
-        features_tuple = await ftms.get_fitness_machine_feature()
-        fitness_features = features_tuple[0]
+        capabilities = await get_capabilities(client)
 
         # Check for power measurement
-        if fitness_features.power_measurement_supported:
+        if capabilities["fitness_machine_features"].get("power_measurement_supported"):
             return True
         else:
             return False
@@ -122,20 +107,16 @@ async def check_ftms_power_support(client):
         return False
 
 # Query FTMS Features
-# This query retrieves and categorizes FTMS features into supported and unsupported.
+# This query retrieves and categorizes FTMS features into supported and unsupported. The full feature set gets cached
+# per device and firmware, so this only goes over bluetooth the first time.
 async def query_ftms_features(client):
     try:
-        ftms = FitnessMachineService(client)
-        features_tuple = await ftms.get_fitness_machine_feature()
-        fitness_features = features_tuple[0]  # First element of the tuple
+        capabilities = await get_capabilities(client)
+        fitness_features = capabilities["fitness_machine_features"]
 
         # Sorrt fitness machine features into True and False
-        true_features = [
-            field for field in fitness_features._fields if getattr(fitness_features, field)
-        ]
-        false_features = [
-            field for field in fitness_features._fields if not getattr(fitness_features, field)
-        ]
+        true_features = [field for field, supported in fitness_features.items() if supported]
+        false_features = [field for field, supported in fitness_features.items() if not supported]
 
         return true_features, false_features
 
@@ -152,9 +133,11 @@ async def connect_hrm(profile):
         print(f"HRM already saved: {profile['device']['hrm_name']}")
         return  # Skip connection if HRM is already saved
 
-    # Begin scanning for HRM devices
+    # Begin scanning for HRM devices. This reuses the trainer's scan if it was only just done
     print("Searching for heart rate monitors...")
-    devices = await BleakScanner.discover()
+    devices = await ble_scan.discover()
+    # Anything advertising the heart rate service goes at the top of the list
+    devices.sort(key=lambda d: not ble_scan.advertises(d.address, ble_scan.HEART_RATE_SERVICE))
 
     # If there are no devices found nearby, print a message to the user
     if not devices:
@@ -171,7 +154,7 @@ async def connect_hrm(profile):
         selected_device = devices[device_index]
 
         # Attempt to connect to the selected HRM
-        async with BleakClient(selected_device.address) as client:
+        async with BleakClient(selected_device) as client:
             if client.is_connected:
                 print(f"Connected to HRM: {selected_device.name}")
 
@@ -208,7 +191,7 @@ async def connect_device(profile):
 
         # Attempt to connect to the saved device
         try:
-            async with BleakClient(device_address) as client:
+            async with BleakClient(ble_scan.cached_device(device_address) or device_address) as client:
                 if client.is_connected:
                     print("Connected to the saved device.")
 
@@ -238,7 +221,9 @@ async def connect_device(profile):
 
     # If no device is saved, begin scanning for devices
     print("Searching for devices...")
-    devices = await BleakScanner.discover()
+    devices = await ble_scan.discover()
+    # Anything advertising the fitness machine service goes at the top of the list
+    devices.sort(key=lambda d: not ble_scan.advertises(d.address, ble_scan.FTMS_SERVICE))
 
     # If there are no devices found nearby, print a message to the user
     if not devices:
@@ -255,7 +240,7 @@ async def connect_device(profile):
         selected_device = devices[device_index]
 
         # Attempt to connect to the selected device
-        async with BleakClient(selected_device.address) as client:
+        async with BleakClient(selected_device) as client:
             if client.is_connected:
                 print("Connected to the selected device.")
 
@@ -314,8 +299,21 @@ async def establish_connection(profile):
 
 # Main loop of program
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set up a rider profile and devices")
+    parser.add_argument("--rider", default=rider, help="rider profile to set up, for more than one rider per file")
+    args = parser.parse_args()
+    rider = args.rider
+    store = get_store(user_profile)
+    if (rider or store.active) not in store.names():
+        # The one place new riders get made
+        print(f"Setting up a new rider profile: {rider or store.active}")
+        store.create(rider or store.active)
+    if rider:
+        store.select(rider)
+
     profile = username_init()
     difficulty_init(profile)
     weight_init(profile)
     asyncio.run(connect_device(profile))    # trainer
     asyncio.run(connect_hrm(profile))       # hrm
+    get_store(user_profile).flush()
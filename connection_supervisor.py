@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+'''
+Connection supervisor. If the trainer or HRM dropped out mid ride nothing noticed, the loop just kept showing the last
+values it had, and the only fix was restarting the script, which threw away the timers too.
+
+Each client gets a disconnect callback. When one fires, the live values from that device get cleared (so the moving
+timer stops and the stats don't fill up with stale numbers), and a reconnect task starts retrying with exponential
+backoff, capped at max_delay. Once it's back, the setup for that device (notifications, control point) gets run again,
+along with any on_reconnect hooks, e.g. the trainer controller re-requesting control and re-sending its target.
+Nothing else gets reset, so the session timers, stats and resistance target all carry on.
+
+How long each reconnect took gets kept in reconnects, and the latest one goes in debug_data.
+'''
+
+# Values each device provides, cleared when it drops out
+device_values = {
+    "trainer": ("power", "cadence"),
+    "hrm": ("heart_rate",),
+}
+
+
+class ConnectionSupervisor:
+    def __init__(self, shared_data, debug_data, base_delay=1.0, max_delay=30.0, debug=False, name=None, log=None):
+        self.name = name  # Goes in front of the messages, for telling riders apart when there's more than one
+        self.shared_data = shared_data
+        self.debug_data = debug_data
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.debug = debug
+        self.log = log or print  # Where the messages go. main() points it at the dashboard's status line if there is one
+
+        self.clients = {}  # device type -> client
+        self.setups = {}  # device type -> async fn(client), run again after a reconnect
+        self.hooks = {}  # device type -> list of fns(client) run after the setup
+        self.reconnects = []  # {"device", "latency", "attempts"} for every reconnect
+        self.connected = {}
+
+        self._loop = None
+        self._tasks = {}
+        self._stopping = False
+
+    # Callback to hand to BleakClient(disconnected_callback=...). Bleak can call it from another thread, so it just
+    # hands over to the loop.
+    def disconnect_callback(self, device_type):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+        def callback(client):
+            lost_at = time.monotonic()
+            self._loop.call_soon_threadsafe(self._on_disconnect, device_type, client, lost_at)
+
+        return callback
+
+    def watch(self, device_type, client, setup=None):
+        self.clients[device_type] = client
+        self.connected[device_type] = True
+        if setup is not None:
+            self.setups[device_type] = setup
+
+    def on_reconnect(self, device_type, hook):
+        self.hooks.setdefault(device_type, []).append(hook)
+
+    # Called before disconnecting on purpose, so the disconnects don't get treated as dropouts
+    def stop(self):
+        self._stopping = True
+        for task in self._tasks.values():
+            task.cancel()
+
+    def _label(self, device_type):
+        return f"{self.name} {device_type}" if self.name else device_type
+
+    def _on_disconnect(self, device_type, client, lost_at):
+        if self._stopping or device_type in self._tasks:
+            return
+        self.log(f"\n{self._label(device_type)} disconnected, reconnecting...")
+        self.connected[device_type] = False
+        for key in device_values.get(device_type, ()):
+            self.shared_data[key] = None
+        self._tasks[device_type] = asyncio.create_task(self._reconnect(device_type, client, lost_at))
+
+    async def _reconnect(self, device_type, client, lost_at):
+        delay = self.base_delay
+        attempts = 0
+        try:
+            while not self._stopping:
+                attempts += 1
+                try:
+                    if not client.is_connected:
+                        await client.connect()
+                    setup = self.setups.get(device_type)
+                    if setup is not None:
+                        await setup(client)
+                    for hook in self.hooks.get(device_type, []):
+                        result = hook(client)
+                        if asyncio.iscoroutine(result):
+                            await result
+                    break
+                except Exception as e:
+                    if self.debug:
+                        self.log(f"Reconnect to {self._label(device_type)} failed (attempt {attempts}), retrying in {delay:.0f}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_delay)
+            else:
+                return
+
+            latency = time.monotonic() - lost_at
+            self.connected[device_type] = True
+            self.reconnects.append({"device": device_type, "latency": latency, "attempts": attempts})
+            self.debug_data["reconnect_latency"] = latency
+            self.debug_data["reconnects"] = len(self.reconnects)
+            self.log(f"\n{self._label(device_type)} reconnected after {latency:.1f}s")
+        finally:
+            self._tasks.pop(device_type, None)
@@ -0,0 +1,229 @@
+import bisect
+import csv
+import json
+import math
+import os
+import xml.etree.ElementTree as ET
+from array import array
+
+'''
+Courses. Loads a route's elevation profile from a GPX, CSV or JSON file, and works out the cumulative distance and the
+gradient and trainer resistance for every segment up front. During the ride the current segment gets looked up from
+the virtual distance. Distance only goes forwards a little bit each tick, so the lookup just walks on from the last
+segment it found (amortised O(1)), and falls back to a binary search if it has jumped.
+
+GPS and elevation data is noisy, and with points only a metre or two apart a half metre wobble in the elevation is a
+25% or 50% gradient, which would pin the resistance at one end or the other. So the elevations get smoothed with a
+moving average over smoothing metres, the points get thinned out so no segment is shorter than min_segment metres, and
+what's left gets clamped to max_gradient either way.
+
+Supported files:
+    .gpx  - trkpt or rtept points, with lat/lon and an ele tag
+    .csv  - a header row, with either distance and elevation columns (metres), or lat, lon and elevation/ele
+    .json - a list of points (or {"points": [...]}) with the same keys as the csv
+'''
+
+earth_radius = 6371000.0  # m
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * math.asin(math.sqrt(a))
+
+
+# Resistance for a gradient. Works like zwift's trainer difficulty: at 50% difficulty you feel half the gradient.
+# Descents take resistance off the baseline, climbs add to it.
+def gradient_to_resistance(gradient, base_resistance=20, difficulty=50, per_percent=4.0):
+    effective = gradient * difficulty / 100
+    return max(0.0, min(100.0, base_resistance + effective * per_percent))
+
+
+# Reading the files. These all give back (distances, elevations, coords). Files with lat/lon points leave distances
+# empty and fill in coords, for the distances to be measured from.
+def _points_from_rows(rows):
+    distances = array("d")
+    elevations = array("d")
+    coords = []
+    for row in rows:
+        row = {str(key).strip().lower(): value for key, value in row.items()}
+        elevation = row.get("elevation", row.get("ele", row.get("altitude")))
+        if elevation in (None, ""):
+            continue
+        elevations.append(float(elevation))
+        if row.get("distance") not in (None, ""):
+            distances.append(float(row["distance"]))
+        else:
+            coords.append((float(row["lat"]), float(row["lon"])))
+    return distances, elevations, coords
+
+
+def _load_gpx(file_name):
+    elevations = array("d")
+    coords = []
+    # iterparse so a 100k point file never has to sit in memory as a tree. By the end of a point its ele tag has
+    # been parsed too, so only the end events are needed.
+    for event, element in ET.iterparse(file_name, events=("end",)):
+        tag = element.tag
+        if tag.endswith("trkpt") or tag.endswith("rtept"):
+            for child in element:
+                if child.tag.endswith("ele"):
+                    coords.append((float(element.get("lat")), float(element.get("lon"))))
+                    elevations.append(float(child.text))
+                    break
+            element.clear()
+    return array("d"), elevations, coords
+
+
+def _load_csv(file_name):
+    with open(file_name, "r", newline="") as f:
+        return _points_from_rows(csv.DictReader(f))
+
+
+def _load_json(file_name):
+    with open(file_name, "r") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("points", [])
+    return _points_from_rows(data)
+
+
+# Average of the elevations within window / 2 metres either side of each point. Running sums, and the two ends of the
+# window only ever move forwards, so it's one pass however long the route is.
+def smooth_elevations(distances, elevations, window):
+    count = len(elevations)
+    if window <= 0 or count < 3:
+        return array("d", elevations)
+    half = window / 2
+    sums = array("d", [0.0])
+    for elevation in elevations:
+        sums.append(sums[-1] + elevation)
+    smoothed = array("d")
+    low = high = 0
+    for i in range(count):
+        while distances[low] < distances[i] - half:
+            low += 1
+        while high + 1 < count and distances[high + 1] <= distances[i] + half:
+            high += 1
+        smoothed.append((sums[high + 1] - sums[low]) / (high + 1 - low))
+    return smoothed
+
+
+class Course:
+    def __init__(self, distances, elevations, base_resistance=20, difficulty=50, loop=False, name=None,
+                 min_segment=20.0, smoothing=50.0, max_gradient=25.0):
+        self.name = name
+        self.loop = loop
+        self.base_resistance = base_resistance
+        self.difficulty = difficulty
+        self.distances = array("d")
+        self.elevations = array("d")
+        self.gradients = array("d")  # Percent, one per segment, segment i runs from point i to point i + 1
+        self.resistances = array("d")
+        self._index = 0
+
+        # Drop any points that don't move forwards, they'd give infinite gradients
+        points_distance = array("d")
+        points_elevation = array("d")
+        for distance, elevation in zip(distances, elevations):
+            if points_distance and distance <= points_distance[-1]:
+                continue
+            points_distance.append(distance)
+            points_elevation.append(elevation)
+        points_elevation = smooth_elevations(points_distance, points_elevation, smoothing)
+
+        # Thin the points out to at least min_segment apart. The last point is always kept, so the course is the full
+        # length, and if that leaves the last segment short it takes the place of the point before it.
+        last = len(points_distance) - 1
+        for i, (distance, elevation) in enumerate(zip(points_distance, points_elevation)):
+            if self.distances and distance - self.distances[-1] < min_segment:
+                if i < last:
+                    continue
+                if len(self.distances) > 1:
+                    self.distances.pop()
+                    self.elevations.pop()
+            self.distances.append(distance)
+            self.elevations.append(elevation)
+
+        for i in range(len(self.distances) - 1):
+            rise = self.elevations[i + 1] - self.elevations[i]
+            run = self.distances[i + 1] - self.distances[i]
+            gradient = max(-max_gradient, min(max_gradient, rise / run * 100))
+            self.gradients.append(gradient)
+            self.resistances.append(gradient_to_resistance(gradient, base_resistance, difficulty))
+        if not self.gradients:
+            # Single point course, flat
+            self.gradients.append(0.0)
+            self.resistances.append(gradient_to_resistance(0.0, base_resistance, difficulty))
+
+    @property
+    def length(self):
+        return self.distances[-1] - self.distances[0] if len(self.distances) > 1 else 0.0
+
+    # Segment index for a distance along the course
+    def _segment(self, distance):
+        last = len(self.gradients) - 1
+        i = self._index
+        # Usually we're still in the same segment or just into the next one
+        if self.distances[i] <= distance:
+            while i < last and self.distances[i + 1] <= distance:
+                i += 1
+                if i - self._index > 8:
+                    # Jumped a long way, binary search instead
+                    i = min(last, max(0, bisect.bisect_right(self.distances, distance) - 1))
+                    break
+        else:
+            i = min(last, max(0, bisect.bisect_right(self.distances, distance) - 1))
+        self._index = i
+        return i
+
+    # (gradient %, resistance) at a distance in metres from the start
+    def lookup(self, distance):
+        position = self.distances[0] + distance
+        if self.loop and self.length > 0:
+            position = self.distances[0] + distance % self.length
+        i = self._segment(position)
+        return self.gradients[i], self.resistances[i]
+
+    # How far along the course a distance is, 0 to 1
+    def progress(self, distance):
+        if self.length <= 0:
+            return 1.0
+        if self.loop:
+            return (distance % self.length) / self.length
+        return min(1.0, distance / self.length)
+
+
+def load_course(file_name, base_resistance=20, difficulty=50, loop=False):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".gpx":
+        distances, elevations, coords = _load_gpx(file_name)
+    elif extension == ".csv":
+        distances, elevations, coords = _load_csv(file_name)
+    elif extension == ".json":
+        distances, elevations, coords = _load_json(file_name)
+    else:
+        raise ValueError(f"Unsupported course file: {file_name}")
+
+    if coords:
+        # Build the cumulative distance from the lat/lon points. Same sum as haversine(), inlined with the radians
+        # and cosines worked out once per point, as this is most of the load time on a long route.
+        distances = array("d", [0.0])
+        radians = math.radians
+        sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+        lat1, lon1 = radians(coords[0][0]), radians(coords[0][1])
+        cos1 = cos(lat1)
+        total = 0.0
+        for lat, lon in coords[1:]:
+            lat2, lon2 = radians(lat), radians(lon)
+            cos2 = cos(lat2)
+            a = sin((lat2 - lat1) / 2) ** 2 + cos1 * cos2 * sin((lon2 - lon1) / 2) ** 2
+            total += 2 * earth_radius * asin(sqrt(a))
+            distances.append(total)
+            lat1, lon1, cos1 = lat2, lon2, cos2
+
+    if not elevations:
+        raise ValueError(f"No elevation points found in {file_name}")
+
+    return Course(distances, elevations, base_resistance, difficulty, loop,
+                  name=os.path.splitext(os.path.basename(file_name))[0])
@@ -0,0 +1,178 @@
+import shutil
+import sys
+import time
+
+'''
+Terminal dashboard. print_data() joins every key into one long line and rewrites it every tick, which wraps and turns
+into a mess on anything narrower than a very wide terminal, and formats 20+ floats every 100ms whether they changed or
+not.
+
+This draws a fixed layout once, then each redraw only writes the fields whose displayed text has changed, straight to
+their spot on screen with cursor positioning. Each field has a fixed width, so nothing shifts about. How often it
+redraws is set separately from how often samples come in. The debug values sit in their own pane underneath, which can
+be switched on and off (press d, if keys are enabled). Other keys can be bound with bind(), e.g. for the workout.
+
+Anything printed while the dashboard is up scrolls the screen under it, and the diff based redraw never puts it back.
+So messages (reconnects, trainer targets and so on) go to message() instead, which shows the newest one on a status
+line under the title.
+'''
+
+# (key, label, format, unit) for each cell, one list per row
+main_layout = [
+    [("power", "Power", "{:.0f}", "W"), ("cadence", "Cadence", "{:.0f}", "rpm"), ("heart_rate", "HR", "{:.0f}", "bpm")],
+    [("velocity", "Speed", "{:.1f}", "km/h"), ("distance", "Distance", "{:.2f}", "km"), ("wkg", "W/kg", "{:.2f}", "")],
+    [("elapsed_timer", "Moving", "{}", ""), ("total_timer", "Total", "{}", ""), ("gradient_pct", "Gradient", "{:.1f}", "%")],
+    [("current_resistance", "Resistance", "{:.0f}", "%"), ("d_resistance", "Target", "{:.0f}", "%"),
+     ("weight", "Weight", "{:.1f}", "kg")],
+    [("workout_step", "Workout", "{}", ""), ("workout_left", "Step left", "{}", ""),
+     ("erg_target", "ERG", "{:.0f}", "W")],
+]
+
+# Anything in here gets scaled before it's shown
+scales = {"distance": 0.001}
+
+cell_width = 26
+label_width = 11
+
+
+class TerminalDashboard:
+    def __init__(self, stream=None, rate=4, show_debug=False, title="Trainer Data"):
+        self.stream = stream or sys.stdout
+        self.interval = 1.0 / rate if rate else 0.0
+        self.show_debug = show_debug
+        self.title = title
+
+        self._drawn = {}  # (row, col) -> text last written there
+        self._debug_slots = {}  # debug key -> (row, col), fixed once a key has a slot
+        self._needs_layout = True
+        self._last_render = 0.0
+        self._debug_top = 3 + len(main_layout) * 2
+        self._bottom = self._debug_top
+        self._stdin_fd = None
+        self._old_terminal = None
+        self._keys = {}  # key -> (fn, label), on top of d
+        self._message = ""
+        self.redraws = 0
+        self.cells_written = 0
+
+    # Run fn when key is pressed. Bind before the first render, so the label makes it into the title line.
+    def bind(self, key, fn, label=None):
+        self._keys[key] = (fn, label)
+        self._needs_layout = True
+
+    # Show a message on the status line, in place of printing it. Goes up on the next redraw.
+    def message(self, text):
+        self._message = " ".join(str(text).split())
+
+    def toggle_debug(self):
+        self.show_debug = not self.show_debug
+        self._needs_layout = True
+
+    # Full clear and draw the labels. Only happens at the start and when the debug pane is switched
+    def _layout(self, out):
+        out.append("\x1b[?25l\x1b[2J\x1b[H")  # Hide the cursor and clear the screen
+        hints = "".join(f", {key}: {label}" for key, (fn, label) in self._keys.items() if label)
+        out.append(f"\x1b[1;1H{self.title}  (d: debug pane{hints})")
+        for row_index, row in enumerate(main_layout):
+            for col_index, (key, label, fmt, unit) in enumerate(row):
+                out.append(f"\x1b[{3 + row_index * 2};{1 + col_index * cell_width}H{label}")
+        if self.show_debug:
+            out.append(f"\x1b[{self._debug_top};1H-- debug --")
+        self._drawn.clear()
+        self._debug_slots.clear()
+        self._needs_layout = False
+
+    @staticmethod
+    def _format(value, fmt, unit, key=None):
+        if value is None:
+            return "--"
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = value * scales.get(key, 1)
+            text = fmt.format(value) if fmt != "{}" else f"{value:.2f}"
+        else:
+            text = str(value)
+        return f"{text} {unit}".rstrip()
+
+    # Writes text at a spot if it's different to what's already there
+    def _put(self, out, row, col, text, width):
+        text = text[:width].ljust(width)
+        if self._drawn.get((row, col)) != text:
+            self._drawn[(row, col)] = text
+            out.append(f"\x1b[{row};{col}H{text}")
+            self.cells_written += 1
+
+    # Redraw whatever has changed. Returns straight away if the last redraw was less than 1/rate ago, unless forced.
+    def render(self, shared_data, debug_data=None, now=None, force=False):
+        now = time.monotonic() if now is None else now
+        if not force and not self._needs_layout and now - self._last_render < self.interval:
+            return False
+        self._last_render = now
+        self.redraws += 1
+
+        out = []
+        if self._needs_layout:
+            self._layout(out)
+
+        self._put(out, 2, 1, self._message, max(1, shutil.get_terminal_size((80, 24)).columns - 1))
+
+        value_width = cell_width - label_width - 1
+        for row_index, row in enumerate(main_layout):
+            for col_index, (key, label, fmt, unit) in enumerate(row):
+                text = self._format(shared_data.get(key), fmt, unit, key)
+                self._put(out, 3 + row_index * 2, 1 + col_index * cell_width + label_width, text, value_width)
+
+        bottom = self._debug_top
+        if self.show_debug and debug_data:
+            columns = max(1, shutil.get_terminal_size((80, 24)).columns // cell_width)
+            for key, value in debug_data.items():
+                slot = self._debug_slots.get(key)
+                if slot is None:
+                    index = len(self._debug_slots)
+                    slot = self._debug_slots[key] = (self._debug_top + 1 + index // columns,
+                                                     1 + (index % columns) * cell_width)
+                text = f"{key[:label_width - 1]:<{label_width}}{self._format(value, '{:.2f}', '')}"
+                self._put(out, slot[0], slot[1], text, cell_width - 1)
+                bottom = max(bottom, slot[0])
+        self._bottom = bottom
+
+        if out:
+            # Park the cursor under everything, so anything else that gets printed doesn't land in the middle
+            out.append(f"\x1b[{self._bottom + 2};1H")
+            self.stream.write("".join(out))
+            self.stream.flush()
+        return True
+
+    # Switch the debug pane with the d key, and run anything bound with bind(). Only on terminals that support it (not
+    # windows), otherwise it just stays as it was set.
+    def enable_keys(self, loop):
+        try:
+            import termios
+            import tty
+        except ImportError:
+            return False
+        if not sys.stdin.isatty():
+            return False
+        self._stdin_fd = sys.stdin.fileno()
+        self._old_terminal = termios.tcgetattr(self._stdin_fd)
+        tty.setcbreak(self._stdin_fd)
+
+        def on_key():
+            key = sys.stdin.read(1)
+            if key in ("d", "D"):
+                self.toggle_debug()
+            elif key in self._keys:
+                self._keys[key][0]()
+
+        loop.add_reader(self._stdin_fd, on_key)
+        return True
+
+    # Put the terminal back how it was
+    def close(self, loop=None):
+        if self._stdin_fd is not None:
+            import termios
+            if loop is not None:
+                loop.remove_reader(self._stdin_fd)
+            termios.tcsetattr(self._stdin_fd, termios.TCSADRAIN, self._old_terminal)
+            self._stdin_fd = None
+        self.stream.write(f"\x1b[{self._bottom + 2};1H\x1b[?25h")
+        self.stream.flush()
@@ -0,0 +1,278 @@
+import argparse
+import math
+import sys
+
+'''
+ERG mode. Holds a target power whatever the cadence, by adjusting the trainer.
+
+If the trainer can take a target power itself (FTMS power target setting, from the capabilities), the target just gets
+handed to it and the trainer does its own ERG, which is quicker than anything we can do over bluetooth. Otherwise
+it's done here, with resistance commands:
+
+    level = model(target * gain + Kp * error, cadence)
+
+The model is a rough guess at the power a resistance level gives at a cadence (power is about proportional to
+cadence at a fixed level). It does most of the work, so a cadence change gets corrected straight away rather than
+waiting for the error to build up. The PI part takes care of whatever the model gets wrong. The integral term is a
+gain on the model's level rather than a fixed number of watts, as a model that's wrong is usually wrong by a
+proportion (a trainer that's 20% harder per level than the model is 20% harder at 150 W and at 300 W), so what it learns
+on one target still holds on the next. It only integrates once the power is near the target (so it doesn't pile up
+while the trainer is still catching up with a step), and not while the output is pinned at the top or bottom of the
+range, so it can't wind up while the rider is spun out.
+
+The gain starts off unknown, and finding it out on the first target with the integral alone means a big overshoot if
+the model is too easy. So for the first target it aims short, at first_aim of it, and holds the model's level there
+until the power steadies. The gain is then worked out straight from the level and the power it gave, and it goes for
+the whole target from there.
+
+The power feeding it is lightly smoothed, the output level can only move so far per second, and changes smaller than
+min_step aren't sent, so the trainer isn't asked for more than it can take. The commands go through the
+TrainerController, which sends only the newest one and spaces them out.
+
+Self check against the simulated trainer ("rider" profile), on simulated time:
+    python erg.py --check
+'''
+
+
+class ErgController:
+    def __init__(self, trainer_controller, capabilities=None, mode="auto", kp=0.5, ki=0.3, integral_band=0.2,
+                 smoothing=0.5, base_watts=20.0, watts_per_level=3.5, reference_cadence=90.0, max_slew=25.0,
+                 min_step=0.5, min_cadence=20.0, first_aim=0.8, steady_rate=0.02, learn_limit=10.0):
+        self.trainer = trainer_controller
+        self.target = None
+
+        target_features = (capabilities or {}).get("target_setting_features", {})
+        if mode == "auto":
+            mode = "power" if target_features.get("power_target_setting_supported") else "resistance"
+        self.mode = mode  # "power" hands the target to the trainer, "resistance" runs the loop here
+
+        self.kp = kp
+        self.ki = ki  # Per second
+        self.integral_band = integral_band  # Only integrate within this fraction of the target
+        self.smoothing = smoothing  # Time constant of the power smoothing, seconds
+        self.base_watts = base_watts  # Model: watts = (base_watts + watts_per_level * level) * cadence / reference
+        self.watts_per_level = watts_per_level
+        self.reference_cadence = reference_cadence
+        self.max_slew = max_slew  # Most the level can move in a second
+        self.min_step = min_step  # Smallest level change worth sending
+        self.min_cadence = min_cadence  # Below this the rider has basically stopped, so the loop holds still
+        self.first_aim = first_aim  # Fraction of the first target to aim for while the gain isn't known
+        self.steady_rate = steady_rate  # Power is steady once it moves less than this fraction of the target a second
+        self.learn_limit = learn_limit  # Seconds to wait for that before leaving the gain to the integral
+
+        self.level = None
+        self.gain = 1.0  # The integral, as a correction to the model's level
+        self.learned = False
+        self._learn_start = None
+        self._check = None  # (time, smoothed power) the steadiness is measured from
+        self.power = None  # Smoothed
+        self.last_time = None
+        self.sent_level = None
+        self.commands = 0
+
+    def set_target(self, watts):
+        self.target = watts
+        if self.mode == "power" and watts is not None:
+            self.trainer.set_target_power(watts)
+            self.commands += 1
+
+    # The resistance level the model thinks gives `watts` at `cadence`
+    def _model_level(self, watts, cadence):
+        return (watts * self.reference_cadence / cadence - self.base_watts) / self.watts_per_level
+
+    # Feed it the latest power and cadence. Call it regularly (a few times a second), now is any monotonic clock.
+    def update(self, power, cadence, now):
+        if self.target is None or self.mode != "resistance":
+            return None
+        dt = 0.0 if self.last_time is None else max(0.0, now - self.last_time)
+        self.last_time = now
+        low, high = self.trainer.resistance_range
+
+        if power is None or cadence is None or cadence < self.min_cadence:
+            # Not pedalling. Hold the level where it is, and don't let the error build up
+            return self.level
+
+        if self.power is None or not self.smoothing:
+            self.power = power
+        else:
+            self.power += (power - self.power) * (1 - math.exp(-dt / self.smoothing))
+
+        if not self.learned:
+            self._learn(cadence, now, low, high)
+        if self.learned:
+            error = self.target - self.power
+            level = self._model_level(self.target + self.kp * error, cadence) * self.gain
+
+            # Anti windup. Only integrate if it wouldn't push further into a limit that's already reached
+            saturated = (level >= high and error > 0) or (level <= low and error < 0)
+            if not saturated and self.target > 0 and abs(error) <= self.integral_band * self.target:
+                self.gain = max(0.25, min(4.0, self.gain + self.ki * error / self.target * dt))
+                level = self._model_level(self.target + self.kp * error, cadence) * self.gain
+        else:
+            level = self._model_level(self.target * self.first_aim, cadence) * self.gain
+
+        level = max(low, min(high, level))
+        if self.level is not None and dt:
+            step = self.max_slew * dt
+            level = max(self.level - step, min(self.level + step, level))
+        self.level = level
+
+        if self.sent_level is None or abs(level - self.sent_level) >= self.min_step:
+            self.sent_level = round(level, 1)
+            self.trainer.set_resistance(self.sent_level)
+            self.commands += 1
+        return level
+
+    # First target only. Once the power has held steady for a second, the gain is whatever makes the model's level for
+    # that power come out at the level the trainer is on. Not if the level is pinned at a limit, as the power there
+    # doesn't say how far out the model is.
+    def _learn(self, cadence, now, low, high):
+        if self._learn_start is None:
+            self._learn_start = now
+            self._check = (now, self.power)
+            return
+        since, power = self._check
+        if now - since < 1.0:
+            return
+        if abs(self.power - power) <= self.steady_rate * self.target * (now - since):
+            model_level = self._model_level(self.power, cadence)
+            if self.sent_level is not None and low < self.sent_level < high and model_level > 0:
+                self.gain = max(0.25, min(4.0, self.sent_level / model_level))
+            self.learned = True
+        elif now - self._learn_start >= self.learn_limit:
+            self.learned = True  # Never steadied, the integral will have to find it
+        self._check = (now, self.power)
+
+    # Something else is driving the trainer for a while (a workout resistance step, or free riding). The next
+    # set_target gets sent again even if it's the same watts, and the first update after doesn't count the time away.
+    def release(self):
+        self.target = None
+        self.last_time = None
+        self.sent_level = None
+
+    def reset(self):
+        self.gain = 1.0
+        self.learned = False
+        self._learn_start = None
+        self.power = None
+        self.last_time = None
+
+
+# Stands in for the TrainerController in the self check, on simulated time: only the newest target is kept, commands
+# go at most every min_interval, and each one gets to the trainer response_delay after it's sent.
+class _CheckController:
+    def __init__(self, trainer, resistance_range=(0, 100), min_interval=0.25, response_delay=0.05):
+        self.trainer = trainer
+        self.resistance_range = resistance_range
+        self.min_interval = min_interval
+        self.response_delay = response_delay
+        self.targets_coalesced = 0
+        self._pending = None
+        self._in_flight = None  # (arrives, target)
+        self._last_command = None
+
+    def set_resistance(self, level):
+        low, high = self.resistance_range
+        self._queue(("resistance", max(low, min(high, level))))
+
+    def set_target_power(self, watts):
+        self._queue(("power", watts))
+
+    def _queue(self, target):
+        if self._pending is not None:
+            self.targets_coalesced += 1
+        self._pending = target
+
+    def advance(self, now):
+        if self._in_flight is not None and now >= self._in_flight[0]:
+            kind, value = self._in_flight[1]
+            self._in_flight = None
+            if kind == "resistance":
+                self.trainer.resistance = value
+                self.trainer.target_power = None
+            else:
+                self.trainer.target_power = value
+        if self._pending is not None and self._in_flight is None and \
+                (self._last_command is None or now - self._last_command >= self.min_interval):
+            self._in_flight = (now + self.response_delay, self._pending)
+            self._pending = None
+            self._last_command = now
+
+
+# Self check against the simulated trainer. Steps the target about with the model deliberately 25% out, too easy and
+# then too hard, and checks the power settles close to the target quickly and without swinging about. The first step
+# gets longer, as that's where the controller finds out how wrong the model is.
+#
+# It runs on simulated time, stepped here rather than slept, so it comes out the same however busy the machine is. At
+# the moment the later steps settle within 3.0s with up to 3.3% overshoot, and the first in 4.2 to 6.3s with up to
+# 2.7%, which leaves a good margin under the limits.
+def self_check(rate=4.0, tolerance=0.05, settle_limit=4.0, overshoot_limit=0.05, first_settle_limit=8.0,
+               first_overshoot_limit=0.05, mode="resistance", watts_per_level=(2.8, 4.4), verbose=True, tick=0.01):
+    from sim_devices import SimClock, SimulatedTrainer, make_profile
+
+    steps = [(0, 150), (30, 250), (60, 180), (90, 300), (120, 120)]
+    sample_ticks = 10  # Ticks between trainer notifications, 10 a second
+    update_ticks = int(round(1.0 / rate / tick))
+    results = []
+    passed = True
+    for model in watts_per_level:
+        trainer = SimulatedTrainer(make_profile("rider", cadence=90), SimClock(), rate=10)
+        controller = _CheckController(trainer)
+        capabilities = {"target_setting_features": {"power_target_setting_supported": mode == "power"}}
+        erg = ErgController(controller, capabilities, watts_per_level=model)
+        if verbose:
+            print(f" Model at {model:g} W a level, the simulated trainer is 3.5")
+
+        samples = []
+        count = 0
+        for index, (start, target) in enumerate(steps):
+            end = steps[index + 1][0] if index + 1 < len(steps) else start + 30
+            erg.set_target(target)
+            first = len(samples)
+            while count * tick < end:
+                now = count * tick
+                controller.advance(now)
+                if count % sample_ticks == 0:
+                    data = trainer.sample(now)
+                    samples.append((now, data.instant_power, data.instant_cadence))
+                if count % update_ticks == 0 and samples:
+                    _, power, cadence = samples[-1]
+                    erg.update(power, cadence, now)
+                count += 1
+
+            # Settled once the power stays within tolerance for the rest of the step
+            window = [(t - start, power) for t, power, _ in samples[first:]]
+            settled = None
+            for t, power in reversed(window):
+                if abs(power - target) > tolerance * target:
+                    break
+                settled = t
+            previous = steps[index - 1][1] if index else 0
+            direction = 1 if target >= previous else -1
+            overshoot = max([(power - target) * direction for _, power in window] + [0]) / target
+            ok = (settled is not None and settled <= (first_settle_limit if index == 0 else settle_limit)
+                  and overshoot <= (first_overshoot_limit if index == 0 else overshoot_limit))
+            passed = passed and ok
+            results.append((model, target, settled, overshoot, ok))
+            if verbose:
+                settle_text = f"{settled:.1f}s" if settled is not None else "never"
+                print(f"  {previous:>3} -> {target:>3} W: settled in {settle_text}, overshoot {overshoot:.1%}"
+                      f"{'' if ok else '  FAIL'}")
+        if verbose:
+            print(f"  {erg.commands} commands sent, {controller.targets_coalesced} coalesced")
+    if verbose:
+        print("Passed" if passed else "Failed")
+    return passed, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ERG mode")
+    parser.add_argument("--check", action="store_true", help="run the self check against the simulated trainer")
+    parser.add_argument("--mode", choices=["resistance", "power"], default="resistance")
+    args = parser.parse_args()
+
+    if args.check:
+        print(f"ERG self check, {args.mode} mode")
+        ok, _ = self_check(mode=args.mode)
+        sys.exit(0 if ok else 1)
+    parser.print_help()
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from pycycling.fitness_machine_service import FitnessMachineService
+
+'''
+FTMS capability cache. check_ftms_power_support() and query_ftms_features() both read the feature characteristic over
+bluetooth every time, and all that got kept was three booleans in the profile.
+
+This keeps the full fitness machine and target setting feature sets, plus the supported resistance and power ranges,
+in a small json file keyed by device address and firmware revision. A firmware update can change what the trainer
+supports, so a new firmware gets queried fresh. Later sessions only need the one firmware read to find their entry.
+
+The resistance range is what the trainer controller clamps to, instead of a hard coded 0-100. The trainer gives it in
+0.1 steps (as the FTMS spec has it), and it's kept as read in the cache, so resistance_limits() turns it into the
+levels the controller sends, and keeps it to 0-255 as set_target_resistance_level sends a single byte.
+
+    python ftms_capabilities.py --check
+'''
+
+FIRMWARE_REVISION = "00002a26-0000-1000-8000-00805f9b34fb"
+
+cache_file = "device_capabilities.json"
+
+resistance_steps = 10  # Steps of the supported resistance range in one level, as FTMS gives it in 0.1s
+max_resistance_level = 255  # Most the resistance target's one byte can hold
+
+
+# pycycling hands back namedtuples, turn them into plain dicts for the json
+def _features_dict(features):
+    if features is None:
+        return {}
+    if hasattr(features, "_asdict"):
+        return {field: bool(value) for field, value in features._asdict().items()}
+    return {field: bool(value) for field, value in vars(features).items()}
+
+
+# Ranges come back as (minimum, maximum, increment), in that order, as in the FTMS spec
+def _range_dict(supported_range):
+    if supported_range is None:
+        return None
+    minimum, maximum, increment = tuple(supported_range)[:3]
+    return {"min": minimum, "max": maximum, "increment": increment}
+
+
+async def read_firmware(client):
+    try:
+        value = await client.read_gatt_char(FIRMWARE_REVISION)
+        return bytes(value).decode("utf-8", errors="replace").strip("\x00 ").strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+
+# Reads everything off the trainer. The range reads are optional, not every trainer has them.
+async def query_capabilities(ftms):
+    features, target_features = await ftms.get_fitness_machine_feature()
+    capabilities = {
+        "fitness_machine_features": _features_dict(features),
+        "target_setting_features": _features_dict(target_features),
+        "resistance_range": None,
+        "power_range": None,
+    }
+    if capabilities["target_setting_features"].get("resistance_target_setting_supported"):
+        try:
+            capabilities["resistance_range"] = _range_dict(await ftms.get_supported_resistance_level_range())
+        except Exception as e:
+            print(f"Error reading supported resistance range: {e}")
+    if capabilities["target_setting_features"].get("power_target_setting_supported"):
+        try:
+            capabilities["power_range"] = _range_dict(await ftms.get_supported_power_range())
+        except Exception as e:
+            print(f"Error reading supported power range: {e}")
+    return capabilities
+
+
+class CapabilityCache:
+    def __init__(self, file_name=cache_file):
+        self.file_name = file_name
+        self.entries = {}
+        if os.path.exists(file_name):
+            with open(file_name, "r") as f:
+                try:
+                    self.entries = json.load(f)
+                except json.JSONDecodeError:
+                    self.entries = {}
+
+    @staticmethod
+    def key(address, firmware):
+        return f"{(address or '').upper()}|{firmware}"
+
+    def get(self, address, firmware):
+        return self.entries.get(self.key(address, firmware))
+
+    def put(self, address, firmware, capabilities):
+        self.entries[self.key(address, firmware)] = capabilities
+        temp_file = self.file_name + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.replace(temp_file, self.file_name)
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = CapabilityCache()
+    return _cache
+
+
+# Capabilities for a connected trainer, from the cache if we've seen this device and firmware before. ftms can be
+# passed in if there's already a service for the client, otherwise one gets made. Simulated trainers (sim_devices.py)
+# are always asked and never cached, so they don't end up in the file next to the real ones.
+async def get_capabilities(client, ftms=None, refresh=False, cache=None):
+    simulated = getattr(client, "simulated", False)
+    if not simulated:
+        cache = cache or get_cache()
+    address = getattr(client, "address", None)
+    firmware = await read_firmware(client)
+
+    capabilities = None if refresh or simulated else cache.get(address, firmware)
+    if capabilities is None:
+        if ftms is None:
+            ftms = FitnessMachineService(client)
+        capabilities = await query_capabilities(ftms)
+        capabilities["address"] = address
+        capabilities["firmware"] = firmware
+        if not simulated:
+            cache.put(address, firmware, capabilities)
+    return capabilities
+
+
+# (min, max) to clamp resistance targets to, in the levels the controller sends, falling back to 0-100 if the trainer
+# didn't say or what it said makes no sense
+def resistance_limits(capabilities):
+    supported_range = (capabilities or {}).get("resistance_range")
+    if not supported_range:
+        return 0, 100
+    low, high = (max(0, min(max_resistance_level, supported_range[end] / resistance_steps))
+                 for end in ("min", "max"))
+    if high <= low:
+        return 0, 100
+    return low, high
+
+
+# Ranges as trainers report them, and the limits they should come out as. The last one goes past what fits in a byte.
+# Then that simulated trainers stay out of the cache.
+def self_check():
+    from sim_devices import SimClock, SimulatedTrainer, SupportedResistanceLevelRange, make_profile
+    from trainer_control import TrainerController
+
+    cases = [(None, (0, 100)), ((0, 1000, 10), (0, 100)), ((50, 200, 1), (5, 20)), ((0, 0, 1), (0, 100)),
+             ((0, 4000, 10), (0, 255))]
+    passed = True
+    for reported, expected in cases:
+        trainer = SimulatedTrainer(make_profile("steady"), SimClock())
+        if reported is not None:
+            trainer.resistance_range = SupportedResistanceLevelRange(*reported)
+        else:
+            trainer.target_features = trainer.target_features._replace(resistance_target_setting_supported=False)
+
+        capabilities = asyncio.run(get_capabilities(trainer, trainer.create_ftms()))
+        limits = resistance_limits(capabilities)
+
+        # Asking for far too much has to come out at something the trainer can be sent
+        controller = TrainerController(None, resistance_range=limits)
+        controller.set_resistance(10000)
+        sent = controller.shared_data["d_resistance"]
+        ok = tuple(limits) == expected and sent == expected[1] and 0 <= sent <= max_resistance_level
+        passed = passed and ok
+        print(f"  reported {reported}: limits {limits[0]:g}-{limits[1]:g}, 10000 sent as {sent:g}"
+              f"{'' if ok else '  FAIL'}")
+
+    # And a simulated trainer mustn't get written into the cache
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache = CapabilityCache(os.path.join(work_dir, "capabilities.json"))
+        trainer = SimulatedTrainer(make_profile("steady"), SimClock())
+        asyncio.run(get_capabilities(trainer, trainer.create_ftms(), cache=cache))
+        cached = bool(cache.entries) or os.path.exists(cache.file_name)
+    passed = passed and not cached
+    print(f"  simulated trainer {'cached  FAIL' if cached else 'not cached'}")
+    print("Passed" if passed else "Failed")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FTMS capability cache")
+    parser.add_argument("--check", action="store_true", help="check the resistance limits and the cache against simulated trainers")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if self_check() else 1)
+    parser.print_help()
@@ -1,3 +1,4 @@
+import time
 import tkinter as tk
 
 # THis stopwatch tkinter script is cobbled together with youtube and chat gpt. I haven't really made any interface scripts before
@@ -25,7 +26,8 @@ class TimerApp:
         self.reset_button = tk.Button(root, text="Reset", command=self.reset_timer, width=10)
         self.reset_button.pack(side=tk.LEFT, padx=10)
 
-        # Timer variables
+        # Timer variables. The time comes from the clock rather than adding 0.01 each callback, since after(10) is
+        # never exactly 10ms and that added up to a noticeable drift
         self.running = False
         self.start_time = 0
         self.elapsed_time = 0
@@ -33,13 +35,13 @@ class TimerApp:
     def update_timer(self):
         if self.running:
 
-            self.elapsed_time += 0.01
+            elapsed_time = self.elapsed_time + time.monotonic() - self.start_time
 
             # Convert to h, m, s and cs
-            hours = int(self.elapsed_time // 3600)
-            minutes = int((self.elapsed_time % 3600) // 60)
-            seconds = int(self.elapsed_time % 60)
-            centiseconds = int((self.elapsed_time - int(self.elapsed_time)) * 100)
+            hours = int(elapsed_time // 3600)
+            minutes = int((elapsed_time % 3600) // 60)
+            seconds = int(elapsed_time % 60)
+            centiseconds = int((elapsed_time - int(elapsed_time)) * 100)
 
             # format
             self.time_label.config(text=f"{hours:02}:{minutes:02}:{seconds:02}.{centiseconds:02}")
@@ -50,10 +52,13 @@ class TimerApp:
     def start_timer(self):
         if not self.running:
             self.running = True
+            self.start_time = time.monotonic()
             self.update_timer()
 
     def stop_timer(self):
-        self.running = False
+        if self.running:
+            self.elapsed_time += time.monotonic() - self.start_time
+            self.running = False
 
     def reset_timer(self):
         self.running = False
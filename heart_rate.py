@@ -0,0 +1,160 @@
+import math
+import time
+
+from sample_store import RingBuffer
+
+'''
+Heart Rate Measurement (0x2A37) decoding. hrm_data_handler() used to take data[1] as the heart rate, which ignores the
+flags byte, so 16 bit heart rates came out wrong and the energy expended and RR intervals were thrown away.
+
+The layout, from the Bluetooth heart rate service spec:
+    flags (1 byte)
+        bit 0    - heart rate is 16 bit (otherwise 8 bit)
+        bits 1-2 - sensor contact status (bit 2 set means contact is supported, bit 1 then says if there's contact)
+        bit 3    - energy expended is present (16 bit, kJ)
+        bit 4    - RR intervals are present (16 bit each, 1/1024 s, as many as fit in the rest of the packet)
+    heart rate (1 or 2 bytes)
+    energy expended (2 bytes, if flagged)
+    RR intervals (2 bytes each, if flagged)
+
+The decoder reads straight out of a memoryview over the notification, keeps its results as attributes rather than
+building a dict or list for each packet, and puts each RR interval into a fixed size ring buffer. RMSSD (the usual
+short term HRV number) is kept up to date as each interval arrives, with a running sum over the last `window`
+successive differences, so it never has to go back over the history.
+'''
+
+HEART_RATE_MEASUREMENT = "00002a37-0000-1000-8000-00805f9b34fb"
+
+FLAG_HR_16_BIT = 0x01
+FLAG_CONTACT_DETECTED = 0x02
+FLAG_CONTACT_SUPPORTED = 0x04
+FLAG_ENERGY_EXPENDED = 0x08
+FLAG_RR_INTERVALS = 0x10
+
+
+# RR intervals and the HRV worked out from them
+class HeartRateVariability:
+    def __init__(self, capacity=1024, window=30, min_rr=300, max_rr=2000, max_change=0.25, max_rejected_run=3):
+        self.intervals = RingBuffer(capacity)  # (arrival time, RR in ms)
+        self.window = window  # Successive differences RMSSD is worked out over
+        self.min_rr = min_rr  # RR intervals outside this range (ms) are dropped as artefacts
+        self.max_rr = max_rr
+        self.max_change = max_change  # And so is a beat more than this fraction different to the last good one
+        self.max_rejected_run = max_rejected_run  # After this many in a row, the rhythm really has changed
+
+        # The last `window` squared successive differences, and their sum
+        self._squares = [0.0] * window
+        self._square_index = 0
+        self._square_count = 0
+        self._square_sum = 0.0
+        self._last_rr = None  # The last accepted beat, what the next one gets checked against
+        self._adjacent = False  # Whether the next beat follows straight on from _last_rr, with nothing dropped between
+        self._rejected_run = 0
+        self.rejected = 0
+
+    def add(self, rr, timestamp):
+        if not self.min_rr <= rr <= self.max_rr:
+            self.rejected += 1
+            self._adjacent = False
+            return False
+        last_rr = self._last_rr
+        if last_rr is not None and abs(rr - last_rr) > self.max_change * last_rr:
+            # Probably a missed or extra beat. Only accepted beats become the reference, so one artefact doesn't take
+            # the good beat after it down too. Unless it keeps happening, then it's the reference that's wrong.
+            self.rejected += 1
+            self._adjacent = False
+            self._rejected_run += 1
+            if self._rejected_run >= self.max_rejected_run:
+                self._last_rr = rr
+                self._rejected_run = 0
+            return False
+        self.intervals.append(timestamp, rr)
+        self._last_rr = rr
+        self._rejected_run = 0
+        adjacent = self._adjacent
+        self._adjacent = True
+
+        # A difference is only counted between beats next to each other, not across one that got dropped
+        if last_rr is not None and adjacent:
+            square = (rr - last_rr) ** 2
+            i = self._square_index
+            self._square_sum += square - self._squares[i]
+            self._squares[i] = square
+            self._square_index = i + 1 if i + 1 < self.window else 0
+            if self._square_count < self.window:
+                self._square_count += 1
+        return True
+
+    # Root mean square of successive RR differences, in ms. None until there's been at least one difference.
+    @property
+    def rmssd(self):
+        if not self._square_count:
+            return None
+        # The running sum can drift a hair below zero from float rounding
+        return math.sqrt(max(self._square_sum, 0.0) / self._square_count)
+
+    @property
+    def last_rr(self):
+        latest = self.intervals.latest()
+        return latest[1] if latest else None
+
+    # A gap in the data (e.g. the strap reconnecting), so the next beat doesn't get compared with an old one
+    def reset_reference(self):
+        self._last_rr = None
+        self._adjacent = False
+        self._rejected_run = 0
+
+
+class HeartRateDecoder:
+    def __init__(self, hrv=None):
+        self.hrv = hrv if hrv is not None else HeartRateVariability()
+        self.heart_rate = None
+        self.contact_supported = False
+        self.contact = None  # None if the strap doesn't report contact
+        self.energy_expended = None  # kJ, only sent by some straps and usually only every few packets
+        self.rr_count = 0  # RR intervals in the last packet
+        self.packets = 0
+        self.errors = 0
+
+    # Decodes a notification and returns the heart rate, or None if the packet is too short to read
+    def decode(self, data, timestamp=None):
+        view = memoryview(data)
+        length = len(view)
+        if length < 2:
+            self.errors += 1
+            return None
+
+        flags = view[0]
+        offset = 1
+        if flags & FLAG_HR_16_BIT:
+            if length < 3:
+                self.errors += 1
+                return None
+            heart_rate = view[1] | (view[2] << 8)
+            offset = 3
+        else:
+            heart_rate = view[1]
+            offset = 2
+
+        self.contact_supported = bool(flags & FLAG_CONTACT_SUPPORTED)
+        self.contact = bool(flags & FLAG_CONTACT_DETECTED) if self.contact_supported else None
+
+        if flags & FLAG_ENERGY_EXPENDED:
+            if offset + 2 <= length:
+                self.energy_expended = view[offset] | (view[offset + 1] << 8)
+            offset += 2
+
+        self.rr_count = 0
+        if flags & FLAG_RR_INTERVALS:
+            if timestamp is None:
+                timestamp = time.monotonic()
+            while offset + 2 <= length:
+                raw = view[offset] | (view[offset + 1] << 8)
+                self.hrv.add(raw * 1000 / 1024, timestamp)
+                self.rr_count += 1
+                offset += 2
+
+        view.release()
+        self.heart_rate = heart_rate
+        self.packets += 1
+        return heart_rate
@@ -0,0 +1,154 @@
+import json
+import math
+import os
+import time
+from array import array
+
+'''
+Latency instrumentation. There was no way to tell how old the power on screen was, or how long a resistance change
+took to actually apply, which is the first thing you want to know when a trainer is being flaky.
+
+Each measurement goes into a histogram with log spaced buckets (10 per decade, from 10us to 100s), so recording is a
+log, an index and an add, with no lists growing over a long ride. Percentiles are read off the buckets, which is
+accurate to within a bucket width (about 25%), plenty for telling 20ms from 2s. Exact min, max and mean are kept too.
+
+What gets measured (names as they appear in the dump):
+    trainer_interval, hrm_interval - time between notifications arriving
+    notify_to_process              - notification arriving to derived_information working it in
+    notify_to_render               - age of the newest power sample when the display is drawn
+    control_request_control, control_reset, control_set_resistance, control_set_power
+                                   - control point round trips, write to indication
+    control_apply                  - a target being set to the trainer confirming it, retries and all
+And counters for retries, timeouts and failures.
+
+Everything can be read live with summary(), and gets dumped next to the session log at the end.
+'''
+
+
+class LatencyHistogram:
+    def __init__(self, min_value=1e-5, max_value=100.0, buckets_per_decade=10):
+        self.min_value = min_value
+        self.buckets_per_decade = buckets_per_decade
+        self._log_min = math.log10(min_value)
+        decades = math.log10(max_value) - self._log_min
+        # One bucket underneath for anything below min_value, and the last one catches anything above max_value
+        self.counts = array("L", bytes(array("L").itemsize * (int(decades * buckets_per_decade) + 2)))
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, seconds):
+        if seconds < self.min_value:
+            return 0
+        index = int((math.log10(seconds) - self._log_min) * self.buckets_per_decade) + 1
+        return index if index < len(self.counts) else len(self.counts) - 1
+
+    # Upper edge of a bucket, in seconds
+    def _edge(self, index):
+        return 10 ** (self._log_min + index / self.buckets_per_decade)
+
+    def record(self, seconds):
+        self.counts[self._bucket(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    # Approximate percentile (0-100), the upper edge of the bucket it falls in, capped at the real max
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = max(1, math.ceil(self.count * p / 100))
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return min(self._edge(index), self.max)
+        return self.max
+
+    # In milliseconds, as that's the scale everything here is on
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        ms = 1000
+        return {
+            "count": self.count,
+            "mean_ms": round(self.mean * ms, 3),
+            "min_ms": round(self.min * ms, 3),
+            "p50_ms": round(self.percentile(50) * ms, 3),
+            "p90_ms": round(self.percentile(90) * ms, 3),
+            "p99_ms": round(self.percentile(99) * ms, 3),
+            "max_ms": round(self.max * ms, 3),
+        }
+
+
+class LatencyMonitor:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._last_seen = {}
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        return histogram
+
+    def record(self, name, seconds):
+        if seconds is not None and seconds >= 0:
+            self.histogram(name).record(seconds)
+
+    # Time since `start` (a time.monotonic() value)
+    def since(self, name, start, now=None):
+        if start is not None:
+            self.record(name, (time.monotonic() if now is None else now) - start)
+
+    # Time between calls with the same name, e.g. how often notifications turn up
+    def interval(self, name, now=None):
+        now = time.monotonic() if now is None else now
+        last = self._last_seen.get(name)
+        self._last_seen[name] = now
+        if last is not None:
+            self.record(name, now - last)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def percentile(self, name, p):
+        histogram = self.histograms.get(name)
+        return histogram.percentile(p) if histogram else None
+
+    def summary(self):
+        return {
+            "histograms": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def dump(self, file_name):
+        temp_file = file_name + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.summary(), f, indent=4)
+        os.replace(temp_file, file_name)
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+        self._last_seen.clear()
+
+
+_monitor = None
+
+
+# One monitor for the whole process, so the handlers, the controller and the display all record to the same place
+def get_monitor():
+    global _monitor
+    if _monitor is None:
+        _monitor = LatencyMonitor()
+    return _monitor
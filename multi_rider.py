@@ -0,0 +1,430 @@
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+
+import ble_scan
+from connection_supervisor import ConnectionSupervisor
+from course import load_course
+from erg import ErgController
+from ftms_capabilities import get_capabilities, resistance_limits
+from latency import LatencyMonitor
+from physics import RiderCoefficients, VirtualBike
+from pipeline import SamplePipeline
+from profile_store import get_store
+from ride_stats import resume_stats, stats_checkpoint
+from sample_store import SampleStore
+from session_recorder import SessionRecorder
+from sim_devices import SimClock, SimulatedHRM, SimulatedTrainer, make_profile
+from tcx_export import TcxWriter
+from trainer_control import TrainerController
+import trainer_data
+
+'''
+Multi rider mode, for running several trainers side by side from one machine. trainer_data.main() handles one trainer
+and one HRM, with everything in a single shared_data dict, so running it twice means two processes fighting over the
+bluetooth adapter.
+
+Here each rider gets a RiderSession, which owns everything main() would: the rider's profile from the profile store,
+their trainer and HRM, the sample store, the pipeline, the physics and course position, the trainer controller (so
+each trainer has its own control queue), the connection supervisor, the session log and the latency stats. Nothing is
+shared between sessions apart from the event loop, so one rider's trainer dropping out (or one session falling over)
+doesn't touch anyone else's ride. The same functions as main() do the work (init_ftms, derived_information and so on).
+
+What is shared is the bluetooth side. There's one scan for every rider's devices, and the connections are made a
+connect_limit at a time, as most adapters get upset if they're asked to connect to lots of things at once. Once
+they're connected, 8 trainers at 4 Hz and 8 HRMs at 1 Hz is only 40 notifications a second.
+
+Each session records its own latency stats. The one to watch is notify_to_process, the time from a notification
+arriving to that rider's pipeline working it in: if the loop gets behind, that's where it shows, per rider, along with
+any samples that had to be dropped. There's also a probe for the loop as a whole, which measures how late a sleep
+wakes up (loop_lag). Both are on the status table and get saved at the end.
+
+Messages from a rider's trainer controller, connection supervisor and pipeline go under the status table (the newest
+one for each rider) rather than printing over it.
+
+    python multi_rider.py --riders alice bob carol
+    python multi_rider.py --simulate rider --count 8
+'''
+
+# Initialising variables and settings
+connect_limit = 3  # Devices connecting at the same time. Drop it to 1 if the adapter struggles
+status_rate = 2  # Status table redraws per second
+lag_interval = 0.1  # Seconds between loop lag probes
+
+
+# Rider names go in file names
+def file_safe(name):
+    return re.sub(r"[^\w-]", "_", name)
+
+
+class RiderSession:
+    def __init__(self, name, profile_file="userprofile.json", course_file=None, course_loop=False, erg_power=None,
+                 erg_mode="auto", session_dir="sessions", stamp=None, debug=False, has_profile=True):
+        self.name = name
+        self.debug = debug
+        # Simulated riders don't need a profile of their own. Without one they ride on the active rider's settings.
+        self.shared_data, self.settings, self.debug_data = trainer_data.init_shared_data(
+            profile_file, name if has_profile else None)
+        self.course_file = course_file
+        self.course_loop = course_loop
+        self.erg_power = erg_power
+        self.erg_mode = erg_mode
+        self.session_dir = session_dir
+        self.session_name = f"session_{file_safe(name)}_{stamp or time.strftime('%Y%m%d_%H%M%S')}"
+        self.summary_file = f"max_values_{file_safe(name)}.json"
+
+        self.monitor = LatencyMonitor()  # Its own, so each rider's numbers can be told apart
+        self.supervisor = ConnectionSupervisor(self.shared_data, self.debug_data, debug=debug, log=self.log)
+        self.clients = {}
+        self.status = "waiting"
+        self.message = None  # Newest message from the controller, supervisor or pipeline, shown under the table
+
+        self.stats = None
+        self.recorder = None
+        self.bike = None
+        self.course = None
+        self.sample_store = None
+        self.pipeline = None
+        self.controller = None
+        self.erg = None
+        self._controller_task = None
+
+    # Messages go under the status table rather than printing over it, or get printed if there's no table
+    def log(self, text):
+        self.message = f"{self.name}: {' '.join(str(text).split())}"
+        if not status_rate:
+            print(self.message)
+
+    # The addresses this rider's devices are on, in the shape device_connection() wants
+    def devices(self):
+        return {
+            "trainer": (self.settings["trainer_address"], self.settings["trainer_name"]),
+            "hrm": (self.settings["hrm_address"], self.settings["hrm_name"]),
+        }
+
+    async def connect(self):
+        self.status = "connecting"
+        self.clients = await trainer_data.device_connection(self.devices(), self.supervisor.disconnect_callback) or {}
+        return self.clients.get("trainer") is not None
+
+    async def connect_simulated(self, trainer, hrm=None):
+        self.clients = {"trainer": trainer}
+        if hrm is not None:
+            self.clients["hrm"] = hrm
+        for device_type, client in self.clients.items():
+            client.disconnected_callback = self.supervisor.disconnect_callback(device_type)
+            await client.connect()
+        return True
+
+    # Everything main() sets up once the devices are connected. Returns False if the trainer couldn't be set up.
+    async def start(self, resistance_rate=2, erg_rate=4, storage_rate=None, export_tcx=True):
+        shared_data, debug_data, settings = self.shared_data, self.debug_data, self.settings
+        trainer_client = self.clients.get("trainer")
+        if trainer_client is None:
+            self.status = "no trainer"
+            return False
+
+        stats, resumed = resume_stats(self.summary_file)
+        if resumed:
+            print(f"{self.name}: resuming ride stats from the last checkpoint.")
+        self.stats = stats
+        sim_clock = trainer_data.session_clock(trainer_client)
+        session_time = sim_clock.time if sim_clock else time.time
+        session_monotonic = sim_clock.now if sim_clock else time.monotonic
+        self.recorder = recorder = SessionRecorder(
+            log_dir=self.session_dir,
+            summary_file=self.summary_file,
+            summary_fn=lambda: stats_checkpoint(stats),
+            checkpoint_interval=trainer_data.checkpoint_interval,
+            session_name=self.session_name,
+            clock=session_monotonic,
+        )
+        if export_tcx:
+            recorder.exporters.append(TcxWriter(os.path.splitext(recorder.log_path)[0] + ".tcx"))
+
+        self.bike = bike = VirtualBike(RiderCoefficients.from_profile(settings["physics"]))
+        course_resistance = settings["base_resistance"]
+        if self.course_file:
+            # Loaded for each rider, as the course keeps track of where it's up to
+            self.course = load_course(self.course_file, settings["base_resistance"], settings["difficulty"],
+                                      self.course_loop)
+        course = self.course
+
+        monitor = self.monitor
+        elapsed_start_time = None
+        is_moving = False
+        session_start_time = session_time()
+
+        # Same as in main(), but on this rider's state
+        def process_sample(sample):
+            nonlocal elapsed_start_time, is_moving, course_resistance
+            if sample.values:
+                monitor.since("notify_to_process", sample.timestamp)
+            trainer_data.apply_sample(shared_data, debug_data, sample)
+            if course:
+                course_resistance = trainer_data.course_position(shared_data, course, bike.distance)
+            elapsed_start_time, is_moving = trainer_data.derived_information(
+                shared_data, debug_data, elapsed_start_time, is_moving, session_start_time, bike=bike,
+                now=session_time() if sim_clock else None)
+
+        def store_sample():
+            timestamp = session_time()
+            stats.update(shared_data, debug_data, timestamp=timestamp, moving=is_moving)
+            recorder.record(shared_data, debug_data, timestamp=timestamp)
+
+        def update_resistance():
+            shared_data["c_resistance"] = shared_data.get("current_resistance", settings["base_resistance"])
+            if self.erg:
+                self.erg.update(shared_data.get("power"), shared_data.get("cadence"), session_monotonic())
+                return
+            self.controller.set_resistance(course_resistance)
+
+        self.pipeline = SamplePipeline(process_sample, log=self.log)
+        self.pipeline.add_consumer(store_sample, rate=storage_rate)
+        self.pipeline.add_consumer(update_resistance, rate=erg_rate if self.erg_power else resistance_rate)
+
+        self.sample_store = SampleStore()
+        _, _, trainer_ftms, _ = await trainer_data.init_ftms(shared_data, debug_data, trainer_client,
+                                                             self.clients.get("hrm"), self.sample_store, self.pipeline,
+                                                             self.supervisor, monitor)
+        if trainer_ftms is None:
+            self.status = "no trainer"
+            return False
+
+        capabilities = None
+        try:
+            capabilities = await get_capabilities(trainer_client, trainer_ftms)
+        except Exception as e:
+            print(f"{self.name}: error reading trainer capabilities: {e}")
+
+        self.controller = TrainerController(trainer_ftms, shared_data, resistance_range=resistance_limits(capabilities),
+                                            debug=self.debug, monitor=monitor, log=self.log)
+        if self.erg_power:
+            self.erg = ErgController(self.controller, capabilities, self.erg_mode)
+            self.erg.set_target(self.erg_power)
+            shared_data["erg_target"] = self.erg_power
+        self.supervisor.on_reconnect("trainer", lambda client: self.controller.reacquire())
+        self.status = "riding"
+        return True
+
+    # Runs until cancelled. If something goes wrong in here, only this rider's session stops.
+    async def run(self):
+        self._controller_task = asyncio.create_task(self.controller.run())
+        try:
+            await self.pipeline.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.status = "stopped"
+            print(f"\n{self.name}: session stopped: {e}")
+        finally:
+            self._controller_task.cancel()
+
+    # Save everything and disconnect. Safe to call on a session that never got going.
+    async def close(self, analyse=True):
+        self.supervisor.stop()
+        if self._controller_task is not None:
+            self._controller_task.cancel()
+        if self.recorder is not None:
+            stats = self.stats
+            self.recorder.summary_fn = lambda: stats_checkpoint(stats, finished=True)
+            await self.recorder.close()
+            print(f"{self.name}: session saved to {self.recorder.log_path}")
+            if analyse and self.recorder.samples_recorded:
+                await trainer_data.analyse_session_file(self.recorder.log_path, self.settings["ftp"],
+                                                        self.settings["max_hr"])
+            latency_file = os.path.splitext(self.recorder.log_path)[0] + ".latency.json"
+            try:
+                self.monitor.dump(latency_file)
+            except OSError as e:
+                print(f"{self.name}: error saving latency stats: {e}")
+        for client in self.clients.values():
+            try:
+                await client.disconnect()
+            except Exception as e:
+                print(f"{self.name}: error disconnecting: {e}")
+
+    # One row of the status table
+    def row(self):
+        shared = self.shared_data
+        lag = self.monitor.percentile("notify_to_process", 99)
+        if self.status == "riding" and not all(self.supervisor.connected.values()):
+            link = "reconnecting"
+        else:
+            link = self.status
+
+        def number(key, fmt):
+            value = shared.get(key)
+            return fmt.format(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else "--"
+
+        target = (f"{self.erg_power:.0f} W" if self.erg_power
+                  else number("current_resistance", "{:.0f} %"))
+        return (f"{self.name[:12]:<12} {number('power', '{:.0f}'):>5} {number('cadence', '{:.0f}'):>4} "
+                f"{number('heart_rate', '{:.0f}'):>4} {number('velocity', '{:.1f}'):>5} "
+                f"{(shared.get('distance') or 0) / 1000:>6.2f} {shared.get('elapsed_timer', '--'):>11} "
+                f"{target:>6} {(f'{lag * 1000:.1f}' if lag is not None else '--'):>8} "
+                f"{(self.pipeline.samples_dropped if self.pipeline else 0):>5}  {link}")
+
+
+class MultiRiderEngine:
+    def __init__(self, riders, profile_file="userprofile.json", simulate=None, sim_speed=1.0, course_file=None,
+                 course_loop=False, erg_power=None, erg_mode="auto", session_dir="sessions", debug=False):
+        stamp = time.strftime("%Y%m%d_%H%M%S")
+        known = get_store(profile_file).names()
+        self.sessions = [RiderSession(name, profile_file, course_file, course_loop, erg_power, erg_mode, session_dir,
+                                      stamp, debug, has_profile=name in known or not simulate) for name in riders]
+        self.simulate = simulate
+        self.sim_speed = sim_speed
+        self.session_dir = session_dir
+        self.stamp = stamp
+        self.monitor = LatencyMonitor()  # The loop as a whole
+        self._started = None
+
+    # One scan for every rider's devices, then the connections a few at a time
+    async def connect(self):
+        if self.simulate:
+            clock = SimClock(self.sim_speed)
+            for index, session in enumerate(self.sessions, 1):
+                # A different power for each rider, so the table isn't eight copies of the same row
+                profile = make_profile(self.simulate, power=150 + 15 * (index - 1), cadence=85 + index % 4 * 3)
+                trainer = SimulatedTrainer(profile, clock, rate=trainer_data.sim_trainer_rate,
+                                           name=f"Simulated Trainer {index}", address=f"SIM:TRAINER:{index}")
+                hrm = SimulatedHRM(trainer, clock, rate=trainer_data.sim_hrm_rate, name=f"Simulated HRM {index}",
+                                   address=f"SIM:HRM:{index}")
+                await session.connect_simulated(trainer, hrm)
+            print(f"Using simulated devices for {len(self.sessions)} riders ({self.simulate}, {self.sim_speed}x speed)")
+            return
+
+        addresses = [address for session in self.sessions for address, name in session.devices().values()
+                     if address and name]
+        print(f"Scanning for {len(addresses)} devices...")
+        # device_connection() scans too, but with everything in the scan cache it won't have to
+        await ble_scan.scan(addresses)
+
+        limit = asyncio.Semaphore(connect_limit)
+
+        async def connect(session):
+            async with limit:
+                try:
+                    if not await session.connect():
+                        session.status = "no trainer"
+                except Exception as e:
+                    session.status = "no trainer"
+                    print(f"{session.name}: error connecting: {e}")
+
+        await asyncio.gather(*(connect(session) for session in self.sessions))
+
+    # How late a sleep wakes up. Anything that holds the loop up shows here, whichever rider it's for
+    async def lag_probe(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(lag_interval)
+            self.monitor.record("loop_lag", time.monotonic() - started - lag_interval)
+
+    def status_table(self):
+        lag = self.monitor.percentile("loop_lag", 99)
+        elapsed = time.monotonic() - self._started if self._started else 0
+        lines = [f"Multi rider  {len(self.sessions)} riders  {elapsed:.0f}s  "
+                 f"loop lag p99 {f'{lag * 1000:.1f} ms' if lag is not None else '--'}",
+                 "",
+                 f"{'Rider':<12} {'Power':>5} {'Cad':>4} {'HR':>4} {'km/h':>5} {'km':>6} {'Moving':>11} {'Target':>6} "
+                 f"{'p99 ms':>8} {'Drops':>5}  Status"]
+        lines.extend(session.row() for session in self.sessions)
+        messages = [session.message for session in self.sessions if session.message]
+        if messages:
+            lines.append("")
+            lines.extend(messages)
+        return lines
+
+    async def display(self):
+        out = sys.stdout
+        out.write("\x1b[?25l\x1b[2J")  # Hide the cursor and clear the screen
+        while True:
+            out.write("\x1b[H" + "".join(line + "\x1b[K\n" for line in self.status_table()) + "\x1b[J")
+            out.flush()
+            await asyncio.sleep(1.0 / status_rate)
+
+    async def run(self):
+        await self.connect()
+        started = []
+        for session in self.sessions:
+            try:
+                if await session.start(trainer_data.resistance_rate, trainer_data.erg_rate,
+                                       trainer_data.storage_rate, trainer_data.export_tcx):
+                    started.append(session)
+                else:
+                    print(f"{session.name}: trainer not connected, leaving them out.")
+            except Exception as e:
+                session.status = "stopped"
+                print(f"{session.name}: error starting session: {e}")
+        if not started:
+            print("Error: no trainers connected. Exiting.")
+            await asyncio.gather(*(session.close(analyse=False) for session in self.sessions))
+            return
+
+        self._started = time.monotonic()
+        tasks = [asyncio.create_task(session.run()) for session in started]
+        tasks.append(asyncio.create_task(self.lag_probe()))
+        if status_rate:
+            tasks.append(asyncio.create_task(self.display()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if status_rate:
+                sys.stdout.write("\x1b[?25h\n")  # Cursor back
+                print("\n".join(self.status_table()))
+            print()
+            await asyncio.gather(*(session.close(trainer_data.analyse_ride) for session in self.sessions))
+
+            latency_file = os.path.join(self.session_dir, f"multi_{self.stamp}.latency.json")
+            try:
+                os.makedirs(self.session_dir, exist_ok=True)
+                self.monitor.dump(latency_file)
+                print(f"Loop latency stats saved to {latency_file}")
+            except OSError as e:
+                print(f"Error saving latency stats: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Several riders at once")
+    parser.add_argument("--riders", nargs="+", help="rider profiles to use, defaults to every profile in the file")
+    parser.add_argument("--profile", default=trainer_data.user_profile, help="profile file")
+    parser.add_argument("--simulate", metavar="PROFILE",
+                        help="use simulated devices: steady, intervals, ramp, rider, or a session .jsonl to play back")
+    parser.add_argument("--count", type=int, default=8, help="simulated riders, if no riders are named")
+    parser.add_argument("--sim-speed", type=float, default=trainer_data.sim_speed)
+    parser.add_argument("--course", help="route file for everyone to ride")
+    parser.add_argument("--loop", action="store_true", help="repeat the course at the end")
+    parser.add_argument("--erg", type=float, metavar="WATTS", help="ERG mode for everyone, hold this power")
+    parser.add_argument("--erg-mode", choices=["auto", "power", "resistance"], default="auto")
+    parser.add_argument("--no-status", action="store_true", help="don't draw the status table")
+    parser.add_argument("--connect-limit", type=int, default=connect_limit, help="devices connecting at the same time")
+    args = parser.parse_args()
+
+    riders = args.riders
+    if not riders:
+        riders = ([f"rider{index}" for index in range(1, args.count + 1)] if args.simulate
+                  else get_store(args.profile).names())
+    if not riders:
+        print("Error: no rider profiles found. Exiting.")
+        sys.exit(1)
+    missing = [name for name in riders if name not in get_store(args.profile).names()]
+    if missing and not args.simulate:
+        parser.error(f"no rider profile for {', '.join(missing)}, set them up with connect_profile.py --rider")
+    if args.no_status:
+        status_rate = 0
+    connect_limit = max(1, args.connect_limit)
+    trainer_data.debug = False  # Eight riders worth of debug prints isn't readable
+
+    engine = MultiRiderEngine(riders, args.profile, args.simulate, args.sim_speed, args.course, args.loop, args.erg,
+                              args.erg_mode, trainer_data.session_dir)
+    try:
+        asyncio.run(engine.run())
+    except KeyboardInterrupt:
+        pass  # The sessions have been saved by the time this gets here
@@ -0,0 +1,112 @@
+import math
+
+'''
+Virtual bike physics. The old calculate_virtual_speed did one explicit Euler step with delta_t=1 every time it was
+called, but the loop runs every 0.1s (or whenever a sample turns up in pipeline mode), so the speed ran about 10x too
+fast and changed with how often the loop went round. That was most of the "acceleration doesn't work" problem.
+
+This steps on the real time between calls instead. That time gets chopped into fixed internal steps, each one done with
+RK4, and anything left over is carried into the next call. So the result only depends on how much time has passed,
+not how it was sliced up, and the same inputs always give the same output. The internal step is 50 ms, so at 20 Hz input
+it's about one step a call, and at 100 Hz one every 5 calls.
+
+The coefficients can be set per rider in the profile, under user_data -> physics, e.g.
+    "physics": {"C_d": 0.7, "A": 0.4, "bike_mass": 9}
+'''
+
+
+class RiderCoefficients:
+    defaults = {
+        "g": 9.8,  # gravitational constant
+        "C_r": 0.006,  # rolling resistance coefficient
+        "C_d": 0.88,  # drag coefficient
+        "A": 0.5,  # frontal area (m^2)
+        "rho": 1.225,  # air density (kg/m^3)
+        "bike_mass": 7,  # mass of bike
+        "max_acceleration": 5.0,  # Maximum realistic acceleration (m/s^2)
+        "min_drive_speed": 0.1,  # Speed the drive force is worked out at when stopped, avoids dividing by zero
+    }
+
+    def __init__(self, **overrides):
+        for name, value in self.defaults.items():
+            setattr(self, name, float(overrides.get(name, value)))
+
+    # Anything in the profile that isn't a known coefficient gets ignored
+    @classmethod
+    def from_profile(cls, physics_settings):
+        physics_settings = physics_settings or {}
+        return cls(**{name: value for name, value in physics_settings.items() if name in cls.defaults})
+
+
+class VirtualBike:
+    def __init__(self, coefficients=None, step=0.05, max_dt=2.0):
+        self.c = coefficients or RiderCoefficients()
+        self.step = step  # Internal step, 20 Hz
+        self.max_dt = max_dt  # Longer gaps than this (dropouts, the laptop going to sleep) only count as max_dt
+        self.v = 0.0  # m/s
+        self.distance = 0.0  # m
+        self.last_time = None
+        self._remainder = 0.0
+
+        # Inputs, held constant over the steps in an update
+        self._power = 0.0
+        self._mass = 0.0
+        self._gradient = 0.0
+
+        self.forces = {}
+
+    def _acceleration(self, v):
+        c = self.c
+        f_rolling = c.C_r * self._mass * c.g  # rolling resistance force
+        f_drag = 0.5 * c.C_d * c.A * c.rho * v ** 2  # air drag force
+        f_grad = self._mass * c.g * math.sin(math.radians(self._gradient))  # gradient force
+        f_drive = self._power / max(v, c.min_drive_speed)
+        acceleration = (f_drive - f_rolling - f_drag - f_grad) / self._mass  # a = F / m
+        return max(-c.max_acceleration, min(acceleration, c.max_acceleration))
+
+    def _rk4(self, h):
+        v = self.v
+        k1 = self._acceleration(v)
+        k2 = self._acceleration(max(0.0, v + 0.5 * h * k1))
+        k3 = self._acceleration(max(0.0, v + 0.5 * h * k2))
+        k4 = self._acceleration(max(0.0, v + h * k3))
+        v_next = max(0.0, v + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4))  # velocity cannot be negative
+        self.distance += 0.5 * (v + v_next) * h
+        self.v = v_next
+
+    # Advance the bike to `now` (monotonic seconds). The first call just sets the starting time.
+    def update(self, power, rider_mass, gradient, now):
+        self._power = max(power, 0.0)
+        self._mass = rider_mass + self.c.bike_mass
+        self._gradient = gradient
+
+        if self.last_time is not None:
+            self._remainder += min(max(now - self.last_time, 0.0), self.max_dt)
+            while self._remainder >= self.step:
+                self._rk4(self.step)
+                self._remainder -= self.step
+        self.last_time = now
+
+        self._update_forces()
+        return self.v
+
+    # Forces at the current speed, for the debug readout
+    def _update_forces(self):
+        c = self.c
+        v = self.v
+        f_rolling = c.C_r * self._mass * c.g
+        f_drag = 0.5 * c.C_d * c.A * c.rho * v ** 2
+        f_grad = self._mass * c.g * math.sin(math.radians(self._gradient))
+        f_total = f_rolling + f_drag + f_grad
+        f_drive = self._power / max(v, c.min_drive_speed)
+        f_net = f_drive - f_total
+        acceleration = max(-c.max_acceleration, min(f_net / self._mass, c.max_acceleration))
+        self.forces = {
+            "f_rolling": f_rolling,
+            "f_drag": f_drag,
+            "f_grad": f_grad,
+            "f_total": f_total,
+            "f_drive": f_drive,
+            "f_net": f_net,
+            "acceleration": acceleration,
+        }
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+'''
+Event driven processing. Instead of polling shared_data every 100ms, the notification handlers push each sample into
+a queue, and the derived metrics are worked out once per sample as it arrives. Display and storage hang off the end as
+consumers, each with its own rate limit, so printing at 10 Hz doesn't hold up anything else and nothing runs at all
+while no data is coming in.
+
+If nothing arrives for idle_tick seconds, a tick with no values gets pushed through anyway so the timers keep
+counting when the trainer goes quiet.
+
+Nothing that raises stops it. If process_fn or a consumer raises, the error gets counted and logged (once per
+different message, so something failing 10 times a second doesn't flood the screen), and the next sample goes through
+as normal, so one bad sample can't end the ride, the recording or the resistance control. The messages go to log,
+which is print unless something else is given, e.g. the dashboard's status line so they don't scroll it.
+'''
+
+
+class Sample:
+    __slots__ = ("channel", "values", "timestamp")
+
+    def __init__(self, channel, values, timestamp):
+        self.channel = channel
+        self.values = values
+        self.timestamp = timestamp
+
+
+class Consumer:
+    def __init__(self, fn, rate=None):
+        self.fn = fn
+        self.interval = 1.0 / rate if rate else None  # None means call it inline for every sample
+        self.is_async = asyncio.iscoroutinefunction(fn)
+        self.updated = asyncio.Event()
+        self.calls = 0
+        self.errors = 0
+        self.last_error = None
+
+
+class SamplePipeline:
+    def __init__(self, process_fn, maxsize=1000, idle_tick=1.0, log=None):
+        self.process_fn = process_fn  # Called once per sample with the Sample, before any consumers
+        self.queue = asyncio.Queue(maxsize)
+        self.idle_tick = idle_tick
+        self.log = log or print
+        self.consumers = []
+        self.samples_processed = 0
+        self.samples_dropped = 0
+        self.process_errors = 0
+        self._last_process_error = None
+        self._tasks = []
+
+    # Consumers without a rate get called for every sample. With a rate, they run in their own task at most `rate`
+    # times a second, and only if something new has come in since they last ran.
+    def add_consumer(self, fn, rate=None):
+        consumer = Consumer(fn, rate)
+        self.consumers.append(consumer)
+        return consumer
+
+    # Called from the notification handlers. Never blocks, if the queue is full the oldest sample gets thrown away
+    # so we always keep up with the newest data.
+    def push(self, channel, values, timestamp=None):
+        sample = Sample(channel, values, time.monotonic() if timestamp is None else timestamp)
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.samples_dropped += 1
+        self.queue.put_nowait(sample)
+
+    @property
+    def consumer_errors(self):
+        return sum(consumer.errors for consumer in self.consumers)
+
+    @property
+    def errors(self):
+        return self.process_errors + self.consumer_errors
+
+    # Logs an error unless it's the same as the last one from the same place. Gives back the message, to compare the
+    # next one against.
+    def _report(self, fn, count, error, last):
+        message = f"{type(error).__name__}: {error}"
+        if message != last:
+            self.log(f"Error in {getattr(fn, '__name__', 'the pipeline')} (error {count}), carrying on: {message}")
+        return message
+
+    async def _call(self, consumer):
+        try:
+            result = consumer.fn()
+            if consumer.is_async:
+                await result
+        except Exception as e:
+            consumer.errors += 1
+            consumer.last_error = self._report(consumer.fn, consumer.errors, e, consumer.last_error)
+        consumer.calls += 1
+
+    async def _process(self, sample):
+        try:
+            self.process_fn(sample)
+        except Exception as e:
+            self.process_errors += 1
+            self._last_process_error = self._report(self.process_fn, self.process_errors, e, self._last_process_error)
+        self.samples_processed += 1
+        for consumer in self.consumers:
+            if consumer.interval is None:
+                await self._call(consumer)
+            else:
+                consumer.updated.set()
+
+    async def _run_consumer(self, consumer):
+        while True:
+            await consumer.updated.wait()
+            consumer.updated.clear()
+            await self._call(consumer)
+            await asyncio.sleep(consumer.interval)
+
+    async def run(self):
+        self._tasks = [asyncio.create_task(self._run_consumer(c)) for c in self.consumers if c.interval is not None]
+        try:
+            while True:
+                try:
+                    sample = await asyncio.wait_for(self.queue.get(), self.idle_tick)
+                except asyncio.TimeoutError:
+                    sample = Sample("tick", None, time.monotonic())
+                await self._process(sample)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
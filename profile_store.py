@@ -0,0 +1,173 @@
+import atexit
+import copy
+import json
+import os
+import threading
+
+'''
+Profile store, shared by connect_profile.py and trainer_data.py. There used to be two copies of load_profile, and
+save_profile rewrote userprofile.json after nearly every setup step.
+
+The file gets parsed and checked once, then kept in memory. Saves just mark it as changed and start a short timer, so
+a run of saves in a row turns into one write, and that write goes to a temp file which then replaces the real one, so
+the profile can't be left half written. Anything still unsaved gets written when the script exits.
+
+The write happens on the timer's thread while the caller carries on changing the profile dicts, so save() takes a deep
+copy there and then, and that copy is what gets written. Changes made after the last save() aren't in the file until
+the next one.
+
+One file can hold several riders:
+    {"active": "jim", "profiles": {"jim": {"user_data": {...}, "device": {...}}, "bob": {...}}}
+The old single profile layout ({"user_data": ..., "device": ...}) still loads, as a profile called "default", and gets
+written back out in the new layout.
+'''
+
+# Known fields, their types and the defaults used when a setting is asked for but not in the profile. Fields with the
+# wrong type get dropped when the file is loaded, so nothing further on has to check.
+schema = {
+    "user_data": {
+        "username": (str, None),
+        "difficulty": ((int, float), 50),
+        "baseline": ((int, float), 20),
+        "weight": ((int, float), 75),
+        "ftp": ((int, float), 200),
+        "max_hr": ((int, float), 190),
+        "physics": (dict, {}),
+    },
+    "device": {
+        "name": (str, None),
+        "address": (str, None),
+        "hrm_name": (str, None),
+        "hrm_address": (str, None),
+        "power": (bool, False),
+        "cadence": (bool, False),
+        "speed": (bool, False),
+    },
+}
+
+default_name = "default"
+
+
+def validate_profile(profile):
+    if not isinstance(profile, dict):
+        profile = {}
+    for section, fields in schema.items():
+        values = profile.get(section)
+        if not isinstance(values, dict):
+            values = profile[section] = {}
+        for field, (types, default) in fields.items():
+            if field in values and values[field] is not None and not isinstance(values[field], types):
+                print(f"Ignoring invalid {section}.{field} in profile: {values[field]!r}")
+                del values[field]
+    return profile
+
+
+class ProfileStore:
+    def __init__(self, file_name="userprofile.json", debounce=0.5):
+        self.file_name = file_name
+        self.debounce = debounce
+        self.active = default_name
+        self.profiles = {}
+        self.writes = 0
+
+        self._dirty = False
+        self._snapshot = None  # Copy taken at the last save(), for the timer thread to write
+        self._timer = None
+        self._lock = threading.Lock()
+
+        self._load()
+        atexit.register(self.flush)
+
+    def _load(self):
+        data = {}
+        if os.path.exists(self.file_name):
+            with open(self.file_name, "r") as f:
+                try:
+                    data = json.load(f)
+                except json.JSONDecodeError:
+                    data = {}  # This happens if the file is there but does not contain anything
+
+        if isinstance(data, dict) and isinstance(data.get("profiles"), dict):
+            self.profiles = {name: validate_profile(profile) for name, profile in data["profiles"].items()}
+            self.active = data.get("active") or next(iter(self.profiles), default_name)
+        elif isinstance(data, dict) and ("user_data" in data or "device" in data):
+            # Old single profile file
+            self.profiles = {default_name: validate_profile(data)}
+        else:
+            self.profiles = {}
+
+    def names(self):
+        return list(self.profiles)
+
+    # The profile for a rider, or the active rider if no name is given. This is the cached dict itself, so changes to it
+    # are kept; call save() to get them written to the file. A rider that isn't in the file is a KeyError, rather than
+    # quietly getting a default profile (a mistyped --rider would ride on the defaults, and leave a junk entry behind).
+    def get(self, name=None):
+        name = name or self.active
+        if name not in self.profiles:
+            raise KeyError(f"No rider profile called {name!r}")
+        return self.profiles[name]
+
+    # A new rider, with nothing set yet so the schema defaults apply until it's set up
+    def create(self, name):
+        if name in self.profiles:
+            raise ValueError(f"There's already a rider profile called {name!r}")
+        self.profiles[name] = validate_profile({})
+        self.save()
+        return self.profiles[name]
+
+    # Switch the active rider
+    def select(self, name):
+        profile = self.get(name)
+        if name != self.active:
+            self.active = name
+            self.save()
+        return profile
+
+    # A single setting with the schema default filled in, e.g. setting("user_data", "weight"). A named rider has to
+    # exist, but the active one can be missing (nothing's been set up yet), and then it's all defaults.
+    def setting(self, section, field, name=None):
+        profile = self.get(name) if name else self.profiles.get(self.active, {})
+        value = profile.get(section, {}).get(field)
+        if value is None:
+            return schema[section][field][1]
+        return value
+
+    # Mark the store as changed. The write happens once things go quiet for `debounce` seconds, or at exit.
+    def save(self, profile=None, name=None):
+        with self._lock:
+            if profile is not None:
+                self.profiles[name or self.active] = validate_profile(profile)
+            self._snapshot = copy.deepcopy({"active": self.active, "profiles": self.profiles})
+            self._dirty = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    # Write now, if anything has changed
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            temp_file = self.file_name + ".tmp"
+            with open(temp_file, "w") as f:
+                json.dump(self._snapshot, f, indent=4, sort_keys=True)
+            os.replace(temp_file, self.file_name)
+            self._dirty = False
+            self.writes += 1
+
+
+_stores = {}
+
+
+# One store per file for the whole process, so both scripts (and everything they import) share the parsed copy
+def get_store(file_name="userprofile.json"):
+    store = _stores.get(file_name)
+    if store is None:
+        store = _stores[file_name] = ProfileStore(file_name)
+    return store
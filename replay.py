@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from course import load_course
+from physics import RiderCoefficients, VirtualBike
+from ride_stats import RideStats
+import trainer_data
+
+'''
+Replays a recorded session through derived_information() and the resistance logic, without a trainer. For tuning the
+physics and the moving time logic against real rides, and checking a change doesn't shift the numbers on old ones.
+
+Only the raw inputs are taken from the log (power, cadence, heart rate, trainer speed, weight, and the gradient if
+no course is given). Everything derived gets worked out again. The clock is virtual: it's set to each sample's
+timestamp from the log, and derived_information() and the physics get that time instead of reading the real clock.
+So nothing depends on how fast the machine is, and the same log with the same settings always gives a byte for byte
+identical output file (its sha256 gets printed, for comparing runs).
+
+It runs as fast as it can, or at real time (or any multiple) with --pace, which is handy for watching it on the
+dashboard.
+
+The replays go in replays/ as <session>.replay.jsonl, away from the sessions so a sessions/*.jsonl doesn't pick them
+up next time, and any .replay.jsonl given as a session gets skipped anyway.
+    python replay.py sessions/session_20240101_120000.jsonl
+    python replay.py sessions/*.jsonl --physics '{"C_d": 0.7}' --output-dir replays_cd07
+'''
+
+replay_dir = "replays"  # Not sessions/, so the replays aren't in the next sessions/*.jsonl
+replay_suffix = ".replay.jsonl"
+
+# What gets copied in from the log. Everything else in it was derived and gets worked out again.
+input_keys = ("power", "cadence", "heart_rate", "weight")
+debug_input_keys = ("t_speed",)
+
+
+# Stands in for the real clock. Only moves when it's told to.
+class VirtualClock:
+    def __init__(self, pace=None):
+        self.pace = pace  # None runs flat out, 1 is real time, 10 is 10x real time
+        self.start = None
+        self.current = None
+        self._wall_start = None
+
+    def now(self):
+        return self.current
+
+    # Move the clock to t, waiting if it's being paced
+    def advance(self, t):
+        if self.start is None:
+            self.start = t
+            self._wall_start = time.monotonic()
+        if self.current is not None and t < self.current:
+            t = self.current  # Never goes backwards, even if the log does
+        self.current = t
+        if self.pace:
+            wait = (t - self.start) / self.pace - (time.monotonic() - self._wall_start)
+            if wait > 0:
+                time.sleep(wait)
+
+
+def read_samples(session_file):
+    with open(session_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                sample = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A line cut off by a crash
+            if sample.get("t") is not None:
+                yield sample
+
+
+def replay_session(session_file, output_file, physics=None, weight=None, course_file=None, base_resistance=20,
+                   difficulty=50, loop=False, resistance_range=(0, 100), resistance_rate=None, pace=None,
+                   display=None):
+    clock = VirtualClock(pace)
+    bike = VirtualBike(RiderCoefficients.from_profile(physics))
+    course = load_course(course_file, base_resistance, difficulty, loop) if course_file else None
+    stats = RideStats()
+    resistance_rate = trainer_data.resistance_rate if resistance_rate is None else resistance_rate
+    resistance_interval = 1.0 / resistance_rate if resistance_rate else 0.0
+
+    shared_data = {"power": 0, "cadence": 0, "speed": 0, "heart_rate": None, "weight": weight or 75}
+    debug_data = {}
+    elapsed_start_time = None
+    is_moving = False
+    session_start_time = None
+    last_resistance_update = None
+    course_resistance = base_resistance
+    digest = hashlib.sha256()
+    samples = 0
+
+    with open(output_file, "w", encoding="utf-8", newline="\n") as out:
+        for sample in read_samples(session_file):
+            clock.advance(sample["t"])
+            now = clock.now()
+            if session_start_time is None:
+                session_start_time = now
+
+            for key in input_keys:
+                if key in sample and not (key == "weight" and weight):
+                    shared_data[key] = sample[key]
+            for key in debug_input_keys:
+                if key in sample:
+                    debug_data[key] = sample[key]
+
+            # Same order as process_sample() in trainer_data.main()
+            if course:
+                course_resistance = trainer_data.course_position(shared_data, course, bike.distance)
+            elif "gradient" in sample:
+                shared_data["gradient"] = sample["gradient"]
+            elapsed_start_time, is_moving = trainer_data.derived_information(
+                shared_data, debug_data, elapsed_start_time, is_moving, session_start_time, bike=bike, now=now)
+
+            # And update_resistance(), at the same rate it runs at live
+            if last_resistance_update is None or now - last_resistance_update >= resistance_interval:
+                last_resistance_update = now
+                low, high = resistance_range
+                shared_data["d_resistance"] = max(low, min(high, course_resistance))
+
+            stats.update(shared_data, debug_data, timestamp=now, moving=is_moving)
+
+            record = {"t": round(now, 3)}
+            record.update(shared_data)
+            record.update(debug_data)
+            line = json.dumps(record, separators=(",", ":")) + "\n"
+            out.write(line)
+            digest.update(line.encode("utf-8"))
+            samples += 1
+
+            if display is not None:
+                display(shared_data, debug_data, now)
+
+        summary = json.dumps(stats.summary(), separators=(",", ":"), sort_keys=True) + "\n"
+        out.write(summary)
+        digest.update(summary.encode("utf-8"))
+
+    return samples, digest.hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded sessions through the derived metrics")
+    parser.add_argument("sessions", nargs="+", help="session .jsonl files")
+    parser.add_argument("--output-dir", default=replay_dir, help="where the replays go")
+    parser.add_argument("--physics", type=json.loads, default=None,
+                        help='physics coefficients as json, e.g. \'{"C_d": 0.7}\'')
+    parser.add_argument("--weight", type=float, help="rider weight, instead of the one in the log")
+    parser.add_argument("--course", help="route to ride, instead of the gradients in the log")
+    parser.add_argument("--base-resistance", type=float, default=20)
+    parser.add_argument("--difficulty", type=float, default=50)
+    parser.add_argument("--loop", action="store_true", help="start the course again at the end")
+    parser.add_argument("--pace", type=float, help="replay at this multiple of real time, e.g. 1 or 10")
+    parser.add_argument("--dashboard", action="store_true", help="show the dashboard while replaying")
+    args = parser.parse_args()
+
+    display = None
+    if args.dashboard:
+        from dashboard import TerminalDashboard
+        dashboard = TerminalDashboard(rate=trainer_data.display_rate, title="Replay")
+        # The dashboard's rate limit runs off the real clock, it's only for watching
+        display = lambda shared, debug, now: dashboard.render(shared, debug)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for session in args.sessions:
+        if session.endswith(replay_suffix):
+            print(f"Skipping {session}, it's a replay")
+            continue
+        output = os.path.join(args.output_dir, os.path.splitext(os.path.basename(session))[0] + replay_suffix)
+        started = time.perf_counter()
+        samples, digest = replay_session(session, output, args.physics, args.weight, args.course, args.base_resistance,
+                                         args.difficulty, args.loop, pace=args.pace, display=display)
+        print(f"{session} -> {output}: {samples} samples in {time.perf_counter() - started:.2f}s, sha256 {digest}")
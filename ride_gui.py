@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import queue
+import threading
+import time
+import tkinter as tk
+
+from profile_store import get_store
+import trainer_data
+
+'''
+Ride dashboard GUI, grown out of the TimerApp stopwatch in "gui test timer.py".
+
+Tk has to own the main thread and the bluetooth side needs its asyncio loop, so they run in separate threads and never
+wait on each other. The asyncio side drops snapshots of the live data into a bounded queue (if the GUI falls behind,
+the oldest snapshot gets thrown away rather than the loop waiting). The GUI drains the whole queue in one go each frame,
+keeps only the newest snapshot, and redraws at a capped frame rate, only touching labels whose text changed.
+
+The timers are worked out from time.monotonic() every frame rather than by adding 0.01 per callback, so they don't
+drift when Tk is late. The moving timer carries on from the last value the ride loop sent while we're moving.
+
+Run with the same options as trainer_data.py, e.g.
+    python ride_gui.py --simulate intervals
+'''
+
+
+def format_time(total_seconds):
+    hours, remainder = divmod(int(total_seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    centiseconds = int((total_seconds - int(total_seconds)) * 100)
+    return f"{hours:02}:{minutes:02}:{seconds:02}.{centiseconds:02}"
+
+
+# Runs trainer_data.main() on its own asyncio loop in a background thread
+class RideThread(threading.Thread):
+    def __init__(self, data_queue, send_rate=20):
+        super().__init__(daemon=True)
+        self.data_queue = data_queue
+        self.send_rate = send_rate
+        self.loop = None
+        self.task = None
+        self.dropped = 0
+
+    # Called on the asyncio thread. Never blocks
+    def push(self, shared_data, debug_data):
+        snapshot = dict(shared_data)
+        snapshot["_received"] = time.monotonic()
+        try:
+            self.data_queue.put_nowait(snapshot)
+        except queue.Full:
+            try:
+                self.data_queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self.data_queue.put_nowait(snapshot)
+
+    def run(self):
+        async def ride():
+            self.loop = asyncio.get_running_loop()
+            self.task = asyncio.current_task()
+            await trainer_data.main(sinks=[(self.push, self.send_rate)])
+
+        try:
+            asyncio.run(ride())
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self, timeout=5.0):
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        self.join(timeout)
+
+
+class RideDashboard:
+    # (key, label, format) for each live value
+    fields = [
+        ("power", "Power (W)", "{:.0f}"),
+        ("cadence", "Cadence (rpm)", "{:.0f}"),
+        ("heart_rate", "HR (bpm)", "{:.0f}"),
+        ("velocity", "Speed (km/h)", "{:.1f}"),
+        ("wkg", "W/kg", "{:.2f}"),
+    ]
+
+    def __init__(self, root, data_queue, fps=20, max_batch=200):
+        self.root = root
+        self.root.title("Ride Dashboard")
+        self.data_queue = data_queue
+        self.frame_ms = int(1000 / fps)
+        self.max_batch = max_batch  # Most snapshots drained in one frame, so a flood can't hold up Tk
+
+        # Live values
+        self.value_labels = {}
+        grid = tk.Frame(root)
+        grid.pack(padx=20, pady=10)
+        for column, (key, label, fmt) in enumerate(self.fields):
+            tk.Label(grid, text=label, font=("Verdana", 10)).grid(row=0, column=column, padx=10)
+            value_label = tk.Label(grid, text="--", font=("Verdana", 28), width=5)  # verdana goat
+            value_label.grid(row=1, column=column, padx=10)
+            self.value_labels[key] = value_label
+
+        # Ride timers
+        timers = tk.Frame(root)
+        timers.pack(pady=10)
+        tk.Label(timers, text="Moving", font=("Verdana", 10)).grid(row=0, column=0, padx=20)
+        tk.Label(timers, text="Total", font=("Verdana", 10)).grid(row=0, column=1, padx=20)
+        self.moving_label = tk.Label(timers, text="00:00:00.00", font=("Verdana", 24))
+        self.moving_label.grid(row=1, column=0, padx=20)
+        self.total_label = tk.Label(timers, text="00:00:00.00", font=("Verdana", 24))
+        self.total_label.grid(row=1, column=1, padx=20)
+
+        # Lap stopwatch, the old TimerApp
+        self.time_label = tk.Label(root, text="00:00:00.00", font=("Verdana", 18))
+        self.time_label.pack(pady=10)
+        buttons = tk.Frame(root)
+        buttons.pack(pady=10)
+        self.start_button = tk.Button(buttons, text="Start", command=self.start_timer, width=10)
+        self.start_button.pack(side=tk.LEFT, padx=10)
+        self.stop_button = tk.Button(buttons, text="Stop", command=self.stop_timer, width=10)
+        self.stop_button.pack(side=tk.LEFT, padx=10)
+        self.reset_button = tk.Button(buttons, text="Reset", command=self.reset_timer, width=10)
+        self.reset_button.pack(side=tk.LEFT, padx=10)
+
+        # Timer variables. Lap time is the time banked while stopped plus the time since the last start
+        self.running = False
+        self.start_time = 0
+        self.elapsed_time = 0
+
+        self.session_start = None
+        self.latest = None
+        self.frames = 0
+        self._shown = {}
+
+        self.root.after(self.frame_ms, self.update_frame)
+
+    def _set(self, label, text):
+        if self._shown.get(label) != text:
+            self._shown[label] = text
+            label.config(text=text)
+
+    def update_frame(self):
+        # Take everything that's waiting, only the newest one matters
+        for _ in range(self.max_batch):
+            try:
+                self.latest = self.data_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        now = time.monotonic()
+        if self.latest is not None:
+            if self.session_start is None:
+                self.session_start = self.latest["_received"]
+            for key, label, fmt in self.fields:
+                value = self.latest.get(key)
+                self._set(self.value_labels[key], fmt.format(value) if isinstance(value, (int, float)) else "--")
+
+            moving = self.latest.get("raw_elapsed_time", 0) or 0
+            if (self.latest.get("power") or 0) > 0 or (self.latest.get("cadence") or 0) > 0:
+                moving += now - self.latest["_received"]
+            self._set(self.moving_label, format_time(moving))
+            self._set(self.total_label, format_time(now - self.session_start))
+
+        if self.running:
+            self._set(self.time_label, format_time(self.elapsed_time + now - self.start_time))
+
+        self.frames += 1
+        self.root.after(self.frame_ms, self.update_frame)
+
+    def start_timer(self):
+        if not self.running:
+            self.running = True
+            self.start_time = time.monotonic()
+
+    def stop_timer(self):
+        if self.running:
+            self.elapsed_time += time.monotonic() - self.start_time
+            self.running = False
+
+    def reset_timer(self):
+        self.running = False
+        self.elapsed_time = 0
+        self._set(self.time_label, "00:00:00.00")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ride dashboard")
+    parser.add_argument("--simulate", metavar="PROFILE", default=trainer_data.simulate,
+                        help="use simulated devices: steady, intervals, ramp, rider, or a session .jsonl to play back")
+    parser.add_argument("--sim-speed", type=float, default=trainer_data.sim_speed)
+    parser.add_argument("--rider", default=trainer_data.rider, help="rider profile to use")
+    parser.add_argument("--course", default=trainer_data.course_file, help="route file to ride")
+    parser.add_argument("--fps", type=float, default=20, help="max redraws per second")
+    args = parser.parse_args()
+
+    trainer_data.simulate = args.simulate
+    trainer_data.sim_speed = args.sim_speed
+    trainer_data.rider = args.rider
+    if args.rider and args.rider not in get_store(trainer_data.user_profile).names():
+        parser.error(f"no rider profile called {args.rider}, set it up with connect_profile.py --rider {args.rider}")
+    trainer_data.course_file = args.course
+    trainer_data.use_dashboard = False  # The GUI is the display
+
+    data_queue = queue.Queue(maxsize=100)
+    ride = RideThread(data_queue, send_rate=args.fps)
+    ride.start()
+
+    root = tk.Tk()
+    app = RideDashboard(root, data_queue, fps=args.fps)
+
+    def on_close():
+        ride.stop()
+        root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
+    root.mainloop()
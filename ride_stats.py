@@ -0,0 +1,223 @@
+import json
+import os
+import time
+from collections import deque
+
+'''
+Running statistics for the whole ride. The old save_max started from empty dicts on every call, so the "max" and
+"average" were really just the current snapshot. This keeps proper session values, and every update is O(1) per key
+(the rolling windows are amortised O(1), each sample gets added and removed once).
+
+Averages are time weighted, using the gap since the previous update, so they stay correct whether the loop runs at
+10 Hz, runs irregularly, or gets driven per sample. Gaps longer than max_gap (dropouts, pauses) are capped so they
+don't swamp the average.
+
+The whole state can be dumped to a dict and loaded back in, so if the script dies mid ride the stats can pick up from
+the last checkpoint rather than replaying the session log.
+'''
+
+
+# Time based rolling average. Keeps the samples inside the window and a running sum.
+class RollingAverage:
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.total = 0.0
+
+    def add(self, timestamp, value):
+        self.samples.append((timestamp, value))
+        self.total += value
+        # Drop anything that has fallen out of the window
+        while self.samples and timestamp - self.samples[0][0] > self.window:
+            self.total -= self.samples.popleft()[1]
+
+    # True once the window has a full window's worth of history in it
+    def is_full(self, timestamp):
+        return bool(self.samples) and timestamp - self.samples[0][0] >= self.window * 0.99
+
+    @property
+    def value(self):
+        return self.total / len(self.samples) if self.samples else 0.0
+
+    def state(self):
+        return {"window": self.window, "samples": list(self.samples)}
+
+    @classmethod
+    def from_state(cls, state):
+        rolling = cls(state["window"])
+        for timestamp, value in state["samples"]:
+            rolling.samples.append((timestamp, value))
+            rolling.total += value
+        return rolling
+
+
+# Stats for a single key
+class KeyStats:
+    def __init__(self):
+        self.count = 0
+        self.max = float("-inf")
+        self.last = 0.0
+        self.weighted_sum = 0.0
+        self.weight = 0.0
+        self.moving_sum = 0.0
+        self.moving_weight = 0.0
+        self.rolling_3s = RollingAverage(3)
+        self.rolling_30s = RollingAverage(30)
+
+    def add(self, timestamp, value, dt, moving):
+        self.count += 1
+        self.last = value
+        if value > self.max:
+            self.max = value
+        self.weighted_sum += value * dt
+        self.weight += dt
+        if moving:
+            self.moving_sum += value * dt
+            self.moving_weight += dt
+        self.rolling_3s.add(timestamp, value)
+        self.rolling_30s.add(timestamp, value)
+
+    @property
+    def mean(self):
+        return self.weighted_sum / self.weight if self.weight > 0 else self.last
+
+    @property
+    def moving_mean(self):
+        return self.moving_sum / self.moving_weight if self.moving_weight > 0 else 0.0
+
+    def state(self):
+        return {
+            "count": self.count,
+            "max": self.max,
+            "last": self.last,
+            "weighted_sum": self.weighted_sum,
+            "weight": self.weight,
+            "moving_sum": self.moving_sum,
+            "moving_weight": self.moving_weight,
+            "rolling_3s": self.rolling_3s.state(),
+            "rolling_30s": self.rolling_30s.state(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls()
+        for field in ("count", "max", "last", "weighted_sum", "weight", "moving_sum", "moving_weight"):
+            setattr(stats, field, state[field])
+        stats.rolling_3s = RollingAverage.from_state(state["rolling_3s"])
+        stats.rolling_30s = RollingAverage.from_state(state["rolling_30s"])
+        return stats
+
+
+class RideStats:
+    def __init__(self, power_key="power", max_gap=5.0):
+        self.power_key = power_key
+        self.max_gap = max_gap
+        self.keys = {}
+        self.last_update = None
+        self.duration = 0.0
+        self.moving_time = 0.0
+
+        # Normalized power. 4th power of the 30s rolling average, time weighted, once the window has filled up
+        self.np_sum = 0.0
+        self.np_weight = 0.0
+
+    # Feed in the current values. Anything numeric gets tracked, strings (the timers) and None are skipped.
+    def update(self, shared_data, debug_data=None, timestamp=None, moving=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        dt = 0.0
+        if self.last_update is not None:
+            dt = min(max(timestamp - self.last_update, 0.0), self.max_gap)
+        self.last_update = timestamp
+
+        # Work out if we're moving the same way the elapsed timer does, if the caller hasn't told us
+        if moving is None:
+            moving = (shared_data.get("power") or 0) > 0 or (shared_data.get("cadence") or 0) > 0
+
+        self.duration += dt
+        if moving:
+            self.moving_time += dt
+
+        for source in (shared_data, debug_data or {}):
+            for key, value in source.items():
+                # bool is a subclass of int, but averaging flags doesn't mean anything
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stats = self.keys.get(key)
+                    if stats is None:
+                        stats = self.keys[key] = KeyStats()
+                    stats.add(timestamp, value, dt, moving)
+
+        power_stats = self.keys.get(self.power_key)
+        if power_stats is not None and power_stats.rolling_30s.is_full(timestamp):
+            self.np_sum += power_stats.rolling_30s.value ** 4 * dt
+            self.np_weight += dt
+
+    @property
+    def normalized_power(self):
+        if self.np_weight > 0:
+            return (self.np_sum / self.np_weight) ** 0.25
+        # Less than 30s of riding, fall back to the plain average
+        power_stats = self.keys.get(self.power_key)
+        return power_stats.mean if power_stats else 0.0
+
+    # Summary for the max_values file. Keeps the old max/avg layout so anything reading the file still works.
+    def summary(self):
+        return {
+            "max_values": {key: stats.max for key, stats in self.keys.items()},
+            "avg_values": {key: stats.mean for key, stats in self.keys.items()},
+            "moving_avg_values": {key: stats.moving_mean for key, stats in self.keys.items()},
+            "rolling_3s": {key: stats.rolling_3s.value for key, stats in self.keys.items()},
+            "rolling_30s": {key: stats.rolling_30s.value for key, stats in self.keys.items()},
+            "normalized_power": self.normalized_power,
+            "duration": self.duration,
+            "moving_time": self.moving_time,
+        }
+
+    def state(self):
+        return {
+            "power_key": self.power_key,
+            "max_gap": self.max_gap,
+            "last_update": self.last_update,
+            "duration": self.duration,
+            "moving_time": self.moving_time,
+            "np_sum": self.np_sum,
+            "np_weight": self.np_weight,
+            "keys": {key: stats.state() for key, stats in self.keys.items()},
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls(power_key=state["power_key"], max_gap=state["max_gap"])
+        stats.last_update = state["last_update"]
+        stats.duration = state["duration"]
+        stats.moving_time = state["moving_time"]
+        stats.np_sum = state["np_sum"]
+        stats.np_weight = state["np_weight"]
+        stats.keys = {key: KeyStats.from_state(key_state) for key, key_state in state["keys"].items()}
+        return stats
+
+
+# Summary plus the saved state, in one dict, for the session recorder to write at each checkpoint. The "finished"
+# flag gets set at the end of the session so a finished ride doesn't get resumed the next time the script starts.
+def stats_checkpoint(stats, finished=False):
+    checkpoint = stats.summary()
+    checkpoint["finished"] = finished
+    checkpoint["state"] = stats.state()
+    return checkpoint
+
+
+# Pick the stats back up from the last checkpoint if the previous session didn't finish properly, otherwise start fresh
+def resume_stats(file_name="max_values.json", max_age=600):
+    if os.path.exists(file_name):
+        try:
+            with open(file_name, "r") as f:
+                checkpoint = json.load(f)
+            state = checkpoint.get("state")
+            if state and not checkpoint.get("finished", True):
+                # Only resume if the crash was recent, an old unfinished file is from a different ride
+                if state["last_update"] and time.time() - state["last_update"] < max_age:
+                    return RideStats.from_state(state), True
+        except (json.JSONDecodeError, KeyError, TypeError):
+            pass
+    return RideStats(), False
@@ -0,0 +1,135 @@
+import time
+from array import array
+
+'''
+Timestamped sample store. The notification handlers used to just overwrite keys in shared_data, so anything arriving
+between two loop ticks was lost and nothing had a timestamp. Every sample now goes into a fixed size ring buffer per
+channel as well, with the monotonic time it arrived.
+
+The buffers are plain arrays of doubles, allocated once, so the memory used is the same after 6 hours as it is after
+6 seconds. Once a buffer is full the oldest samples get overwritten.
+'''
+
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.count = 0  # Number of valid samples, up to capacity
+        self.total = 0  # Number of samples ever appended
+        self._next = 0  # Where the next sample goes
+
+    def append(self, timestamp, value):
+        i = self._next
+        self.timestamps[i] = timestamp
+        self.values[i] = value
+        self._next = i + 1 if i + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+        self.total += 1
+
+    def __len__(self):
+        return self.count
+
+    # Physical index of the newest sample
+    @property
+    def head(self):
+        return self._next - 1 if self._next else self.capacity - 1
+
+    # Newest (timestamp, value), or None if nothing has arrived yet
+    def latest(self):
+        if not self.count:
+            return None
+        i = self.head
+        return self.timestamps[i], self.values[i]
+
+    # Maps a logical index (0 is the oldest sample still held) to the physical index in the arrays
+    def _physical(self, logical):
+        return (self._next - self.count + logical) % self.capacity
+
+    # Logical index of the first sample at or after timestamp. Binary search, timestamps only ever go up.
+    def _find(self, timestamp):
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.timestamps[self._physical(mid)] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    # Copies out the samples between start and end (inclusive) in time order, as two arrays. At most two slices are
+    # needed, one for each side of the wrap.
+    def slice(self, start=None, end=None):
+        first = self._find(start) if start is not None else 0
+        last = self._find(end) if end is not None else self.count
+        if end is not None:
+            # Include samples exactly on the end time
+            while last < self.count and self.timestamps[self._physical(last)] == end:
+                last += 1
+        if last <= first:
+            return array("d"), array("d")
+
+        a = self._physical(first)
+        b = self._physical(last - 1) + 1
+        if a < b:
+            return self.timestamps[a:b], self.values[a:b]
+        return self.timestamps[a:] + self.timestamps[:b], self.values[a:] + self.values[:b]
+
+    # The last `seconds` worth of samples, counting back from now (or from the newest sample)
+    def window(self, seconds, now=None):
+        if not self.count:
+            return array("d"), array("d")
+        if now is None:
+            now = self.timestamps[self.head]
+        return self.slice(now - seconds, now)
+
+
+# Read only view of the newest sample in a buffer. Nothing gets copied, it reads straight out of the arrays.
+class LatestView:
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    @property
+    def value(self):
+        if not self._buffer.count:
+            return None
+        return self._buffer.values[self._buffer.head]
+
+    @property
+    def timestamp(self):
+        if not self._buffer.count:
+            return None
+        return self._buffer.timestamps[self._buffer.head]
+
+    # Seconds since the newest sample arrived
+    def age(self, now=None):
+        if not self._buffer.count:
+            return None
+        return (now if now is not None else time.monotonic()) - self._buffer.timestamps[self._buffer.head]
+
+
+class SampleStore:
+    # Channels the notification handlers write to. Capacity is per channel, 4096 is about 17 minutes at 4 Hz or
+    # 40 seconds at 100 Hz, which is plenty for the rolling windows.
+    default_channels = ("power", "cadence", "t_speed", "heart_rate")
+
+    def __init__(self, channels=default_channels, capacity=4096):
+        self.buffers = {channel: RingBuffer(capacity) for channel in channels}
+        self.latest = {channel: LatestView(buffer) for channel, buffer in self.buffers.items()}
+
+    # Add a sample. Anything that isn't a number (e.g. a missing heart rate) is skipped.
+    def append(self, channel, value, timestamp=None):
+        if value is None:
+            return
+        buffer = self.buffers.get(channel)
+        if buffer is None:
+            return
+        buffer.append(time.monotonic() if timestamp is None else timestamp, value)
+
+    def window(self, channel, seconds, now=None):
+        return self.buffers[channel].window(seconds, now)
+
+    def slice(self, channel, start=None, end=None):
+        return self.buffers[channel].slice(start, end)
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Session recorder. This replaces the old approach of rewriting max_values.json every tick, which was about 36,000 full
+file rewrites an hour, all of them blocking on the same loop that handles the bluetooth notifications.
+
+Samples get appended to a JSON lines log (one compact line per sample, with a timestamp), and the lines are batched up
+in memory and handed off to a single background thread to write. Using one worker thread keeps the batches in order
+without needing any locking. The summary file is only written at the checkpoint interval and once at the end.
+
+Exporters (like the TCX writer) get every sample too. They format their own output on the loop and hand it over in
+chunks at each flush, so their writes go through the same thread, in order with everything else.
+'''
+
+
+class SessionRecorder:
+    def __init__(self, log_dir="sessions", summary_file="max_values.json", summary_fn=None, batch_size=50,
+                 flush_interval=2.0, checkpoint_interval=60.0, exporters=(), session_name=None, clock=None):
+        # Several riders starting in the same second need their own names, so it can be given
+        self.session_name = session_name or time.strftime("session_%Y%m%d_%H%M%S")
+        self.log_dir = log_dir
+        self.log_path = os.path.join(log_dir, self.session_name + ".jsonl")
+        self.summary_file = summary_file
+        self.summary_fn = summary_fn  # Called on the loop, returns a dict to dump into the summary file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.checkpoint_interval = checkpoint_interval  # None means only write the summary at the end
+        self.clock = clock or time.monotonic  # The session's clock, for the checkpoint interval
+        self.exporters = list(exporters)  # Anything with add(sample), take(), write(chunk), summary() and close()
+
+        self.samples_recorded = 0
+        self.bytes_written = 0
+
+        self._pending = []
+        self._file = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._last_flush = time.monotonic()
+        self._last_checkpoint = self.clock()
+        self._closed = False
+
+    # Add a sample to the pending batch. This is the only thing that runs every tick, so it has to stay cheap.
+    def record(self, shared_data, debug_data=None, timestamp=None):
+        if self._closed:
+            return
+
+        sample = {"t": round(timestamp if timestamp is not None else time.time(), 3)}
+        for source in (shared_data, debug_data or {}):
+            for key, value in source.items():
+                if value is None or isinstance(value, (int, float, str, bool)):
+                    sample[key] = value
+
+        self._pending.append(json.dumps(sample, separators=(",", ":")))
+        self.samples_recorded += 1
+        for exporter in self.exporters:
+            exporter.add(sample)
+
+        now = time.monotonic()
+        if len(self._pending) >= self.batch_size or now - self._last_flush >= self.flush_interval:
+            self.flush()
+
+        if self.checkpoint_interval and self.clock() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    # Hand the pending lines over to the writer thread. Doesn't wait for the write to finish.
+    def flush(self):
+        self._last_flush = time.monotonic()
+        for exporter in self.exporters:
+            chunk = exporter.take()
+            if chunk:
+                self._executor.submit(exporter.write, chunk)
+        if not self._pending:
+            return None
+        lines, self._pending = self._pending, []
+        return self._executor.submit(self._write_lines, lines)
+
+    # Write the summary file. The summary itself is built here on the calling thread, so that the live dicts aren't
+    # being read from another thread while the loop is changing them. Only the dump happens in the background.
+    def checkpoint(self):
+        self._last_checkpoint = self.clock()
+        if self.summary_fn is None or not self.summary_file:
+            return None
+        summary = self.summary_fn()
+        return self._executor.submit(self._write_summary, summary)
+
+    # Flush what's left, write the final summary and shut the writer thread down.
+    async def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self.checkpoint()
+        for exporter in self.exporters:
+            self._executor.submit(exporter.close, exporter.summary())
+        self._closed = True
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_file)
+        self._executor.shutdown(wait=True)
+
+    # Everything below here runs on the writer thread
+    def _write_lines(self, lines):
+        if self._file is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            self._file = open(self.log_path, "a", encoding="utf-8")
+        chunk = "\n".join(lines) + "\n"
+        self._file.write(chunk)
+        self._file.flush()
+        self.bytes_written += len(chunk)
+
+    def _write_summary(self, summary):
+        # Write to a temp file and swap it in, so a crash mid-write doesn't leave a half written summary behind
+        temp_file = self.summary_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=4)
+        os.replace(temp_file, self.summary_file)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,165 @@
+import argparse
+import math
+import multiprocessing
+import sys
+import time
+from multiprocessing import shared_memory
+
+'''
+Sample ring in shared memory, for handing samples from the bluetooth process to the worker process without pickling
+or a pipe in between (see split_process.py).
+
+Each record is a fixed row of doubles: the time it arrived, the channel, then one slot for each field. Fields that
+aren't in a sample are left as NaN. The header holds the number of records ever written and a stop flag.
+
+There's one writer and one reader. The writer never waits: it fills in the next row and then bumps the count, so the
+reader never sees a half written row that's newer than the count. If the reader falls more than a ring's worth behind,
+the oldest rows get overwritten and are counted as dropped, the same as the pipeline queue does. A row that gets
+overwritten while it's being copied out is caught by checking the count again afterwards.
+
+Self check, a writer process against a reader here:
+    python shared_ring.py --check
+'''
+
+channels = ("tick", "trainer", "hrm", "status")
+fields = ("power", "cadence", "t_speed", "heart_rate", "rmssd", "current_resistance", "trainer_connected",
+          "hrm_connected")
+
+# Which fields go with which channel, so a missing value can come back as None rather than just not being there
+channel_fields = {
+    "tick": (),
+    "trainer": ("power", "cadence", "t_speed"),
+    "hrm": ("heart_rate", "rmssd"),
+    "status": ("current_resistance", "trainer_connected", "hrm_connected"),
+}
+
+_channel_ids = {name: index for index, name in enumerate(channels)}
+_field_slots = {name: index + 2 for index, name in enumerate(fields)}
+_row = len(fields) + 2  # Doubles per record
+_header = 16  # Written count and stop flag, 8 bytes each
+
+
+class SharedSampleRing:
+    def __init__(self, capacity=4096, name=None):
+        self.capacity = capacity
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=_header + 8 * _row * capacity)
+            self.owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self._header = self._shm.buf[:_header].cast("Q")
+        self._rows = self._shm.buf[_header:_header + 8 * _row * capacity].cast("d")
+        self._read = 0
+        self.samples_dropped = 0
+
+    # What the other process needs to attach to it
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def written(self):
+        return self._header[0]
+
+    # Writer side. Same call as SamplePipeline.push, so init_ftms can push straight into the ring.
+    def push(self, channel, values, timestamp=None):
+        seq = self._header[0]
+        base = (seq % self.capacity) * _row
+        rows = self._rows
+        rows[base] = time.monotonic() if timestamp is None else timestamp
+        rows[base + 1] = _channel_ids[channel]
+        for slot in range(base + 2, base + _row):
+            rows[slot] = math.nan
+        if values:
+            for key, value in values.items():
+                slot = _field_slots.get(key)
+                if slot is not None and value is not None:
+                    rows[base + slot] = value
+        self._header[0] = seq + 1  # Only now is the row there for the reader
+
+    # Reader side. Everything written since the last read, oldest first, as (channel, values, timestamp).
+    def read(self, limit=None):
+        written = self._header[0]
+        if written - self._read > self.capacity:
+            self.samples_dropped += written - self._read - self.capacity
+            self._read = written - self.capacity
+        end = written if limit is None else min(written, self._read + limit)
+
+        samples = []
+        rows = self._rows
+        for seq in range(self._read, end):
+            base = (seq % self.capacity) * _row
+            record = rows[base:base + _row].tolist()
+            if self._header[0] - seq >= self.capacity:
+                self.samples_dropped += 1  # The writer got to this row while it was being copied
+                continue
+            channel = channels[int(record[1])]
+            values = {}
+            for key in channel_fields[channel]:
+                value = record[_field_slots[key]]
+                values[key] = None if value != value else value  # NaN is missing
+            samples.append((channel, values or None, record[0]))
+        self._read = end
+        return samples
+
+    @property
+    def stopping(self):
+        return bool(self._header[1])
+
+    def stop(self):
+        self._header[1] = 1
+
+    # The memoryviews have to go before the block can be closed
+    def close(self):
+        self._header.release()
+        self._rows.release()
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+
+def _check_writer(name, capacity, count):
+    ring = SharedSampleRing(capacity, name)
+    for index in range(count):
+        ring.push("trainer", {"power": float(index), "cadence": 90.0}, float(index))
+        if index % 100 == 0:
+            time.sleep(0.001)
+    ring.close()
+
+
+# A writer process pushes numbered samples while the reader here reads them. Every sample read has to be in order and
+# whole, and every sample written either read or counted as dropped.
+def self_check(count=200000, capacity=1024):
+    ring = SharedSampleRing(capacity)
+    writer = multiprocessing.get_context("spawn").Process(target=_check_writer, args=(ring.name, capacity, count))
+    started = time.monotonic()
+    writer.start()
+
+    received = 0
+    last = -1.0
+    ok = True
+    while writer.is_alive() or ring.written > ring._read:
+        for channel, values, timestamp in ring.read():
+            if channel != "trainer" or values["power"] != timestamp or values["cadence"] != 90.0 or timestamp <= last:
+                ok = False
+            last = timestamp
+            received += 1
+        time.sleep(0.0005)
+    writer.join()
+    elapsed = time.monotonic() - started
+
+    ok = ok and received + ring.samples_dropped == count and last == count - 1
+    print(f"{count} written, {received} read, {ring.samples_dropped} dropped, {count / elapsed:.0f} samples/s")
+    ring.close()
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared memory sample ring")
+    parser.add_argument("--check", action="store_true", help="run the writer/reader self check")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if self_check() else 1)
+    parser.print_help()
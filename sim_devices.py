@@ -0,0 +1,353 @@
+import asyncio
+import json
+import math
+import time
+from collections import namedtuple
+
+'''
+Simulated trainer and heart rate monitor, so the whole thing can be run without a Kickr and a chest strap plugged in.
+The simulated clients stand in for BleakClient, and the trainer hands out a stand in for pycycling's
+FitnessMachineService, with the same method names that trainer_data.py and connect_profile.py use.
+
+The trainer sends indoor bike data and the HRM sends 0x2A37 heart rate notifications, at whatever rates are set. The
+numbers come from a synthetic profile, or from a recorded session log. speed scales the simulated time, so 100 makes
+an hour of riding go by in 36 seconds.
+
+Profiles:
+    steady    - constant power and cadence
+    intervals - 4 minutes hard, 2 minutes easy, repeated
+    ramp      - power goes up 20W every minute
+    rider     - fixed cadence, and the power comes from the resistance / target power the trainer is told to use,
+                like a real trainer would. For testing the control side of things.
+    a path    - anything ending in .jsonl is played back from a session log
+'''
+
+# Shaped like pycycling's namedtuples, with the fields the scripts actually read
+IndoorBikeData = namedtuple("IndoorBikeData", ["instant_speed", "instant_cadence", "instant_power", "resistance_level"])
+FitnessMachineFeatures = namedtuple("FitnessMachineFeatures", [
+    "avg_speed_supported", "cadence_supported", "total_distance_supported", "inclination_supported",
+    "resistance_level_supported", "heart_rate_measurement_supported", "power_measurement_supported",
+])
+TargetSettingFeatures = namedtuple("TargetSettingFeatures", [
+    "speed_target_setting_supported", "inclination_target_setting_supported", "resistance_target_setting_supported",
+    "power_target_setting_supported", "indoor_bike_simulation_parameters_supported",
+])
+SupportedResistanceLevelRange = namedtuple("SupportedResistanceLevelRange",
+                                           ["minimum_resistance", "maximum_resistance", "minimum_increment"])
+SupportedPowerRange = namedtuple("SupportedPowerRange", ["minimum_power", "maximum_power", "minimum_increment"])
+ControlPointResponse = namedtuple("ControlPointResponse",
+                                  ["request_code_enum", "result_code_enum", "response_parameter"])
+
+HEART_RATE_MEASUREMENT = "00002a37-0000-1000-8000-00805f9b34fb"
+FIRMWARE_REVISION = "00002a26-0000-1000-8000-00805f9b34fb"
+
+
+# Simulated time. Starts when the first device connects and runs `speed` times faster than the wall clock. A session
+# with simulated devices runs on this too (see session_clock() in trainer_data.py), so --sim-speed speeds the whole
+# session up and not just the devices. It pickles, and time.monotonic() is the same in every process, so a copy in
+# another process keeps the same time.
+class SimClock:
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.start = None
+        self.epoch = None
+
+    def now(self):
+        if self.start is None:
+            self.start = time.monotonic()
+            self.epoch = time.time()
+        return (time.monotonic() - self.start) * self.speed
+
+    # Simulated seconds since the epoch, like time.time(), for timestamps. Starts from the real time it started at
+    def time(self):
+        elapsed = self.now()
+        return self.epoch + elapsed
+
+    # Real seconds to sleep for a number of simulated seconds
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds / self.speed)
+
+
+# Power, cadence and heart rate as a function of simulated time
+class SyntheticProfile:
+    def __init__(self, name="steady", power=180, cadence=90):
+        self.name = name
+        self.power = power
+        self.cadence = cadence
+
+    def __call__(self, t):
+        if self.name == "intervals":
+            power = self.power * (1.4 if t % 360 < 240 else 0.6)
+        elif self.name == "ramp":
+            power = 100 + 20 * int(t // 60)
+        else:
+            # A little wobble on top, real power is never perfectly flat
+            power = self.power + 5 * math.sin(t * 2.1)
+        return {"power": power, "cadence": self.cadence + 2 * math.sin(t * 0.7)}
+
+
+# Plays a recorded session log back. Samples are looked up by time, holding the last value between samples.
+class RecordedProfile:
+    def __init__(self, file_name):
+        self.samples = []
+        with open(file_name, "r") as f:
+            start = None
+            for line in f:
+                if not line.strip():
+                    continue
+                sample = json.loads(line)
+                start = sample["t"] if start is None else start
+                self.samples.append((sample["t"] - start, sample))
+        self._index = 0
+
+    def __call__(self, t):
+        # Times only go forwards, so carry on from where the last lookup got to
+        while self._index + 1 < len(self.samples) and self.samples[self._index + 1][0] <= t:
+            self._index += 1
+        sample = self.samples[self._index][1] if self.samples else {}
+        return {
+            "power": sample.get("power") or 0,
+            "cadence": sample.get("cadence") or 0,
+            "speed": sample.get("t_speed"),
+            "heart_rate": sample.get("heart_rate"),
+        }
+
+    @property
+    def duration(self):
+        return self.samples[-1][0] if self.samples else 0
+
+
+def make_profile(name, power=180, cadence=90):
+    if name.endswith(".jsonl"):
+        return RecordedProfile(name)
+    return SyntheticProfile(name, power, cadence)
+
+
+# Stand in for pycycling's FitnessMachineService
+class SimulatedFTMS:
+    def __init__(self, trainer):
+        self.trainer = trainer
+        self._bike_data_handler = None
+        self._control_point_handler = None
+        self.has_control = False
+        self.commands = []  # Every control point write, for checking what got sent
+
+    def set_indoor_bike_data_handler(self, callback):
+        self._bike_data_handler = callback
+
+    def set_control_point_response_handler(self, callback):
+        self._control_point_handler = callback
+
+    async def enable_indoor_bike_data_notify(self):
+        self.trainer.start_streaming(self)
+
+    async def disable_indoor_bike_data_notify(self):
+        self.trainer.stop_streaming()
+
+    async def enable_control_point_indicate(self):
+        pass
+
+    async def get_fitness_machine_feature(self):
+        return self.trainer.features, self.trainer.target_features
+
+    async def get_supported_resistance_level_range(self):
+        return self.trainer.resistance_range
+
+    async def get_supported_power_range(self):
+        return self.trainer.power_range
+
+    # Control point writes. The response comes back a little later, like the indication would.
+    def _respond(self, op_code, result=0x01):
+        self.commands.append(op_code)
+        if self._control_point_handler is not None:
+            response = ControlPointResponse(op_code, result, None)
+            asyncio.get_running_loop().call_later(self.trainer.response_delay, self._control_point_handler, response)
+
+    async def request_control(self):
+        self.has_control = True
+        self._respond(0x00)
+
+    async def reset(self):
+        self._respond(0x01)
+
+    async def set_target_resistance_level(self, level):
+        if not self.has_control:
+            return self._respond(0x04, 0x05)
+        self.trainer.resistance = level
+        self.trainer.target_power = None
+        self._respond(0x04)
+
+    async def set_target_power(self, power):
+        if not self.has_control:
+            return self._respond(0x05, 0x05)
+        self.trainer.target_power = power
+        self._respond(0x05)
+
+    def _notify(self, data):
+        if self._bike_data_handler is not None:
+            self._bike_data_handler(data)
+
+
+# Base for the simulated clients, covering the bits of BleakClient that get used
+class SimulatedClient:
+    simulated = True
+
+    def __init__(self, name, address, clock, rate):
+        self.name = name
+        self.address = address
+        self.clock = clock
+        self.rate = rate  # Notifications per simulated second
+        self.is_connected = False
+        self.disconnected_callback = None  # Same as BleakClient's, called with the client when it drops out
+        self._task = None
+
+    async def connect(self):
+        self.clock.now()
+        self.is_connected = True
+        return True
+
+    # Pretend the device dropped out. Notifications stop until it's connected and set up again.
+    def drop(self):
+        self.stop_streaming()
+        self.is_connected = False
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    async def disconnect(self):
+        self.stop_streaming()
+        self.is_connected = False
+        return True
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+    async def read_gatt_char(self, uuid):
+        if uuid == FIRMWARE_REVISION:
+            return bytearray(b"sim-1.0")
+        raise KeyError(f"Characteristic {uuid} not simulated")
+
+    def stop_streaming(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _stream(self, emit):
+        interval = 1.0 / self.rate
+        next_t = self.clock.now()
+        while self.is_connected:
+            emit(self.clock.now())
+            next_t += interval
+            await self.clock.sleep(max(0.0, next_t - self.clock.now()))
+
+
+class SimulatedTrainer(SimulatedClient):
+    def __init__(self, profile, clock, rate=4, name="Simulated Trainer", address="SIM:TRAINER", response_delay=0.02):
+        super().__init__(name, address, clock, rate)
+        self.profile = profile
+        self.response_delay = response_delay
+        self.resistance = 20
+        self.target_power = None
+        self.power = 0.0
+        self.last_sample = {}
+        self._last_t = None
+
+        self.features = FitnessMachineFeatures(True, True, True, False, True, False, True)
+        self.target_features = TargetSettingFeatures(False, False, True, True, True)
+        self.resistance_range = SupportedResistanceLevelRange(0, 1000, 10)  # In 0.1 steps, as FTMS has it
+        self.power_range = SupportedPowerRange(0, 2000, 1)
+
+    def create_ftms(self):
+        return SimulatedFTMS(self)
+
+    def start_streaming(self, ftms):
+        self.stop_streaming()
+        self._task = asyncio.create_task(self._stream(lambda t: ftms._notify(self.sample(t))))
+
+    # Rider profile power. The trainer settles towards the power the resistance (or target power) gives at this
+    # cadence, with a bit of lag like a real flywheel.
+    def _rider_power(self, t, cadence):
+        if self.target_power is not None:
+            target = self.target_power
+        else:
+            target = (20 + 3.5 * self.resistance) * cadence / 90
+        dt = 0.0 if self._last_t is None else t - self._last_t
+        self.power += (target - self.power) * min(1.0, dt / 1.0)
+        return self.power
+
+    def sample(self, t):
+        values = self.profile(t)
+        cadence = values.get("cadence") or 0
+        if getattr(self.profile, "name", None) == "rider":
+            power = self._rider_power(t, cadence)
+        else:
+            power = values.get("power") or 0
+        self._last_t = t
+
+        # Rough trainer wheel speed if the profile doesn't have one, a Kickr reads about 36 km/h at 200W
+        speed = values.get("speed")
+        if speed is None:
+            speed = 36 * (max(power, 0) / 200) ** (1 / 3)
+
+        self.last_sample = {"power": power, "cadence": cadence, "speed": speed}
+        return IndoorBikeData(speed, cadence, int(power), self.resistance)
+
+
+class SimulatedHRM(SimulatedClient):
+    def __init__(self, trainer, clock, rate=1, name="Simulated HRM", address="SIM:HRM", resting=60):
+        super().__init__(name, address, clock, rate)
+        self.trainer = trainer
+        self.heart_rate = resting
+        self.resting = resting
+        self._last_beat = None
+
+    async def start_notify(self, uuid, callback):
+        if uuid != HEART_RATE_MEASUREMENT:
+            raise KeyError(f"Characteristic {uuid} not simulated")
+        self.stop_streaming()
+        self._task = asyncio.create_task(self._stream(lambda t: callback(uuid, self.measurement(t))))
+
+    async def stop_notify(self, uuid):
+        self.stop_streaming()
+
+    # Heart rate follows the recording if there is one, otherwise drifts towards a level set by the trainer's power
+    def measurement(self, t):
+        recorded = self.trainer.profile(t).get("heart_rate")
+        if recorded:
+            self.heart_rate = recorded
+        else:
+            target = self.resting + 0.45 * self.trainer.last_sample.get("power", 0)
+            self.heart_rate += (target - self.heart_rate) * 0.05
+        heart_rate = int(round(self.heart_rate))
+
+        # Contact supported and detected, and RR intervals for every beat since the last packet. The beat to beat
+        # time wobbles a little with breathing, like a real heart.
+        flags = 0x16
+        payload = bytearray()
+        if heart_rate > 255:
+            # Flags bit 0 set, 16 bit heart rate
+            flags |= 0x01
+            payload += bytes([heart_rate & 0xFF, heart_rate >> 8])
+        else:
+            payload.append(heart_rate)
+        if self._last_beat is None:
+            self._last_beat = t
+        while self._last_beat < t:
+            rr = 60 / max(self.heart_rate, 30) * (1 + 0.04 * math.sin(self._last_beat * 1.3))
+            self._last_beat += rr
+            payload += int(rr * 1024).to_bytes(2, "little")
+        return bytearray([flags]) + payload
+
+
+# Builds the simulated devices, in the same shape device_connection() returns them
+def create_simulated_clients(profile="steady", speed=1.0, trainer_rate=4, hrm_rate=1, power=180, cadence=90,
+                             with_hrm=True):
+    clock = SimClock(speed)
+    trainer = SimulatedTrainer(make_profile(profile, power, cadence), clock, rate=trainer_rate)
+    clients = {"trainer": trainer}
+    if with_hrm:
+        clients["hrm"] = SimulatedHRM(trainer, clock, rate=hrm_rate)
+    return clients
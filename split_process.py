@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+
+from connection_supervisor import ConnectionSupervisor, device_values
+from course import load_course
+from dashboard import TerminalDashboard
+from erg import ErgController
+from ftms_capabilities import get_capabilities, resistance_limits
+from latency import get_monitor
+from physics import RiderCoefficients, VirtualBike
+from pipeline import SamplePipeline
+from profile_store import get_store
+from ride_stats import resume_stats, stats_checkpoint
+from sample_store import SampleStore
+from session_recorder import SessionRecorder
+from shared_ring import SharedSampleRing
+from sim_devices import create_simulated_clients
+from tcx_export import TcxWriter
+from trainer_control import TrainerController
+import trainer_data
+
+'''
+Two process mode. In trainer_data.main() the physics, the stats, the dashboard and the session log all run on the same
+loop that the bluetooth callbacks come in on, so a slow disk or the ride analysis at a checkpoint holds up the
+notifications behind it.
+
+Here the process you start only does the bluetooth side: it owns the BleakClients (and the supervisor, the trainer
+controller and ERG, which need to be close to the trainer), and the notification handlers write each sample into a
+ring in shared memory (shared_ring.py) and go straight back to waiting. A worker process reads the ring and does
+everything else the same way main() does it: derived_information, the course, the stats, the session log, the TCX file,
+the dashboard and the analysis at the end.
+
+Going the other way, the worker sends the resistance it wants down a pipe, and the bluetooth process hands it to the
+trainer controller. Every status_interval the bluetooth process also puts a status record in the ring with the
+resistance the trainer confirmed and whether each device is connected, so the worker can clear the values of a
+device that has dropped out, the same as the supervisor does in main().
+
+The latency stats are split too. <session>.io.latency.json has the notification intervals (the jitter this is meant to
+keep down) and the control point times, <session>.latency.json has notify_to_process and notify_to_render, which are
+measured across the two processes as they're on the same monotonic clock.
+
+    python split_process.py
+    python split_process.py --simulate rider --sim-speed 10
+'''
+
+# Initialising variables and settings
+ring_capacity = 4096  # Samples the ring holds, about 17 minutes at 4 Hz, so the worker would have to stall a long time
+poll_interval = 0.02  # Seconds between the worker reading the ring, and the bluetooth process reading the pipe
+status_interval = 0.5  # Seconds between status records
+join_timeout = 60  # Seconds to wait for the worker to save everything at the end
+
+# trainer_data settings the worker needs. It's a fresh process, so it has the defaults until these are copied over.
+worker_settings = ("debug", "user_profile", "rider", "session_dir", "checkpoint_interval", "summary_file", "export_tcx",
+                   "analyse_ride", "display_rate", "use_dashboard", "storage_rate", "resistance_rate", "course_file",
+                   "course_loop", "erg_power")
+
+
+# The worker process. Everything in here is main() from the sample pipeline on, with the ring in place of the
+# notification handlers.
+async def run_worker(ring, control, session_name, sim_clock=None):
+    shared_data, settings, debug_data = trainer_data.init_shared_data(trainer_data.user_profile, trainer_data.rider)
+
+    stats, resumed = resume_stats(trainer_data.summary_file)
+    if resumed:
+        print("Resuming ride stats from the last checkpoint.")
+    recorder = SessionRecorder(
+        log_dir=trainer_data.session_dir,
+        summary_file=trainer_data.summary_file,
+        summary_fn=lambda: stats_checkpoint(stats),
+        checkpoint_interval=trainer_data.checkpoint_interval,
+        session_name=session_name,
+        clock=sim_clock.now if sim_clock else time.monotonic,
+    )
+    if trainer_data.export_tcx:
+        recorder.exporters.append(TcxWriter(os.path.splitext(recorder.log_path)[0] + ".tcx"))
+
+    elapsed_start_time = None
+    is_moving = False
+    session_time = sim_clock.time if sim_clock else time.time
+    session_start_time = session_time()
+    bike = VirtualBike(RiderCoefficients.from_profile(settings["physics"]))
+
+    course = None
+    course_resistance = settings["base_resistance"]
+    if trainer_data.course_file:
+        course = load_course(trainer_data.course_file, settings["base_resistance"], settings["difficulty"],
+                             trainer_data.course_loop)
+        print(f"Course loaded: {course.name}, {course.length / 1000:.1f}km")
+    if trainer_data.erg_power:
+        shared_data["erg_target"] = trainer_data.erg_power
+
+    monitor = get_monitor()
+    sample_store = SampleStore()
+
+    def process_sample(sample):
+        nonlocal elapsed_start_time, is_moving, course_resistance
+        if sample.values:
+            monitor.since("notify_to_process", sample.timestamp)
+        trainer_data.apply_sample(shared_data, debug_data, sample)
+        if course:
+            course_resistance = trainer_data.course_position(shared_data, course, bike.distance)
+        elapsed_start_time, is_moving = trainer_data.derived_information(
+            shared_data, debug_data, elapsed_start_time, is_moving, session_start_time, bike=bike,
+            now=session_time() if sim_clock else None)
+
+    def store_sample():
+        timestamp = session_time()
+        stats.update(shared_data, debug_data, timestamp=timestamp, moving=is_moving)
+        recorder.record(shared_data, debug_data, timestamp=timestamp)
+
+    # No keys here, the worker doesn't get the terminal's input
+    dashboard = TerminalDashboard(rate=trainer_data.display_rate, show_debug=trainer_data.debug) \
+        if trainer_data.use_dashboard else None
+
+    def display_sample():
+        age = sample_store.latest["power"].age()
+        if age is not None:
+            debug_data["render_lag_ms"] = age * 1000
+        if dashboard:
+            rendered = dashboard.render(shared_data, debug_data)
+        else:
+            trainer_data.print_data(shared_data, debug_data, "raw_elapsed_time", debug=True)
+            rendered = True
+        if rendered:
+            monitor.record("notify_to_render", age)
+
+    # In ERG mode the bluetooth process runs the controller, so there's nothing to send
+    last_sent = None
+
+    def update_resistance():
+        nonlocal last_sent
+        shared_data["c_resistance"] = shared_data.get("current_resistance", settings["base_resistance"])
+        if not trainer_data.erg_power and course_resistance != last_sent:
+            control.send(("resistance", course_resistance))
+            last_sent = course_resistance
+
+    pipeline = SamplePipeline(process_sample, log=dashboard.message if dashboard else None)
+    pipeline.add_consumer(store_sample, rate=trainer_data.storage_rate)
+    pipeline.add_consumer(display_sample, rate=trainer_data.display_rate)
+    pipeline.add_consumer(update_resistance, rate=trainer_data.resistance_rate)
+
+    def apply_status(values):
+        if values["current_resistance"] is not None:
+            shared_data["current_resistance"] = values["current_resistance"]
+        for device_type in ("trainer", "hrm"):
+            if values[f"{device_type}_connected"] == 0:
+                for key in device_values[device_type]:
+                    shared_data[key] = None
+
+    # Moves samples from the ring into the sample store and the pipeline, until the bluetooth process says stop
+    async def read_ring():
+        while True:
+            stopping = ring.stopping
+            for channel, values, timestamp in ring.read():
+                if channel == "status":
+                    apply_status(values)
+                    continue
+                if values:
+                    for key, value in values.items():
+                        sample_store.append(key, value, timestamp)
+                pipeline.push(channel, values, timestamp)
+            debug_data["ring_dropped"] = ring.samples_dropped
+            if stopping:
+                return
+            await asyncio.sleep(poll_interval)
+
+    pipeline_task = asyncio.create_task(pipeline.run())
+    try:
+        await read_ring()
+        while not pipeline.queue.empty():
+            await asyncio.sleep(poll_interval)
+    finally:
+        pipeline_task.cancel()
+        await asyncio.gather(pipeline_task, return_exceptions=True)
+        if dashboard:
+            dashboard.close()
+
+        recorder.summary_fn = lambda: stats_checkpoint(stats, finished=True)
+        await recorder.close()
+        print(f"\nSession saved to {recorder.log_path}")
+        if pipeline.errors:
+            print(f"{pipeline.errors} errors in the pipeline during the ride")
+        if trainer_data.export_tcx:
+            print(f"Ride file saved to {os.path.splitext(recorder.log_path)[0]}.tcx")
+        if trainer_data.analyse_ride and recorder.samples_recorded:
+            await trainer_data.analyse_session_file(recorder.log_path, settings["ftp"], settings["max_hr"])
+
+        latency_file = os.path.splitext(recorder.log_path)[0] + ".latency.json"
+        try:
+            monitor.dump(latency_file)
+            print(f"Latency stats saved to {latency_file}")
+        except OSError as e:
+            print(f"Error saving latency stats: {e}")
+
+
+# Entry point of the worker process. sim_clock is the simulated devices' clock, which pickles across with its start
+# time, so the worker's session runs at the same speed as the devices.
+def worker(ring_name, capacity, control, session_name, settings, sim_clock=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C goes to both processes, the bluetooth one decides when to stop
+    for name, value in settings.items():
+        setattr(trainer_data, name, value)
+
+    ring = SharedSampleRing(capacity, ring_name)
+    try:
+        asyncio.run(run_worker(ring, control, session_name, sim_clock))
+    finally:
+        control.close()
+        ring.close()
+
+
+# The bluetooth process
+async def main():
+    shared_data, settings, debug_data = trainer_data.init_shared_data(trainer_data.user_profile, trainer_data.rider)
+    supervisor = ConnectionSupervisor(shared_data, debug_data, debug=trainer_data.debug)
+
+    if trainer_data.simulate:
+        connected_clients = create_simulated_clients(trainer_data.simulate, speed=trainer_data.sim_speed,
+                                                     trainer_rate=trainer_data.sim_trainer_rate,
+                                                     hrm_rate=trainer_data.sim_hrm_rate)
+        for device_type, client in connected_clients.items():
+            client.disconnected_callback = supervisor.disconnect_callback(device_type)
+            await client.connect()
+        print(f"Using simulated devices ({trainer_data.simulate}, {trainer_data.sim_speed}x speed)")
+    else:
+        devices = {
+            "trainer": (settings["trainer_address"], settings["trainer_name"]),
+            "hrm": (settings["hrm_address"], settings["hrm_name"]),
+        }
+        connected_clients = await trainer_data.device_connection(devices, supervisor.disconnect_callback)
+
+    trainer_client = (connected_clients or {}).get("trainer")
+    if not trainer_client:
+        print("Error: Trainer client not connected. Exiting.")
+        for client in (connected_clients or {}).values():
+            await client.disconnect()
+        return
+    hrm_client = connected_clients.get("hrm")
+
+    # The worker is started before the notifications, so it has the ring from the first sample
+    session_name = time.strftime("session_%Y%m%d_%H%M%S")
+    ring = SharedSampleRing(ring_capacity)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("spawn").Process(
+        target=worker, name="trainer-worker",
+        args=(ring.name, ring_capacity, sender, session_name,
+              {name: getattr(trainer_data, name) for name in worker_settings},
+              trainer_data.session_clock(trainer_client)))
+    process.start()
+    sender.close()  # The worker has its own copy
+
+    monitor = get_monitor()
+    controller_task = None
+    try:
+        # No sample store or pipeline in this process, the handlers just write into the ring
+        _, _, trainer_ftms, _ = await trainer_data.init_ftms(shared_data, debug_data, trainer_client, hrm_client,
+                                                             None, ring, supervisor)
+        if trainer_ftms is None:
+            return
+
+        capabilities = None
+        try:
+            capabilities = await get_capabilities(trainer_client, trainer_ftms)
+        except Exception as e:
+            print(f"Error reading trainer capabilities: {e}")
+
+        controller = TrainerController(trainer_ftms, shared_data, resistance_range=resistance_limits(capabilities),
+                                       debug=trainer_data.debug)
+        controller_task = asyncio.create_task(controller.run())
+        supervisor.on_reconnect("trainer", lambda client: controller.reacquire())
+
+        # ERG runs here rather than in the worker, so the loop from power to resistance doesn't go through two
+        # processes. It runs on each new trainer sample, at most erg_rate times a second.
+        erg = None
+        if trainer_data.erg_power:
+            erg = ErgController(controller, capabilities, trainer_data.erg_mode)
+            erg.set_target(trainer_data.erg_power)
+            print(f"ERG mode, holding {trainer_data.erg_power} W ({erg.mode} control)")
+        erg_interval = 1.0 / trainer_data.erg_rate
+        last_erg = 0.0
+        last_status = 0.0
+        last_written = None
+        sim_clock = trainer_data.session_clock(trainer_client)
+
+        while process.is_alive():
+            try:
+                while receiver.poll():
+                    op, value = receiver.recv()
+                    if op == "resistance":
+                        controller.set_resistance(value)
+            except EOFError:
+                pass  # The worker has gone, is_alive() picks that up
+
+            now = time.monotonic()
+            if erg and now - last_erg >= erg_interval and ring.written != last_written:
+                last_erg = now
+                last_written = ring.written
+                erg.update(shared_data.get("power"), shared_data.get("cadence"), sim_clock.now() if sim_clock else now)
+
+            if now - last_status >= status_interval:
+                last_status = now
+                ring.push("status", {
+                    "current_resistance": shared_data.get("current_resistance"),
+                    "trainer_connected": float(supervisor.connected.get("trainer", False)),
+                    "hrm_connected": float(supervisor.connected.get("hrm", hrm_client is not None)),
+                }, now)
+
+            await asyncio.sleep(poll_interval)
+        print("\nError: the worker process stopped. Exiting.")
+
+    except asyncio.CancelledError:
+        print("\nExiting notification loop.")
+    finally:
+        supervisor.stop()
+        if controller_task:
+            controller_task.cancel()
+        ring.stop()
+
+        print("Disconnecting devices...")
+        await trainer_client.disconnect()
+        if hrm_client:
+            await hrm_client.disconnect()
+        print("Devices disconnected.")
+
+        # The worker saves the session, the TCX file and the analysis before it goes
+        await asyncio.get_running_loop().run_in_executor(None, process.join, join_timeout)
+        if process.is_alive():
+            print("Error: the worker didn't finish saving in time, stopping it.")
+            process.terminate()
+        receiver.close()
+        ring.close()
+
+        latency_file = os.path.join(trainer_data.session_dir, session_name + ".io.latency.json")
+        try:
+            os.makedirs(trainer_data.session_dir, exist_ok=True)
+            monitor.dump(latency_file)
+            print(f"Bluetooth latency stats saved to {latency_file}")
+        except OSError as e:
+            print(f"Error saving latency stats: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trainer data, with the bluetooth and the processing in two processes")
+    parser.add_argument("--simulate", metavar="PROFILE", default=trainer_data.simulate,
+                        help="use simulated devices: steady, intervals, ramp, rider, or a session .jsonl to play back")
+    parser.add_argument("--sim-speed", type=float, default=trainer_data.sim_speed)
+    parser.add_argument("--rider", default=trainer_data.rider, help="rider profile to use")
+    parser.add_argument("--course", default=trainer_data.course_file, help="route file to ride")
+    parser.add_argument("--loop", action="store_true", default=trainer_data.course_loop)
+    parser.add_argument("--erg", type=float, default=trainer_data.erg_power, metavar="WATTS",
+                        help="ERG mode, hold this power")
+    parser.add_argument("--erg-mode", choices=["auto", "power", "resistance"], default=trainer_data.erg_mode)
+    args = parser.parse_args()
+
+    trainer_data.simulate = args.simulate
+    trainer_data.sim_speed = args.sim_speed
+    trainer_data.rider = args.rider
+    if args.rider and args.rider not in get_store(trainer_data.user_profile).names():
+        parser.error(f"no rider profile called {args.rider}, set it up with connect_profile.py --rider {args.rider}")
+    trainer_data.course_file = args.course
+    trainer_data.course_loop = args.loop
+    trainer_data.erg_power = args.erg
+    trainer_data.erg_mode = args.erg_mode
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import time
+
+'''
+TCX ride file export, so a ride can go to Strava, Garmin Connect, TrainingPeaks etc. instead of only leaving
+max_values.json behind.
+
+The file is written as the ride goes. Each trackpoint gets formatted as its sample comes in (thinned out to one a
+second, like a head unit), and the text goes out in chunks through the session recorder's writer thread, so nothing
+is held in memory apart from a few running totals, however long the ride is.
+
+The catch with writing TCX as you go is that the lap summary (total time, distance, averages) comes before the
+trackpoints in the file. So the summary gets written at the start with fixed width, zero padded placeholder values,
+and once the ride is over the real values are written over the top of it. Being the same width, nothing after it has
+to move. The heart rate elements can't be zero (TCX wants at least 1 bpm), so they're left out of the placeholder and
+out of the final summary if there was no HRM, with spaces of the same width standing in for them.
+
+It can also convert a session log after the fact, in one pass through the file:
+    python tcx_export.py sessions/session_20240101_120000.jsonl
+
+FIT isn't done here. It's a binary format with its own message definitions and CRC, and TCX is taken everywhere FIT is.
+'''
+
+header = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" '
+    'xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">\n'
+    ' <Activities>\n'
+    '  <Activity Sport="Biking">\n'
+    '   <Id>{start}</Id>\n'
+    '   <Lap StartTime="{start}">\n'
+)
+
+# Fixed width, so the real values can be written over the placeholders at the end
+lap_summary = (
+    '    <TotalTimeSeconds>{time:010.1f}</TotalTimeSeconds>\n'
+    '    <DistanceMeters>{distance:012.2f}</DistanceMeters>\n'
+    '    <MaximumSpeed>{max_speed:07.3f}</MaximumSpeed>\n'
+    '    <Calories>{calories:05d}</Calories>\n'
+    '{heart_rate}'
+    '    <Intensity>Active</Intensity>\n'
+    '    <Cadence>{avg_cadence:03d}</Cadence>\n'
+    '    <TriggerMethod>Manual</TriggerMethod>\n'
+    '    <Track>\n'
+)
+
+lap_heart_rate = (
+    '    <AverageHeartRateBpm><Value>{avg_hr:03d}</Value></AverageHeartRateBpm>\n'
+    '    <MaximumHeartRateBpm><Value>{max_hr:03d}</Value></MaximumHeartRateBpm>\n'
+)
+
+placeholder = {"time": 0, "distance": 0, "max_speed": 0, "calories": 0, "avg_hr": 0, "max_hr": 0, "avg_cadence": 0}
+
+
+# The lap summary, with the heart rate blanked out (same width) if there isn't one
+def format_lap_summary(values):
+    heart_rate = lap_heart_rate.format(**values)
+    if not values["avg_hr"] or not values["max_hr"]:
+        heart_rate = " " * (len(heart_rate) - 1) + "\n"
+    return lap_summary.format(heart_rate=heart_rate, **values)
+
+footer = (
+    '    </Track>\n'
+    '    <Extensions><ns3:LX><ns3:AvgSpeed>{avg_speed:07.3f}</ns3:AvgSpeed>'
+    '<ns3:AvgWatts>{avg_power:04d}</ns3:AvgWatts><ns3:MaxWatts>{max_power:04d}</ns3:MaxWatts></ns3:LX></Extensions>\n'
+    '   </Lap>\n'
+    '   <Creator xsi:type="Device_t" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+    '<Name>Cycle Trainer Project</Name><UnitId>0</UnitId><ProductID>0</ProductID>'
+    '<Version><VersionMajor>0</VersionMajor><VersionMinor>0</VersionMinor></Version></Creator>\n'
+    '  </Activity>\n'
+    ' </Activities>\n'
+    '</TrainingCenterDatabase>\n'
+)
+
+
+def iso_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + f".{int(timestamp % 1 * 1000):03d}Z"
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+class TcxWriter:
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval  # Seconds between trackpoints
+        self.points = 0
+
+        self._pending = []
+        self._file = None
+        self._summary_offset = None
+        self._start = None
+        self._last_point = None
+        self._totals = {"time": 0.0, "distance": 0.0, "max_speed": 0.0, "work": 0.0, "hr_sum": 0, "hr_count": 0,
+                        "max_hr": 0, "cadence_sum": 0, "cadence_count": 0, "power_sum": 0, "power_count": 0,
+                        "max_power": 0}
+
+    # Takes a recorded sample (a session log line as a dict, with "t" in epoch seconds). Cheap, it only formats
+    # a trackpoint once per interval and keeps the totals.
+    def add(self, sample):
+        t = sample.get("t")
+        if t is None:
+            return
+        if self._start is None:
+            self._start = t
+            self._pending.append(header.format(start=iso_time(t)))
+            self._pending.append(None)  # Where the lap summary goes, filled in by the writer
+        if self._last_point is not None and t - self._last_point < self.interval:
+            return
+        dt = 0.0 if self._last_point is None else t - self._last_point
+        self._last_point = t
+
+        power = _number(sample.get("power"))
+        cadence = _number(sample.get("cadence"))
+        heart_rate = _number(sample.get("heart_rate"))
+        distance = _number(sample.get("distance"))
+        velocity = _number(sample.get("velocity"))  # km/h
+        speed = velocity / 3.6 if velocity is not None else None
+
+        totals = self._totals
+        totals["time"] = t - self._start
+        if distance is not None:
+            totals["distance"] = max(totals["distance"], distance)
+        if speed is not None:
+            totals["max_speed"] = max(totals["max_speed"], speed)
+        if power is not None:
+            totals["work"] += power * dt
+            totals["power_sum"] += power
+            totals["power_count"] += 1
+            totals["max_power"] = max(totals["max_power"], power)
+        if heart_rate:
+            totals["hr_sum"] += heart_rate
+            totals["hr_count"] += 1
+            totals["max_hr"] = max(totals["max_hr"], heart_rate)
+        if cadence is not None:
+            totals["cadence_sum"] += cadence
+            totals["cadence_count"] += 1
+
+        point = [f'     <Trackpoint><Time>{iso_time(t)}</Time>']
+        if distance is not None:
+            point.append(f'<DistanceMeters>{distance:.2f}</DistanceMeters>')
+        if heart_rate:
+            point.append(f'<HeartRateBpm><Value>{min(int(round(heart_rate)), 255)}</Value></HeartRateBpm>')
+        if cadence is not None:
+            point.append(f'<Cadence>{min(int(round(cadence)), 254)}</Cadence>')
+        if speed is not None or power is not None:
+            point.append('<Extensions><ns3:TPX>')
+            if speed is not None:
+                point.append(f'<ns3:Speed>{speed:.3f}</ns3:Speed>')
+            if power is not None:
+                point.append(f'<ns3:Watts>{int(round(power))}</ns3:Watts>')
+            point.append('</ns3:TPX></Extensions>')
+        point.append('</Trackpoint>\n')
+        self._pending.append("".join(point))
+        self.points += 1
+
+    # Hands over what's been formatted since last time, for write(). Called on the same thread as add().
+    def take(self):
+        chunk, self._pending = self._pending, []
+        return chunk
+
+    # The lap summary values, from the totals so far
+    def summary(self):
+        totals = self._totals
+
+        def average(key):
+            count = totals[key + "_count"]
+            return int(round(totals[key + "_sum"] / count)) if count else 0
+
+        return {
+            "time": min(totals["time"], 99999999.9),
+            "distance": min(totals["distance"], 999999999.99),
+            "max_speed": min(totals["max_speed"], 999.999),
+            "avg_speed": min(totals["distance"] / totals["time"], 999.999) if totals["time"] else 0.0,
+            "calories": min(int(round(totals["work"] / 1000)), 65535),  # 1 kJ of work is about 1 kcal burned
+            "avg_hr": min(average("hr"), 255),
+            "max_hr": min(int(round(totals["max_hr"])), 255),
+            "avg_cadence": min(average("cadence"), 254),
+            "avg_power": min(average("power"), 9999),
+            "max_power": min(int(round(totals["max_power"])), 9999),
+        }
+
+    # Everything below here can run on the recorder's writer thread
+    def write(self, chunk):
+        if not chunk:
+            return
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "wb")
+        for part in chunk:
+            if part is None:
+                self._summary_offset = self._file.tell()
+                part = format_lap_summary(placeholder)
+            self._file.write(part.encode("utf-8"))
+        self._file.flush()
+
+    # Writes the footer and goes back to fill in the lap summary. summary comes from summary(), taken on the thread
+    # that's been calling add().
+    def close(self, summary, chunk=None):
+        self.write(chunk)
+        if self._file is None:
+            return  # Nothing was ever recorded
+        self._file.write(footer.format(**summary).encode("utf-8"))
+        if self._summary_offset is not None:
+            self._file.seek(self._summary_offset)
+            self._file.write(format_lap_summary(summary).encode("utf-8"))
+        self._file.close()
+        self._file = None
+
+
+# Converts a session log to TCX, one line at a time
+def convert(session_file, output_file=None, interval=1.0, chunk_points=500):
+    output_file = output_file or os.path.splitext(session_file)[0] + ".tcx"
+    writer = TcxWriter(output_file, interval)
+    with open(session_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                writer.add(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # A line cut off by a crash
+            if len(writer._pending) >= chunk_points:
+                writer.write(writer.take())
+    writer.close(writer.summary(), writer.take())
+    return output_file, writer.points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert session logs to TCX")
+    parser.add_argument("sessions", nargs="+", help="session .jsonl files")
+    parser.add_argument("--output", help="output file, only with a single session")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between trackpoints")
+    args = parser.parse_args()
+
+    for session in args.sessions:
+        output, points = convert(session, args.output if len(args.sessions) == 1 else None, args.interval)
+        print(f"{session} -> {output} ({points} trackpoints)")
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import socket
+import struct
+import sys
+import time
+
+'''
+Live telemetry server, so other screens (a browser, a phone, a second monitor) can show the ride. It speaks plain
+WebSocket, done here with the standard library so there's nothing extra to install.
+
+publish() is a sink for trainer_data.main(). It's called on the ride loop, so all it does is copy the numbers into the
+latest snapshot; nothing gets encoded or sent there. Each client has its own task which wakes at the client's rate,
+and sends one message with every value that has changed since the last one it sent that client:
+
+    {"seq": 12, "t": 1718000000.12, "d": {"power": 212, "velocity": 31.4}}
+
+The first message has "full": true and everything in it. A value that's gone (a device dropped out) is sent as null.
+Floats are rounded to 2 places, so noise in the last digits doesn't count as a change.
+
+A client sets its rate (updates a second, up to max_rate) and the keys it wants by sending
+    {"rate": 2, "keys": ["power", "heart_rate"]}
+at any time. Leave keys out for everything.
+
+A client that doesn't keep up isn't buffered for. If there's more than max_buffer bytes still waiting to go to it, its
+updates get skipped (the next one it does get carries all the changes, so nothing is lost but the in between values),
+and if it stays that far behind for stall_timeout seconds it gets disconnected. A GET without the upgrade gets the
+whole snapshot back as JSON, for a quick look with curl.
+
+    python trainer_data.py --telemetry 8765
+    python telemetry_server.py --check
+'''
+
+_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"  # From the WebSocket spec, for the handshake
+
+
+def _frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+# One frame from a client. Client frames are always masked. Returns (opcode, payload)
+async def _read_frame(reader):
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", await reader.readexactly(8))
+    if length > 65536:
+        raise ValueError("frame too big")
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return opcode, payload
+
+
+def _compact(value):
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+
+class TelemetryClient:
+    def __init__(self, writer, rate):
+        self.writer = writer
+        self.rate = rate
+        self.keys = None  # None is everything
+        self.sent = {}  # What the client has been sent, to work out the changes against
+        self.needs_full = True  # Next message is a full one. Its own flag, as sent stays empty if none of the keys exist
+        self.seq = 0
+        self.skipped = 0
+        self.behind_since = None
+        self.wake = asyncio.Event()  # Set when the rate changes, so a slow rate doesn't hold up a faster one
+
+
+class TelemetryServer:
+    def __init__(self, host="127.0.0.1", port=8765, max_rate=10, default_rate=2, max_buffer=16384,
+                 stall_timeout=5.0, send_buffer=65536, debug=False, log=None):
+        self.host = host  # 0.0.0.0 to let other devices on the network see it
+        self.port = port
+        self.max_rate = max_rate
+        self.default_rate = default_rate
+        self.max_buffer = max_buffer
+        self.stall_timeout = stall_timeout
+        self.send_buffer = send_buffer  # Kept small, so a stuck client shows up in our buffer rather than the kernel's
+        self.debug = debug
+        self.log = log or print  # The dashboard's status line, when there is one
+
+        self.snapshot = {}
+        self.version = 0
+        self.clients = set()
+        self.clients_dropped = 0
+        self._server = None
+        self._handlers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]  # In case it was 0
+        self.log(f"Telemetry on ws://{self.host}:{self.port}")
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for task in list(self._handlers):
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    # Sink for trainer_data.main(). Runs on the ride loop, so it only copies
+    def publish(self, shared_data, debug_data=None):
+        snapshot = self.snapshot
+        for source in (shared_data, debug_data or {}):
+            for key, value in source.items():
+                if value is None or isinstance(value, (int, float, str, bool)):
+                    snapshot[key] = value
+        self.version += 1
+
+    # Everything that has changed since the client was last sent anything
+    def _delta(self, client):
+        delta = {}
+        for key, value in self.snapshot.items():
+            if client.keys is not None and key not in client.keys:
+                continue
+            value = _compact(value)
+            if key not in client.sent or client.sent[key] != value:
+                delta[key] = value
+                client.sent[key] = value
+        return delta
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        headers = {}
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        key = headers.get("sec-websocket-key")
+        if headers.get("upgrade", "").lower() != "websocket" or not key:
+            body = json.dumps({key: _compact(value) for key, value in self.snapshot.items()}).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+            writer.close()
+            return
+
+        accept = base64.b64encode(hashlib.sha1((key + _guid).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        sock = writer.get_extra_info("socket")
+        if sock is not None and self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+
+        client = TelemetryClient(writer, min(self.default_rate, self.max_rate))
+        self.clients.add(client)
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        if self.debug:
+            self.log(f"Telemetry client connected: {writer.get_extra_info('peername')}")
+        sender = asyncio.create_task(self._send_loop(client))
+        try:
+            await self._receive_loop(reader, client)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            pass  # Cancelled is the server closing, which is a normal way for a client to go
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            self.clients.discard(client)
+            self._handlers.discard(handler)
+            writer.close()
+            if self.debug:
+                self.log(f"Telemetry client gone, {client.seq} updates sent, {client.skipped} skipped")
+
+    # Subscription changes, pings and the close from the client
+    async def _receive_loop(self, reader, client):
+        while True:
+            opcode, payload = await _read_frame(reader)
+            if opcode == 0x8:  # Close
+                client.writer.write(_frame(0x8, payload[:2]))
+                return
+            if opcode == 0x9:  # Ping
+                client.writer.write(_frame(0xA, payload))
+            elif opcode == 0x1:
+                try:
+                    request = json.loads(payload)
+                except ValueError:
+                    continue
+                if not isinstance(request, dict):
+                    continue
+                if isinstance(request.get("rate"), (int, float)) and request["rate"] > 0:
+                    client.rate = min(float(request["rate"]), self.max_rate)
+                if "keys" in request:
+                    keys = request["keys"]
+                    client.keys = set(keys) if isinstance(keys, list) else None
+                    client.sent = {}  # Start again with a full update of the new keys
+                    client.needs_full = True
+                client.wake.set()
+
+    async def _send_loop(self, client):
+        writer = client.writer
+        sent_version = None
+        while True:
+            if self.version != sent_version or client.needs_full:
+                buffered = writer.transport.get_write_buffer_size()
+                if buffered > self.max_buffer:
+                    # Behind, so this one gets skipped. The next one that goes has all the changes in it
+                    client.skipped += 1
+                    now = time.monotonic()
+                    if client.behind_since is None:
+                        client.behind_since = now
+                    elif now - client.behind_since > self.stall_timeout:
+                        self.clients_dropped += 1
+                        writer.transport.abort()
+                        return
+                else:
+                    client.behind_since = None
+                    full = client.needs_full
+                    client.needs_full = False
+                    delta = self._delta(client)
+                    sent_version = self.version
+                    if delta or full:
+                        message = {"seq": client.seq, "t": round(time.time(), 2), "d": delta}
+                        if full:
+                            message["full"] = True
+                        writer.write(_frame(0x1, json.dumps(message, separators=(",", ":")).encode()))
+                        client.seq += 1
+            try:
+                await asyncio.wait_for(client.wake.wait(), 1.0 / client.rate)
+            except asyncio.TimeoutError:
+                pass
+            client.wake.clear()
+
+
+# Bare bones client, for the self check
+class _TestClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.state = {}
+        self.messages = 0
+
+    @classmethod
+    async def connect(cls, port, receive_buffer=None):
+        sock = socket.socket()
+        if receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        key = base64.b64encode(b"0123456789abcdef").decode()
+        writer.write(("GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        response = await reader.readuntil(b"\r\n\r\n")
+        if b" 101 " not in response:
+            raise ConnectionError("no upgrade")
+        return cls(reader, writer)
+
+    def send(self, request):
+        payload = json.dumps(request).encode()
+        mask = b"\x01\x02\x03\x04"
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.writer.write(struct.pack("!BB", 0x81, 0x80 | len(payload)) + mask + masked)
+
+    async def receive(self):
+        opcode, payload = await _read_frame(self.reader)
+        message = json.loads(payload)
+        if message.get("full"):
+            self.state = {}
+        self.state.update(message["d"])
+        self.messages += 1
+        return message
+
+
+# A publisher at 50 Hz, a client at 5 Hz that has to end up with the same numbers, one that only wants the power, and
+# one that never reads and has to get dropped
+async def self_check(duration=3.0, verbose=True):
+    server = TelemetryServer(port=0, max_rate=20, max_buffer=8192, stall_timeout=1.0, send_buffer=4096)
+    await server.start()
+    padding = {f"field_{index}": "x" * 256 for index in range(40)}  # So the stuck client fills its buffers quickly
+
+    async def publisher():
+        started = time.monotonic()
+        tick = 0
+        while True:
+            tick += 1
+            elapsed = time.monotonic() - started
+            server.publish({"power": 200 + tick % 50, "cadence": 90.0 + (tick % 7) / 3, "heart_rate": None,
+                            "elapsed": elapsed, **{key: f"{value}{tick}" for key, value in padding.items()}})
+            await asyncio.sleep(0.02)
+
+    publishing = asyncio.create_task(publisher())
+    fast = await _TestClient.connect(server.port)
+    fast.send({"rate": 5})
+    power_only = await _TestClient.connect(server.port)
+    power_only.send({"rate": 20, "keys": ["power"]})
+    stuck = await _TestClient.connect(server.port, receive_buffer=4096)
+    stuck.send({"rate": 20})
+
+    async def follow(client):
+        while True:
+            await client.receive()
+
+    following = [asyncio.create_task(follow(fast)), asyncio.create_task(follow(power_only))]
+    await asyncio.sleep(duration)
+    publishing.cancel()
+    await asyncio.sleep(0.5)  # Let the last changes go out
+    for task in following:
+        task.cancel()
+
+    expected = {key: _compact(value) for key, value in server.snapshot.items()}
+    rate = fast.messages / (duration + 0.5)
+    checks = [
+        ("5 Hz client matches the snapshot", fast.state == expected),
+        (f"5 Hz client got {rate:.1f} updates/s", 3.5 <= rate <= 6.5),
+        ("power only client only got power", set(power_only.state) == {"power"}
+         and power_only.state["power"] == expected["power"]),
+        ("stuck client dropped", server.clients_dropped == 1),
+    ]
+    for client in (fast, power_only, stuck):
+        client.writer.close()
+    await server.close()
+
+    passed = all(ok for _, ok in checks)
+    if verbose:
+        for name, ok in checks:
+            print(f"  {name}{'' if ok else '  FAIL'}")
+        print("Passed" if passed else "Failed")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live telemetry server")
+    parser.add_argument("--check", action="store_true", help="run the self check")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if asyncio.run(self_check()) else 1)
+    parser.print_help()
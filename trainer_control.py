@@ -0,0 +1,222 @@
+import asyncio
+import time
+
+from latency import get_monitor
+
+'''
+Trainer control. set_resistance() requests control, resets the trainer and then sets the resistance for every single
+change, with up to 10 retries straight after each other, and the main loop waits for all of it.
+
+This keeps one control session open instead. Control is requested once (plus the reset my trainer needs) and only
+requested again if the trainer says we've lost it. New targets just get dropped into a single pending slot, so if the
+gradient changes five times while a command is in flight, only the newest value gets sent. A background task sends it,
+waits for the control point indication to confirm it, and backs off exponentially if it fails.
+'''
+
+# FTMS control point op codes and result codes, from the FTMS spec
+REQUEST_CONTROL = 0x00
+RESET = 0x01
+SET_TARGET_RESISTANCE = 0x04
+SET_TARGET_POWER = 0x05
+
+# Names for the latency histograms
+op_names = {
+    REQUEST_CONTROL: "request_control",
+    RESET: "reset",
+    SET_TARGET_RESISTANCE: "set_resistance",
+    SET_TARGET_POWER: "set_power",
+}
+
+RESULT_SUCCESS = 0x01
+RESULT_CONTROL_NOT_PERMITTED = 0x05
+
+
+class ControlLost(Exception):
+    pass
+
+
+class CommandFailed(Exception):
+    pass
+
+
+# pycycling gives back enums for the codes, but plain ints are fine too
+def _code(value):
+    return getattr(value, "value", value)
+
+
+class TrainerController:
+    def __init__(self, ftms, shared_data=None, resistance_range=(0, 100), min_interval=0.25, ack_timeout=2.0,
+                 base_backoff=0.25, max_backoff=8.0, debug=False, monitor=None, log=None):
+        self.ftms = ftms
+        self.shared_data = shared_data if shared_data is not None else {}
+        self.resistance_range = resistance_range
+        self.min_interval = min_interval  # Minimum gap between commands, so we don't flood the trainer
+        self.ack_timeout = ack_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.debug = debug
+        self.monitor = monitor or get_monitor()  # Round trip and apply times go in here
+        self.log = log or print  # Where the messages go, e.g. the dashboard's status line so they don't scroll it
+
+        self.has_control = False
+        self.current = None  # (kind, value) the trainer last confirmed
+        self._pending = None  # (kind, value) waiting to be sent. Only ever holds the newest target
+        self._pending_since = None  # When the pending target was set, for timing how long it takes to apply
+        self._wake = asyncio.Event()
+        self._acks = {}  # op code -> future waiting for the control point response
+        self._last_command = 0.0
+
+        # Counters, for keeping an eye on flaky trainers
+        self.commands_sent = 0
+        self.commands_acked = 0
+        self.commands_failed = 0
+        self.targets_coalesced = 0
+        self.control_requests = 0
+        self.last_ack_latency = None
+
+        self.attach(ftms)
+
+    # Hook up the control point responses. Called again with the new service after a reconnect.
+    def attach(self, ftms):
+        self.ftms = ftms
+        self.has_control = False
+        if ftms is not None and hasattr(ftms, "set_control_point_response_handler"):
+            ftms.set_control_point_response_handler(self._on_response)
+
+    # After a reconnect, control has to be requested again, and the last target gets sent again as the trainer may
+    # have reset itself
+    def reacquire(self):
+        self.has_control = False
+        if self._pending is None and self.current is not None:
+            self._pending = self.current
+            self._pending_since = time.monotonic()
+        self.current = None
+        self._wake.set()
+
+    def _on_response(self, response):
+        request_code = _code(getattr(response, "request_code_enum", None))
+        future = self._acks.pop(request_code, None)
+        if future is not None and not future.done():
+            future.set_result(_code(getattr(response, "result_code_enum", None)))
+
+    # Queue up a resistance target. Doesn't wait for anything, the background task sends it.
+    def set_resistance(self, level):
+        low, high = self.resistance_range
+        level = max(low, min(high, level))
+        self.shared_data["d_resistance"] = level
+        self._queue(("resistance", level))
+
+    # Queue up a target power, for trainers that do their own ERG
+    def set_target_power(self, watts):
+        self.shared_data["d_power"] = watts
+        self._queue(("power", watts))
+
+    def _queue(self, target):
+        if self._pending is not None:
+            self.targets_coalesced += 1
+        self._pending = target
+        self._pending_since = time.monotonic()
+        self._wake.set()
+
+    # Send a command and wait for the trainer to confirm it
+    async def _command(self, op_code, send):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._acks[op_code] = future
+        self.commands_sent += 1
+        started = time.monotonic()
+        try:
+            await send()
+            result = await asyncio.wait_for(future, self.ack_timeout)
+        except asyncio.TimeoutError:
+            self.monitor.count("control_timeouts")
+            raise
+        finally:
+            self._acks.pop(op_code, None)
+        self.monitor.since("control_" + op_names.get(op_code, f"{op_code:#04x}"), started)
+
+        if result == RESULT_CONTROL_NOT_PERMITTED:
+            raise ControlLost()
+        if result != RESULT_SUCCESS:
+            raise CommandFailed(f"Control point op code {op_code:#04x} returned result {result}")
+        self.commands_acked += 1
+        self.last_ack_latency = time.monotonic() - started
+
+    async def _acquire_control(self):
+        if self.debug:
+            self.log("Requesting control...")
+        self.control_requests += 1
+        await self._command(REQUEST_CONTROL, self.ftms.request_control)
+        # Reset the trainer. Needed on mine, but only once per control session rather than every change
+        await self._command(RESET, self.ftms.reset)
+        self.has_control = True
+
+    async def _send(self, target):
+        kind, value = target
+        if not self.has_control:
+            await self._acquire_control()
+        if kind == "resistance":
+            await self._command(SET_TARGET_RESISTANCE, lambda: self.ftms.set_target_resistance_level(value))
+            self.shared_data["current_resistance"] = value
+        else:
+            await self._command(SET_TARGET_POWER, lambda: self.ftms.set_target_power(value))
+            self.shared_data["current_power_target"] = value
+        self.current = target
+
+    # Background task. Waits for a new target, sends it, and retries with backoff until it goes through or a newer
+    # target replaces it.
+    async def run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+
+            attempt = 0
+            while self._pending is not None:
+                target, self._pending = self._pending, None
+                queued_at = self._pending_since
+                if target == self.current:
+                    continue
+
+                # Space the commands out a bit
+                wait = self.min_interval - (time.monotonic() - self._last_command)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    if self._pending is not None:
+                        # Something newer came in while we were waiting
+                        self.targets_coalesced += 1
+                        continue
+
+                self._last_command = time.monotonic()
+                try:
+                    if self.ftms is None:
+                        raise CommandFailed("No trainer connected")
+                    await self._send(target)
+                    self.monitor.since("control_apply", queued_at)
+                    attempt = 0
+                    if self.debug:
+                        self.log(f"Trainer target set: {target[0]} {target[1]}")
+                except ControlLost:
+                    # The trainer handed control to something else. Ask for it back, straight away the first time,
+                    # then backing off if it keeps refusing
+                    if self.debug:
+                        self.log("Lost control of the trainer, requesting it again.")
+                    self.has_control = False
+                    self.monitor.count("control_lost")
+                    if attempt:
+                        await asyncio.sleep(min(self.max_backoff, self.base_backoff * 2 ** attempt))
+                    attempt += 1
+                    if self._pending is None:
+                        self._pending = target
+                        self._pending_since = queued_at
+                except Exception as e:
+                    self.commands_failed += 1
+                    self.monitor.count("control_retries")
+                    backoff = min(self.max_backoff, self.base_backoff * 2 ** attempt)
+                    attempt += 1
+                    if self.debug:
+                        self.log(f"Error setting trainer target (attempt {attempt}), retrying in {backoff:.2f}s: {e}")
+                    await asyncio.sleep(backoff)
+                    # Retry unless a newer target has turned up in the meantime
+                    if self._pending is None:
+                        self._pending = target
+                        self._pending_since = queued_at
@@ -1,15 +1,33 @@
+import argparse
 import asyncio
 import json
+import math
 import os
 import time
-import math
 from pycycling.fitness_machine_service import FitnessMachineService
-from bleak import BleakClient, BleakScanner
-from connect_profile import load_profile
+from bleak import BleakClient
+from profile_store import get_store
+import ble_scan
+from session_recorder import SessionRecorder
+from ride_stats import resume_stats, stats_checkpoint
+from sample_store import SampleStore
+from pipeline import SamplePipeline
+from trainer_control import TrainerController
+from sim_devices import create_simulated_clients
+from physics import RiderCoefficients, VirtualBike
+from course import load_course
+from connection_supervisor import ConnectionSupervisor
+from ftms_capabilities import get_capabilities, resistance_limits
+from dashboard import TerminalDashboard
+from heart_rate import HEART_RATE_MEASUREMENT, HeartRateDecoder
+from latency import get_monitor
+from tcx_export import TcxWriter
+from erg import ErgController
+from telemetry_server import TelemetryServer
+from workout import WorkoutPlayer, load_workout
 
 '''
 To Do:
-Fix acceleration
 test on multiple hardware setups.
 
 '''
@@ -21,42 +39,56 @@ test on multiple hardware setups.
 # Initialising svariables and settings
 debug = True
 user_profile = "userprofile.json"
+rider = None  # Rider profile to use, for files with more than one. None uses whichever one was used last
 calculated_resistance = 30
-
-# Create the shared data structure
-def init_shared_data(profile_file):
-    # function to load in the profile
-    def load_profile(profile_file):
-        if os.path.exists(profile_file):
-            with open(profile_file, "r") as f:
-                try:
-                    profile = json.load(f)
-                    # Setting up the headings, if they do not exist
-                    if "user_data" not in profile:
-                        profile["user_data"] = {}
-                    if "device" not in profile:
-                        profile["device"] = {}
-                    return profile
-                except json.JSONDecodeError:
-                    return {"user_data": {}, "device": {}}
-                    # Return empty. This happens if the file is there but does not contain anything
-        else:
-            return {"user_data": {}, "device": {}}
-
-    profile = load_profile(user_profile)
+session_dir = "sessions"  # Where the session logs get written
+checkpoint_interval = 60  # Seconds between summary file writes. None to only write it at the end of the session
+summary_file = "max_values.json"
+export_tcx = True  # Write a .tcx ride file next to the session log as the ride goes
+analyse_ride = True  # Power curve, zones and TSS into <session>.analysis.json at the end. Needs numpy
+use_pipeline = True  # Process each sample as it arrives, rather than polling every 100ms
+display_rate = 10  # Max console updates per second
+use_dashboard = True  # Fixed layout terminal dashboard. False for the old single line readout
+storage_rate = None  # Max samples stored per second in pipeline mode. None stores every sample
+resistance_rate = 2  # Max resistance updates per second in pipeline mode
+simulate = None  # Name of a simulated profile (steady, intervals, ramp, rider) or a session log to play back
+sim_speed = 1.0  # How much faster than real time the simulated devices, and the session with them, run
+sim_trainer_rate = 4  # Simulated indoor bike data notifications per second
+sim_hrm_rate = 1  # Simulated heart rate notifications per second
+course_file = None  # Route to ride (.gpx, .csv or .json). None rides flat at the base resistance
+course_loop = False  # Start the course again once the end is reached
+erg_power = None  # Target watts for ERG mode. None rides by resistance (base or course)
+erg_mode = "auto"  # "power" lets the trainer hold the target, "resistance" runs the loop here, "auto" picks
+erg_rate = 4  # ERG updates per second in pipeline mode
+workout_file = None  # Structured workout to ride (.zwo or .json). Power targets go through ERG, relative to the FTP
+workout_extend = 30  # Seconds the + key adds to the current workout step
+telemetry_port = None  # Port for the live telemetry WebSocket server. None turns it off
+telemetry_host = "127.0.0.1"  # 0.0.0.0 to let phones and other machines on the network connect
+telemetry_rate = 10  # Max snapshots per second handed to the telemetry server, and the fastest a client can ask for
+
+# Create the shared data structure. The profile comes from the shared profile store, which has already checked it,
+# and fills in the defaults for anything that isn't set
+def init_shared_data(profile_file, rider_name=None):
+    store = get_store(profile_file)
+
+    def setting(section, field):
+        return store.setting(section, field, rider_name)
 
     # Extract device information
     settings = {
-        "trainer_address": profile.get("device", {}).get("address", None),
-        "trainer_name": profile.get("device", {}).get("name", None),
-        "hrm_address": profile.get("device", {}).get("hrm_address", None),
-        "hrm_name": profile.get("device", {}).get("hrm_name", None),
-        "has_power": profile.get("device", {}).get("power", False),
-        "has_cadence": profile.get("device", {}).get("cadence", False),
-        "has_speed": profile.get("device", {}).get("speed", False),
-        "base_resistance": profile.get("user_data", {}).get("baseline", 20),
-        "difficulty": profile.get("user_data", {}).get("difficulty", 50),
-        "weight": profile.get("user_data", {}).get("weight", 75),
+        "trainer_address": setting("device", "address"),
+        "trainer_name": setting("device", "name"),
+        "hrm_address": setting("device", "hrm_address"),
+        "hrm_name": setting("device", "hrm_name"),
+        "has_power": setting("device", "power"),
+        "has_cadence": setting("device", "cadence"),
+        "has_speed": setting("device", "speed"),
+        "base_resistance": setting("user_data", "baseline"),
+        "difficulty": setting("user_data", "difficulty"),
+        "weight": setting("user_data", "weight"),
+        "ftp": setting("user_data", "ftp"),
+        "max_hr": setting("user_data", "max_hr"),
+        "physics": setting("user_data", "physics"),
     }
 
     shared_data = {
@@ -76,22 +108,30 @@ def init_shared_data(profile_file):
 
     return shared_data, settings, debug_data
 
-# Connect to the devices (trainer first, then others)
-async def device_connection(devices):
+# Connect to the devices (trainer first, then others). There's one scan for all of them, which stops as soon as
+# everything has been seen, then the other devices connect at the same time once the trainer is connected.
+# disconnected_callback, if given, gets called with the device type and gives back the callback for that client.
+async def device_connection(devices, disconnected_callback=None):
     connected_clients = {}
 
-    async def connect_to_device(address, name):
+    addresses = [address for address, name in devices.values() if address and name]
+    print("Scanning for devices...")
+    found = await ble_scan.scan(addresses)
+
+    async def connect_to_device(address, name, device_type):
         try:
-            print(f"Scanning for device: {name}...")
-            device_list = await BleakScanner.discover()
-            device = next((d for d in device_list if d.address == address and d.name == name), None)
+            device = found.get(address.upper())
 
-            if not device:
+            if not device or (device.name and device.name != name):
                 print(f"Device {name} not found.")
                 return None
 
             print(f"Connecting to device: {name}.")
-            client = BleakClient(device.address)
+            # Passing the scanned device saves bleak scanning for it again
+            if disconnected_callback is not None:
+                client = BleakClient(device, disconnected_callback=disconnected_callback(device_type))
+            else:
+                client = BleakClient(device)
             await client.connect()
 
             if not client.is_connected:
@@ -109,27 +149,39 @@ async def device_connection(devices):
     trainer = devices.get("trainer")
     if trainer:
         trainer_address, trainer_name = trainer
-        trainer_client = await connect_to_device(trainer_address, trainer_name)
+        trainer_client = await connect_to_device(trainer_address, trainer_name, "trainer") if trainer_address else None
         if trainer_client:
             connected_clients["trainer"] = trainer_client
         else:
             print("Critical Error: Trainer connection failed. Exiting program.")
             return None
 
-    # Connect to any other devices
-    for device_type, (address, name) in devices.items():
-        if device_type != "trainer" and address and name:
-            client = await connect_to_device(address, name)
-            if client:
-                connected_clients[device_type] = client
-            else:
-                print(f"Error: could not connect to {name}")
+    # Connect to any other devices, all at once
+    others = [(device_type, address, name) for device_type, (address, name) in devices.items()
+              if device_type != "trainer" and address and name]
+    clients = await asyncio.gather(*(connect_to_device(address, name, device_type)
+                                     for device_type, address, name in others))
+    for (device_type, address, name), client in zip(others, clients):
+        if client:
+            connected_clients[device_type] = client
+        else:
+            print(f"Error: could not connect to {name}")
 
     return connected_clients
 
 
+# Simulated devices bring their own stand in for the FTMS service
+def make_ftms(client):
+    if getattr(client, "simulated", False):
+        return client.create_ftms() if hasattr(client, "create_ftms") else None
+    return FitnessMachineService(client)
+
+
 # Manage the fitness machine service (ftms) for trainer and HRM
-async def init_ftms(shared_data, debug_data, trainer_client, hrm_client=None):
+# Every sample also goes into the sample store (if there is one) with its arrival time, so nothing gets lost between
+# ticks, and gets pushed into the pipeline (if there is one) to be processed straight away
+async def init_ftms(shared_data, debug_data, trainer_client, hrm_client=None, sample_store=None, pipeline=None,
+                    supervisor=None, monitor=None):
     shared_data.update({
         "power": None,
         "cadence": None,
@@ -137,42 +189,88 @@ async def init_ftms(shared_data, debug_data, trainer_client, hrm_client=None):
         "heart_rate": None,
     })
 
+    monitor = monitor or get_monitor()
+
     def trainer_data_handler(data):
+        arrival = time.monotonic()
+        monitor.interval("trainer_interval", arrival)
         shared_data["power"] = getattr(data, "instant_power", 0.0)
         shared_data["cadence"] = getattr(data, "instant_cadence", 0.0)
         debug_data["t_speed"] = getattr(data, "instant_speed", 0.0)
 
-    async def enable_hrm_notifications(client):
-        def hrm_data_handler(sender, data):
-            if data:
-                heart_rate = data[1] if len(data) > 1 else None
-                shared_data["heart_rate"] = heart_rate
+        if sample_store is not None:
+            sample_store.append("power", shared_data["power"], arrival)
+            sample_store.append("cadence", shared_data["cadence"], arrival)
+            sample_store.append("t_speed", debug_data["t_speed"], arrival)
+
+        if pipeline is not None:
+            pipeline.push("trainer", {
+                "power": shared_data["power"],
+                "cadence": shared_data["cadence"],
+                "t_speed": debug_data["t_speed"],
+            }, arrival)
+
+    # Decodes the whole 0x2A37 packet (16 bit heart rates, contact, energy and RR intervals), not just data[1]
+    hr_decoder = HeartRateDecoder()
+
+    def hrm_data_handler(sender, data):
+        if data:
+            arrival = time.monotonic()
+            monitor.interval("hrm_interval", arrival)
+            heart_rate = hr_decoder.decode(data, arrival)
+            shared_data["heart_rate"] = heart_rate
+            debug_data["rmssd"] = hr_decoder.hrv.rmssd
+            debug_data["rr"] = hr_decoder.hrv.last_rr
+            if hr_decoder.contact is not None:
+                debug_data["hr_contact"] = hr_decoder.contact
+            if hr_decoder.energy_expended is not None:
+                debug_data["energy"] = hr_decoder.energy_expended
+            if sample_store is not None:
+                sample_store.append("heart_rate", heart_rate, arrival)
+            if pipeline is not None:
+                pipeline.push("hrm", {"heart_rate": heart_rate, "rmssd": debug_data["rmssd"]}, arrival)
+
+    async def start_hrm_notify(client):
+        # After a reconnect the first beat shouldn't be compared with the last one from before the drop
+        hr_decoder.hrv.reset_reference()
+        await client.start_notify(
+            HEART_RATE_MEASUREMENT, hrm_data_handler # FTMS should work with my hrm natively, this
+            # code shouldn't be needed. More work needed
+        )
 
+    async def enable_hrm_notifications(client):
         try:
-            await client.start_notify(
-                "00002a37-0000-1000-8000-00805f9b34fb", hrm_data_handler # FTMS should work with my hrm natively, this
-                # code shouldn't be needed. More work needed
-            )
+            await start_hrm_notify(client)
             print("HRM notifications enabled")
         except Exception as e:
             print(f"Error enabling HRM notifications: {e}")
 
-    try:
-        trainer_ftms = FitnessMachineService(trainer_client)
-        trainer_ftms.set_indoor_bike_data_handler(trainer_data_handler)
-        print("Trainer handler set")
-
+    # Also run again by the supervisor after the trainer reconnects
+    async def start_trainer_notify(client):
         await trainer_ftms.enable_control_point_indicate()
         print("Control point notifications enabled")
 
         await trainer_ftms.enable_indoor_bike_data_notify()
         print("Trainer notifications enabled")
 
+    try:
+        trainer_ftms = make_ftms(trainer_client)
+        trainer_ftms.set_indoor_bike_data_handler(trainer_data_handler)
+        print("Trainer handler set")
+
+        await start_trainer_notify(trainer_client)
+
         hrm_ftms = None
         if hrm_client:
-            hrm_ftms = FitnessMachineService(hrm_client)
+            hrm_ftms = make_ftms(hrm_client)
             await enable_hrm_notifications(hrm_client)
 
+        # If a device drops out, the supervisor reconnects it and runs the same setup again
+        if supervisor is not None:
+            supervisor.watch("trainer", trainer_client, start_trainer_notify)
+            if hrm_client:
+                supervisor.watch("hrm", hrm_client, start_hrm_notify)
+
         print("FTMS and HRM initialized successfully")
         return shared_data, debug_data, trainer_ftms, hrm_ftms,
 
@@ -185,8 +283,10 @@ async def init_ftms(shared_data, debug_data, trainer_client, hrm_client=None):
 
 
 
-# Set up resistance for the trainer
-async def set_resistance(ftms, desired_resistance, current_resistance, shared_data, retries=10, debug=False):
+# Set up resistance for the trainer. This is the old one shot version, the main loop goes through the TrainerController
+# in trainer_control.py now, which keeps control between changes and doesn't block the loop.
+async def set_resistance(ftms, desired_resistance, current_resistance, shared_data, retries=10, debug=False,
+                         resistance_range=(0, 100)):
 
     '''
 I'm unsure if it's an issue with my trainer, pycycling or my bluetooth connection, but the retries here are necessary
@@ -205,11 +305,17 @@ so I can't
     if desired_resistance == current_resistance:
         return current_resistance
 
+    # Each step and the whole thing (retries included) get timed, to see which part the trainer is slow with
+    monitor = get_monitor()
+    started = time.monotonic()
+
     # Main Process, This tries to set the resistance as long as we're below 'retries'
     for attempt in range(retries):
+        if attempt:
+            monitor.count("set_resistance_retries")
         try:
-            # Clamp resistance level between 0 and 100
-            desired_resistance = max(0, min(100, desired_resistance))
+            # Clamp resistance level to what the trainer supports, 0 to 100 unless told otherwise
+            desired_resistance = max(resistance_range[0], min(resistance_range[1], desired_resistance))
             shared_data["d_resistance"] = desired_resistance  # Update desired_resistance in shared_data
             if debug:
                 print(f"Setting resistance level to {desired_resistance}% (Attempt {attempt + 1})...")
@@ -217,33 +323,41 @@ so I can't
             # Request control of the trainer
             if debug:
                 print("Requesting control...")
+            step = time.monotonic()
             control_response = await ftms.request_control()
+            monitor.since("set_resistance_request_control", step)
             if debug:
                 print(f"Control Point Response (Request Control): {control_response}")
 
             # Reset the trainer. Needed
             if debug:
                 print("Resetting trainer...")
+            step = time.monotonic()
             reset_response = await ftms.reset()
+            monitor.since("set_resistance_reset", step)
             if debug:
                 print(f"Control Point Response (Reset): {reset_response}")
 
             # Set the target resistance level
             if debug:
                 print(f"Setting target resistance level to {desired_resistance}%...")
+            step = time.monotonic()
             resistance_response = await ftms.set_target_resistance_level(desired_resistance)
+            monitor.since("set_resistance_set_target", step)
             if debug:
                 print(f"Control Point Response (Set Resistance): {resistance_response}")
 
             if debug:
                 print(f"Resistance successfully set to {desired_resistance}%.")
             shared_data["current_resistance"] = desired_resistance  # Update current_resistance in shared_data
+            monitor.since("set_resistance_total", started)
             return desired_resistance
 
         except Exception as e:
             if debug:
                 print(f"Error while setting resistance (Attempt {attempt + 1}): {e}")
             if attempt == retries - 1:
+                monitor.count("set_resistance_failures")
                 if debug:
                     print("Max retries reached. Giving up.")
                 raise  # Rethrow the exception after the final attempt
@@ -252,14 +366,53 @@ so I can't
     return current_resistance
 
 
+# Copy a pipeline sample's values into shared_data, or debug_data for the debug only ones. Samples can queue up, so this
+# makes sure derived_information sees the values from the sample it's processing rather than whatever came in last.
+debug_keys = {"t_speed", "rmssd"}
+
+def apply_sample(shared_data, debug_data, sample):
+    if sample.values:
+        for key, value in sample.values.items():
+            if key in debug_keys:
+                debug_data[key] = value
+            else:
+                shared_data[key] = value
+
+
+# Looks up where the rider is on the course from the virtual distance, and sets the gradient for the physics. Returns
+# the resistance the course wants at that point.
+def course_position(shared_data, course, distance):
+    gradient, resistance = course.lookup(distance)
+    shared_data["gradient_pct"] = gradient
+    shared_data["gradient"] = math.degrees(math.atan(gradient / 100))  # calculate_virtual_speed wants degrees
+    return resistance
+
+
+# Physics state for the virtual speed. main() makes one with the rider's own coefficients
+default_bike = VirtualBike()
+
+
 # Create Derived information
 
-def derived_information(shared_data, debug_data, elapsed_start_time, is_moving, session_start_time, debug=False):
+def derived_information(shared_data, debug_data, elapsed_start_time, is_moving, session_start_time, debug=False,
+                        bike=None, now=None):
     """
     This function is made up of a number of sub-functions, which take the outputs of the trainer, and convert them into
     useful stats for cycling metrics. We should be able to put any number of features in here, but for now we only have
     the important ones.
+
+    bike is the VirtualBike holding the physics state. If it's not given, the module level one gets used.
+
+    now is the time to use for everything in here, in the same clock as session_start_time. Left as None it's the real
+    time, replay.py passes the time from the session log so a replay comes out the same every time.
     """
+    if bike is None:
+        bike = default_bike
+    if now is None:
+        now = time.time()
+        physics_now = time.monotonic()
+    else:
+        physics_now = now
 
     def calculate_elapsed_time():
 
@@ -275,87 +428,51 @@ def derived_information(shared_data, debug_data, elapsed_start_time, is_moving,
         cadence = shared_data.get("cadence", 0) or 0
         elapsed_time = shared_data.get("raw_elapsed_time", 0)  # Accumulated elapsed time
 
-        if power > 0 or cadence > 0 or shared_data["velocity"] > 0:
+        if power > 0 or cadence > 0 or shared_data.get("velocity", 0) > 0:
             if not is_moving:
                 is_moving = True
-                elapsed_start_time = time.time()  # Start accumulating time
+                elapsed_start_time = now  # Start accumulating time
             elif elapsed_start_time:
-                elapsed_time += time.time() - elapsed_start_time  # Add time since last start
-                elapsed_start_time = time.time()  # Update start time
+                elapsed_time += now - elapsed_start_time  # Add time since last start
+                elapsed_start_time = now  # Update start time
         elif is_moving:
             is_moving = False
             if elapsed_start_time:
-                elapsed_time += time.time() - elapsed_start_time  # Add final elapsed period
+                elapsed_time += now - elapsed_start_time  # Add final elapsed period
                 elapsed_start_time = None
 
-        total_time = time.time() - session_start_time  # Total time since session start
+        total_time = now - session_start_time  # Total time since session start
         shared_data["elapsed_timer"] = format_time(elapsed_time)
         shared_data["raw_elapsed_time"] = elapsed_time  # Persist accumulated elapsed time
         shared_data["total_timer"] = format_time(total_time)
 
-    def calculate_virtual_speed(delta_t=1):
+    def calculate_virtual_speed():
 
         '''
         This is an insane formula, mostly ripped from a couple of blogs and papers, and with a little help from chat gpt
         to help make sense of it. Hopefully it's accurate, it gives a slightly lower speed readout than the speed metric
         recorded from the trainer, which feels like it's in line with a physics simulation, however I am not a physicist
-        so it could be totally off. Additionally, the acceleration and deceleration don't work properly. Another thing
-        to add to the list of things to do.
+        so it could be totally off. The actual maths lives in physics.py now, which steps on the real time between
+        calls rather than pretending every call is 1 second apart.
         '''
 
-        g = 9.8  # gravitational constant
-        C_r = 0.006  # rolling resistance coefficient
-        C_d = 0.88  # drag coefficient
-        A = 0.5  # frontal area (m^2)
-        rho = 1.225  # air density (kg/m^3)
-        bike_mass = 7  # mass of bike
-
         # Get values from shared_data with defaults
         power = shared_data.get("power", 0) or 0
-        weight = (shared_data.get("weight", 70) or 70) + bike_mass
+        weight = shared_data.get("weight", 70) or 70
         gradient = shared_data.get("gradient", 0) or 0  # in degrees
-        v = shared_data.get("v", 0) or 0  # current velocity (m/s)
-
-        # Total mass of the system
-        total_mass = weight
-
-        # Calculate resistive forces
-        f_rolling = C_r * weight * g  # rolling resistance force
-        f_drag = 0.5 * C_d * A * rho * v ** 2  # air drag force
-        f_grad = weight * g * math.sin(math.radians(gradient))  # gradient force
 
-        # Total resistive force
-        f_total = f_rolling + f_drag + f_grad
-
-        # Driving force from power (avoid division by zero for v)
-        if v > 0:
-            f_drive = power / max(v, 0.1)
-        else:
-            f_drive = power / 0.1  # small initial velocity to avoid division by zero
-
-        # Net force and acceleration
-        f_net = f_drive - f_total
-        acceleration = f_net / total_mass  # a = F / m
-        max_acceleration = 5.0  # Maximum realistic acceleration (m/s²)
-        acceleration = max(-max_acceleration, min(acceleration, max_acceleration))
-
-        # Update velocity iteratively with inertia
-        v = max(0, v + acceleration * delta_t)  # velocity cannot be negative
+        v = bike.update(power, weight, gradient, physics_now)
 
         # Convert velocity to km/h for display purposes
         shared_data["velocity"] = v * 3.6  # in km/h
-        shared_data["v"] = v  # Store current velocity in m/s for future calculations
+        shared_data["v"] = v  # Store current velocity in m/s
+
+        shared_data["distance"] = bike.distance  # in m
 
         # Debug data
         debug_data["v"] = v  # in m/s
         debug_data["velocity"] = shared_data["velocity"]  # in km/h
-        debug_data["f_rolling"] = f_rolling
-        debug_data["f_drag"] = f_drag
-        debug_data["f_grad"] = f_grad
-        debug_data["f_total"] = f_total
-        debug_data["f_drive"] = f_drive
-        debug_data["f_net"] = f_net
-        debug_data["acceleration"] = acceleration
+        debug_data.update(bike.forces)
 
         return v
 
@@ -403,10 +520,7 @@ def print_data(shared_data, debug_data, exclude=None, debug=False):
 
 
 # This records the maximum values of each stat, as well as their averages.
-def save_max(shared_data, debug_data, file_name="max_values.json"):
-
-    # Clear the file by opening it in write mode and immediately closing it
-    open(file_name, "w").close()
+def max_summary(shared_data, debug_data):
 
     # Initialize max, sums, and counts
     max_values = {}
@@ -430,18 +544,22 @@ def save_max(shared_data, debug_data, file_name="max_values.json"):
     # Calc average values
     avg_values = {key: avg_sums[key] / avg_counts[key] for key in avg_sums}
 
+    return {
+        "max_values": max_values,
+        "avg_values": avg_values,
+        "avg_sums": avg_sums,  # Save sums and counts for persistent averages
+        "avg_counts": avg_counts,
+    }
+
+
+# Writes the snapshot summary straight to disk. The main loop doesn't use this anymore, the session recorder writes the
+# running stats from ride_stats at checkpoints instead.
+def save_max(shared_data, debug_data, file_name="max_values.json"):
+
     # Save the updated data to the JSON file
     with open(file_name, "w") as json_file:
-        json.dump(
-            {
-                "max_values": max_values,
-                "avg_values": avg_values,
-                "avg_sums": avg_sums,  # Save sums and counts for persistent averages
-                "avg_counts": avg_counts,
-            },
-            json_file,
-            indent=4,
-        )
+        json.dump(max_summary(shared_data, debug_data), json_file, indent=4)
+
 
 
 
@@ -451,14 +569,44 @@ def save_max(shared_data, debug_data, file_name="max_values.json"):
 
 
 
+# Runs the post ride analysis on a thread, as it's a few hundred ms of numpy for a long ride. numpy is only needed for
+# this, so without it the ride still gets saved, just not analysed.
+async def analyse_session_file(session_file, ftp, max_hr):
+    try:
+        from ride_analysis import analyse_session
+    except ImportError:
+        print("numpy isn't installed, skipping the ride analysis.")
+        return None
+    try:
+        results, output_file = await asyncio.get_running_loop().run_in_executor(None, analyse_session, session_file,
+                                                                                ftp, max_hr)
+    except Exception as e:
+        print(f"Error analysing the ride: {e}")
+        return None
+    if results:
+        print(f"Ride analysis saved to {output_file} (NP {results['normalized_power']:.0f} W, "
+              f"TSS {results['tss']:.0f})")
+    return results
+
 
 '''
 Main Loop
 '''
 
-async def main():
+# The clock a session runs on, when it isn't the real one: with simulated devices it's their SimClock, so with
+# --sim-speed the timers, the checkpoints, the workout and the times in the session log all go at the same speed as
+# the devices. None for real devices.
+def session_clock(trainer_client):
+    if getattr(trainer_client, "simulated", False):
+        return trainer_client.clock
+    return None
+
+
+# sinks is a list of (fn, rate) for anything else that wants the live data, like the GUI. Each fn gets called with
+# shared_data and debug_data, at most rate times a second, and should hand the data off rather than do anything slow.
+async def main(sinks=()):
     # Initialise shared_data before creating tasks
-    shared_data, settings, debug_data = init_shared_data(user_profile)
+    shared_data, settings, debug_data = init_shared_data(user_profile, rider)
 
     # Grab some variables from the settings
     trainer_address = settings["trainer_address"]
@@ -466,54 +614,262 @@ async def main():
     hrm_address = settings["hrm_address"]
     hrm_name = settings["hrm_name"]
 
-    # Connect devices
-    devices = {
-        "trainer": (trainer_address, trainer_name),
-        "hrm": (hrm_address, hrm_name),
-    }
-    connected_clients = await device_connection(devices)
+    # Keeps an eye on the connections and reconnects anything that drops out
+    supervisor = ConnectionSupervisor(shared_data, debug_data, debug=debug)
+
+    # Connect devices, or make up some simulated ones
+    if simulate:
+        connected_clients = create_simulated_clients(simulate, speed=sim_speed, trainer_rate=sim_trainer_rate,
+                                                     hrm_rate=sim_hrm_rate)
+        for device_type, client in connected_clients.items():
+            client.disconnected_callback = supervisor.disconnect_callback(device_type)
+            await client.connect()
+        print(f"Using simulated devices ({simulate}, {sim_speed}x speed)")
+    else:
+        devices = {
+            "trainer": (trainer_address, trainer_name),
+            "hrm": (hrm_address, hrm_name),
+        }
+        connected_clients = await device_connection(devices, supervisor.disconnect_callback)
 
     if connected_clients:
         trainer_client = connected_clients.get("trainer")
         hrm_client = connected_clients.get("hrm")
 
         if trainer_client:
-            # Initialize FTMS
-            shared_data, debug_data, trainer_ftms, hrm_ftms = await init_ftms(shared_data, debug_data, trainer_client, hrm_client)
+            # Ride stats carry on from the last checkpoint if the previous session crashed
+            stats, resumed = resume_stats(summary_file)
+            if resumed:
+                print("Resuming ride stats from the last checkpoint.")
+
+            sim_clock = session_clock(trainer_client)
+            session_time = sim_clock.time if sim_clock else time.time
+            session_monotonic = sim_clock.now if sim_clock else time.monotonic
+
+            # Samples get appended to the session log, the summary is only written at checkpoints and at the end
+            recorder = SessionRecorder(
+                log_dir=session_dir,
+                summary_file=summary_file,
+                summary_fn=lambda: stats_checkpoint(stats),
+                checkpoint_interval=checkpoint_interval,
+                clock=session_monotonic,
+            )
+            if export_tcx:
+                recorder.exporters.append(TcxWriter(os.path.splitext(recorder.log_path)[0] + ".tcx"))
 
             # Start with the base resistance
             current_resistance = settings.get("base_resistance", 20)
 
             elapsed_start_time = None
             is_moving = False
-            session_start_time = time.time()
+            session_start_time = session_time()
+            bike = VirtualBike(RiderCoefficients.from_profile(settings["physics"]))
+
+            # The course gets looked up by distance every sample, and sets the gradient and the resistance
+            course = None
+            course_resistance = settings["base_resistance"]
+            if course_file:
+                course = load_course(course_file, settings["base_resistance"], settings["difficulty"], course_loop)
+                print(f"Course loaded: {course.name}, {course.length / 1000:.1f}km")
+
+            # The workout is compiled once here, the player keeps track of where we are in it
+            workout = None
+            if workout_file:
+                workout = WorkoutPlayer(load_workout(workout_file, settings["ftp"]))
+                print(f"Workout loaded: {workout.workout.name}, {len(workout.workout.steps)} steps, "
+                      f"{workout.workout.length // 60} min")
+
+            # Latency histograms for how old the data is by the time it's processed and shown
+            monitor = get_monitor()
+            last_processed = None
+
+            # Work out the derived metrics for a new sample. In pipeline mode this runs once per sample, otherwise
+            # once per loop tick
+            def process_sample(sample=None):
+                nonlocal elapsed_start_time, is_moving, course_resistance, last_processed
+                if sample is not None:
+                    if sample.values:
+                        monitor.since("notify_to_process", sample.timestamp)
+                    apply_sample(shared_data, debug_data, sample)
+                else:
+                    # Polling mode, only count each notification once
+                    arrival = sample_store.latest["power"].timestamp
+                    if arrival is not None and arrival != last_processed:
+                        last_processed = arrival
+                        monitor.since("notify_to_process", arrival)
+                if course:
+                    course_resistance = course_position(shared_data, course, bike.distance)
+                elapsed_start_time, is_moving = derived_information(shared_data, debug_data, elapsed_start_time,
+                                                                    is_moving, session_start_time, bike=bike,
+                                                                    now=session_time() if sim_clock else None)
+
+            def store_sample():
+                timestamp = session_time()
+                stats.update(shared_data, debug_data, timestamp=timestamp, moving=is_moving)
+                recorder.record(shared_data, debug_data, timestamp=timestamp)
+
+            # The dashboard only redraws what has changed, at its own rate. print_data is the old single line readout
+            dashboard = TerminalDashboard(rate=display_rate, show_debug=debug) if use_dashboard else None
+            if dashboard:
+                # Messages from here on go on the dashboard's status line rather than scrolling it
+                supervisor.log = dashboard.message
+                if workout:
+                    dashboard.bind("p", workout.toggle_pause, "pause")
+                    dashboard.bind("n", workout.skip, "next step")
+                    dashboard.bind("+", lambda: workout.extend(workout_extend), f"+{workout_extend}s")
+                dashboard.enable_keys(asyncio.get_running_loop())
+
+            # Live data for other screens. It's just another sink, the sending happens in the server's own tasks
+            telemetry = None
+            if telemetry_port:
+                telemetry = TelemetryServer(telemetry_host, telemetry_port, max_rate=telemetry_rate, debug=debug,
+                                            log=dashboard.message if dashboard else None)
+                try:
+                    await telemetry.start()
+                    sinks = list(sinks) + [(telemetry.publish, telemetry_rate)]
+                except OSError as e:
+                    print(f"Error starting the telemetry server: {e}")
+                    telemetry = None
+
+            def display_sample():
+                # How old the power on screen is
+                age = sample_store.latest["power"].age()
+                if age is not None:
+                    debug_data["render_lag_ms"] = age * 1000
+                if dashboard:
+                    rendered = dashboard.render(shared_data, debug_data)
+                else:
+                    print_data(shared_data, debug_data, "raw_elapsed_time", debug=True)
+                    rendered = True
+                if rendered:
+                    monitor.record("notify_to_render", age)
+
+            # Hands the target to the trainer controller, which sends it in the background. Nothing here waits on
+            # bluetooth, so telemetry keeps flowing while the trainer catches up
+            erg = None
+
+            def update_resistance():
+                shared_data["c_resistance"] = shared_data.get("current_resistance", current_resistance)
+
+                # The workout's target for this second, if there is one. Free ride steps fall through to the
+                # ERG power or the course, the same as without a workout
+                target_power = erg_power
+                if workout:
+                    kind, value = workout.update(session_monotonic(), moving=is_moving)
+                    shared_data["workout_step"], shared_data["workout_left"] = workout.status()
+                    if kind == "resistance":
+                        if erg and erg.target is not None:
+                            erg.release()
+                            shared_data["erg_target"] = None
+                        controller.set_resistance(value)
+                        return
+                    if kind == "power":
+                        target_power = value
+
+                # In ERG mode the controller works the resistance out from the power, or the trainer does it
+                if erg:
+                    if not target_power:
+                        if erg.target is not None:
+                            erg.release()
+                            shared_data["erg_target"] = None
+                    else:
+                        if target_power != erg.target:
+                            erg.set_target(target_power)
+                            shared_data["erg_target"] = target_power
+                        erg.update(shared_data.get("power"), shared_data.get("cadence"), session_monotonic())
+                        return
+
+                # The course sets the resistance from the gradient. Without one it's the base resistance
+                desired_resistance = course_resistance
+                controller.set_resistance(desired_resistance)
+
+            # In pipeline mode, the handlers push each sample into the pipeline queue as it arrives
+            pipeline = None
+            if use_pipeline:
+                pipeline = SamplePipeline(process_sample, log=dashboard.message if dashboard else None)
+                pipeline.add_consumer(store_sample, rate=storage_rate)
+                pipeline.add_consumer(display_sample, rate=display_rate)
+                pipeline.add_consumer(update_resistance, rate=erg_rate if erg_power or workout else resistance_rate)
+                for sink, rate in sinks:
+                    pipeline.add_consumer(lambda sink=sink: sink(shared_data, debug_data), rate=rate)
+
+            # Initialize FTMS. The sample store keeps the timestamped history behind shared_data
+            sample_store = SampleStore()
+            shared_data, debug_data, trainer_ftms, hrm_ftms = await init_ftms(shared_data, debug_data, trainer_client,
+                                                                              hrm_client, sample_store, pipeline,
+                                                                              supervisor)
+
+            # What the trainer supports, from the cache if it's been seen before. The resistance range is what the
+            # targets get clamped to
+            capabilities = None
+            try:
+                capabilities = await get_capabilities(trainer_client, trainer_ftms)
+            except Exception as e:
+                print(f"Error reading trainer capabilities: {e}")
 
+            # One control session for the whole ride, with a background task sending the newest resistance target
+            controller = TrainerController(trainer_ftms, shared_data, resistance_range=resistance_limits(capabilities),
+                                           debug=debug, log=dashboard.message if dashboard else None)
+            controller_task = asyncio.create_task(controller.run())
 
-            try:
-                while True:
-                    # RESISTANCE LOGIC GOES HERE. SLOPES ETC
-                    desired_resistance = 20
+            if erg_power or workout:
+                erg = ErgController(controller, capabilities, erg_mode)
+            if erg_power:
+                erg.set_target(erg_power)
+                shared_data["erg_target"] = erg_power
+                print(f"ERG mode, holding {erg_power} W ({erg.mode} control)")
 
-                    # Update resistance only if it has changed
-                    current_resistance = await set_resistance(
-                        trainer_ftms, desired_resistance, current_resistance, shared_data, retries=10, debug=debug
-                    )
+            # After the trainer reconnects, control has to be requested again and the target sent again
+            supervisor.on_reconnect("trainer", lambda client: controller.reacquire())
 
-                    # Update derived information and get updated elapsed_start_time and is_moving
-                    elapsed_start_time, is_moving = derived_information(shared_data, debug_data, elapsed_start_time, is_moving,
-                                                                        session_start_time)
+            try:
+                if pipeline:
+                    await pipeline.run()
+                else:
+                    # Polling mode, the old way of doing things
+                    while True:
+                        update_resistance()
 
-                    # Print the data to the console
-                    print_data(shared_data, debug_data, "raw_elapsed_time", debug=True)
-                    save_max(shared_data, debug_data)
+                        # Update derived information and get updated elapsed_start_time and is_moving
+                        process_sample()
 
-                    await asyncio.sleep(0.1)  # Adjust as needed for real-time updates
+                        # Print the data to the console
+                        display_sample()
+                        store_sample()
+                        for sink, rate in sinks:
+                            sink(shared_data, debug_data)
+
+                        await asyncio.sleep(0.1)  # Adjust as needed for real-time updates
 
 
             except KeyboardInterrupt:
                 print("\nExiting notification loop.")
             finally:
-                print("\nDisconnecting devices...")
+                supervisor.stop()
+                controller_task.cancel()
+                if dashboard:
+                    dashboard.close(asyncio.get_running_loop())
+                if telemetry:
+                    await telemetry.close()
+
+                # Mark the final summary as finished so the next session starts fresh
+                recorder.summary_fn = lambda: stats_checkpoint(stats, finished=True)
+                await recorder.close()
+                print(f"\nSession saved to {recorder.log_path}")
+                if pipeline and pipeline.errors:
+                    print(f"{pipeline.errors} errors in the pipeline during the ride")
+                if export_tcx:
+                    print(f"Ride file saved to {os.path.splitext(recorder.log_path)[0]}.tcx")
+                if analyse_ride and recorder.samples_recorded:
+                    await analyse_session_file(recorder.log_path, settings["ftp"], settings["max_hr"])
+
+                latency_file = os.path.splitext(recorder.log_path)[0] + ".latency.json"
+                try:
+                    monitor.dump(latency_file)
+                    print(f"Latency stats saved to {latency_file}")
+                except OSError as e:
+                    print(f"Error saving latency stats: {e}")
+                print("Disconnecting devices...")
                 await trainer_client.disconnect()
                 if hrm_client:
                     await hrm_client.disconnect()
@@ -528,4 +884,39 @@ async def main():
 
 
 # Run the main loop
-asyncio.run(main())
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trainer data")
+    parser.add_argument("--simulate", metavar="PROFILE", default=simulate,
+                        help="use simulated devices: steady, intervals, ramp, rider, or a session .jsonl to play back")
+    parser.add_argument("--sim-speed", type=float, default=sim_speed,
+                        help="simulated time multiplier for the devices and the session, e.g. 100")
+    parser.add_argument("--sim-trainer-rate", type=float, default=sim_trainer_rate, help="trainer notifications/s")
+    parser.add_argument("--sim-hrm-rate", type=float, default=sim_hrm_rate, help="HRM notifications/s")
+    parser.add_argument("--rider", default=rider, help="rider profile to use")
+    parser.add_argument("--course", default=course_file, help="route file to ride (.gpx, .csv or .json)")
+    parser.add_argument("--loop", action="store_true", default=course_loop, help="repeat the course at the end")
+    parser.add_argument("--erg", type=float, default=erg_power, metavar="WATTS", help="ERG mode, hold this power")
+    parser.add_argument("--erg-mode", choices=["auto", "power", "resistance"], default=erg_mode,
+                        help="let the trainer hold the power, or do it here with resistance")
+    parser.add_argument("--workout", default=workout_file, help="structured workout to ride (.zwo or .json)")
+    parser.add_argument("--telemetry", type=int, default=telemetry_port, metavar="PORT",
+                        help="serve live data over WebSocket on this port")
+    parser.add_argument("--telemetry-host", default=telemetry_host, help="address for the telemetry server")
+    args = parser.parse_args()
+
+    simulate = args.simulate
+    sim_speed = args.sim_speed
+    sim_trainer_rate = args.sim_trainer_rate
+    sim_hrm_rate = args.sim_hrm_rate
+    rider = args.rider
+    if rider and rider not in get_store(user_profile).names():
+        parser.error(f"no rider profile called {rider}, set it up with connect_profile.py --rider {rider}")
+    course_file = args.course
+    course_loop = args.loop
+    erg_power = args.erg
+    erg_mode = args.erg_mode
+    workout_file = args.workout
+    telemetry_port = args.telemetry
+    telemetry_host = args.telemetry_host
+
+    asyncio.run(main())
@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import xml.etree.ElementTree as ET
+from array import array
+
+'''
+Structured workouts. Loads a ZWO file (the zwift workout format) or a JSON list of intervals, and compiles it once into
+a flat table with a target for every second of the workout, so during the ride the target is one index into an array
+rather than walking the workout's repeats and ramps every tick. FTP relative targets get turned into watts when it's
+compiled.
+
+Each second has a kind and a value: "power" (watts, for ERG), "resistance" (%, sent straight to the trainer), or
+"free" (no target, the ride carries on by course or base resistance as normal).
+
+Supported in ZWO files: SteadyState, Warmup, Cooldown and Ramp (PowerLow to PowerHigh), IntervalsT and FreeRide.
+Powers there are fractions of FTP.
+
+JSON files are {"name": ..., "steps": [...]}, or just the list of steps. Each step has a duration in seconds and one of
+    "power": 0.9                  fraction of FTP
+    "from": 0.5, "to": 0.75       ramp, fractions of FTP
+    "watts": 200                  (or "from_watts" and "to_watts" for a ramp)
+    "resistance": 40              trainer resistance %
+or none of them for free riding. {"repeat": 5, "steps": [...]} repeats the steps inside it. Any step can have a name.
+
+The table doesn't change during the ride. Where the rider is in it is kept by the WorkoutPlayer, which is what pause,
+skip and extend work on, so none of them need anything recompiling:
+    pause   - position stops moving (it also stops while the rider isn't moving)
+    skip    - position jumps to the start of the next step
+    extend  - position holds on the last second of the current step for the extra time
+
+    python workout.py my_workout.zwo --ftp 250
+'''
+
+kinds = ("free", "power", "resistance")  # Kind codes in the table are indexes into this
+
+
+class WorkoutStep:
+    __slots__ = ("name", "duration", "kind", "start", "end", "relative")
+
+    def __init__(self, duration, kind="free", start=None, end=None, relative=True, name=None):
+        self.name = name or ("Free ride" if kind == "free" else "Ramp" if end not in (None, start) else "Steady")
+        self.duration = max(1, int(round(duration)))  # The table is per second
+        self.kind = kind
+        self.start = start
+        self.end = start if end is None else end
+        self.relative = relative  # start and end are fractions of FTP
+
+
+class Workout:
+    def __init__(self, steps, ftp=200, name=None):
+        self.name = name
+        self.ftp = ftp
+        self.steps = list(steps)
+        self.starts = array("L")  # Second each step starts on, plus the end of the workout
+        self.kinds = array("b")
+        self.targets = array("d")
+        self.step_index = array("L")
+
+        for index, step in enumerate(self.steps):
+            self.starts.append(len(self.targets))
+            kind = kinds.index(step.kind)
+            scale = ftp if step.relative and step.kind == "power" else 1
+            for second in range(step.duration):
+                if step.kind == "free":
+                    value = 0.0
+                else:
+                    value = (step.start + (step.end - step.start) * second / step.duration) * scale
+                self.kinds.append(kind)
+                self.targets.append(value)
+                self.step_index.append(index)
+        self.starts.append(len(self.targets))
+
+    @property
+    def length(self):
+        return len(self.targets)
+
+    # (kind, value) at a position in seconds, None for the value when it's free riding or past the end
+    def lookup(self, position):
+        second = int(position)
+        if second < 0 or second >= len(self.targets):
+            return "free", None
+        kind = kinds[self.kinds[second]]
+        return kind, (None if kind == "free" else self.targets[second])
+
+    def step_at(self, position):
+        second = int(position)
+        if second >= len(self.step_index):
+            return len(self.steps)
+        return self.step_index[max(0, second)]
+
+
+# Where the rider is in a compiled workout
+class WorkoutPlayer:
+    def __init__(self, workout, hold_margin=1e-3):
+        self.workout = workout
+        self.position = 0.0  # Seconds into the workout table
+        self.extra = 0.0  # Extension still to be ridden on the current step
+        self.paused = False
+        self.hold_margin = hold_margin  # How far before the end of a step an extension holds, to stay in it
+        self._last = None
+
+    @property
+    def finished(self):
+        return self.position >= self.workout.length
+
+    @property
+    def step(self):
+        return self.workout.step_at(self.position)
+
+    # Seconds left in the current step, extension included
+    def step_remaining(self):
+        if self.finished:
+            return 0.0
+        return self.workout.starts[self.step + 1] - self.position + self.extra
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+
+    def skip(self):
+        if not self.finished:
+            self.position = float(self.workout.starts[self.step + 1])
+        self.extra = 0.0
+
+    def extend(self, seconds=30):
+        if not self.finished:
+            self.extra += seconds
+
+    def _advance(self, dt):
+        if self.extra > 0:
+            # Ride up to just before the end of the step, use up the extension there, then carry on with what's left
+            hold_at = self.workout.starts[self.step + 1] - self.hold_margin
+            to_hold = max(0.0, hold_at - self.position)
+            if dt > to_hold:
+                held = min(dt - to_hold, self.extra)
+                self.extra -= held
+                dt -= held
+        self.position = min(self.position + dt, float(self.workout.length))
+
+    # Move on by the time since the last call, unless paused or the rider isn't moving, and give back (kind, value)
+    def update(self, now, moving=True):
+        if self._last is not None and moving and not self.paused:
+            self._advance(max(0.0, now - self._last))
+        self._last = now
+        return self.workout.lookup(self.position)
+
+    # For the display, e.g. ("3/12 Intervals", "1:05")
+    def status(self):
+        if self.finished:
+            return "Done", "0:00"
+        index = self.step
+        minutes, seconds = divmod(int(self.step_remaining() + 0.999), 60)
+        left = f"{minutes}:{seconds:02}" + (" paused" if self.paused else "")
+        return f"{index + 1}/{len(self.workout.steps)} {self.workout.steps[index].name}", left
+
+
+# Reading the files. Both give back (name, steps) with the repeats already unrolled.
+def _load_zwo(file_name):
+    root = ET.parse(file_name).getroot()
+    name = root.findtext("name")
+    steps = []
+    body = root.find("workout")
+    for element in (body if body is not None else []):
+        tag = element.tag
+        duration = float(element.get("Duration", 0))
+        if tag == "SteadyState":
+            steps.append(WorkoutStep(duration, "power", float(element.get("Power"))))
+        elif tag in ("Warmup", "Cooldown", "Ramp"):
+            steps.append(WorkoutStep(duration, "power", float(element.get("PowerLow")), float(element.get("PowerHigh")),
+                                     name=tag if tag != "Ramp" else None))
+        elif tag == "IntervalsT":
+            on = WorkoutStep(float(element.get("OnDuration")), "power", float(element.get("OnPower")), name="On")
+            off = WorkoutStep(float(element.get("OffDuration")), "power", float(element.get("OffPower")), name="Off")
+            for _ in range(int(element.get("Repeat", 1))):
+                steps.extend((on, off))
+        elif tag in ("FreeRide", "MaxEffort"):
+            steps.append(WorkoutStep(duration, "free", name="Free ride" if tag == "FreeRide" else "Max effort"))
+    return name, steps
+
+
+def _json_steps(items):
+    steps = []
+    for item in items:
+        if "repeat" in item:
+            inner = _json_steps(item.get("steps", []))
+            steps.extend(inner * int(item["repeat"]))
+            continue
+        duration = float(item["duration"])
+        name = item.get("name")
+        if "power" in item:
+            steps.append(WorkoutStep(duration, "power", float(item["power"]), name=name))
+        elif "from" in item:
+            steps.append(WorkoutStep(duration, "power", float(item["from"]), float(item["to"]), name=name))
+        elif "watts" in item:
+            steps.append(WorkoutStep(duration, "power", float(item["watts"]), relative=False, name=name))
+        elif "from_watts" in item:
+            steps.append(WorkoutStep(duration, "power", float(item["from_watts"]), float(item["to_watts"]),
+                                     relative=False, name=name))
+        elif "resistance" in item:
+            steps.append(WorkoutStep(duration, "resistance", float(item["resistance"]), relative=False, name=name))
+        else:
+            steps.append(WorkoutStep(duration, name=name))
+    return steps
+
+
+def _load_json(file_name):
+    with open(file_name, "r") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return None, _json_steps(data)
+    return data.get("name"), _json_steps(data.get("steps", []))
+
+
+def load_workout(file_name, ftp=200):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".zwo":
+        name, steps = _load_zwo(file_name)
+    elif extension == ".json":
+        name, steps = _load_json(file_name)
+    else:
+        raise ValueError(f"Unsupported workout file: {file_name}")
+
+    if not steps:
+        raise ValueError(f"No steps found in {file_name}")
+    return Workout(steps, ftp, name or os.path.splitext(os.path.basename(file_name))[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show a workout's compiled steps")
+    parser.add_argument("file", help=".zwo or .json workout")
+    parser.add_argument("--ftp", type=float, default=200)
+    args = parser.parse_args()
+
+    workout = load_workout(args.file, args.ftp)
+    print(f"{workout.name}: {len(workout.steps)} steps, {workout.length // 60}:{workout.length % 60:02}")
+    for index, step in enumerate(workout.steps):
+        start = workout.starts[index]
+        first = workout.lookup(start)[1]
+        last = workout.lookup(workout.starts[index + 1] - 1)[1]
+        target = "--" if first is None else f"{first:.0f}" if first == last else f"{first:.0f}-{last:.0f}"
+        unit = {"power": " W", "resistance": " %"}.get(step.kind, "")
+        print(f"  {start // 60:>3}:{start % 60:02}  {step.duration:>5}s  {step.name:<12} {target}{unit}")